@@ -0,0 +1,34 @@
+import asyncio
+from sqlalchemy import text
+from app.db.models import PENDING_MANUFACTURER_PREDICATE, RECEIVED_FROM_MFR_PREDICATE
+from app.db.session import async_session_maker
+
+# Indexes declared on the models; create_all only adds them to new databases
+INDEXES = [
+    ("ix_transactions_created_at_id", "transactions (created_at, id)"),
+    ("ix_transactions_type_created_at", "transactions (type, created_at)"),
+    ("ix_transactions_linked_transaction_id_type", "transactions (linked_transaction_id, type)"),
+    ("ix_transactions_customer_id_created_at", "transactions (customer_id, created_at)"),
+    ("ix_transaction_items_transaction_id", "transaction_items (transaction_id)"),
+    ("ix_transaction_items_product_id_transaction_id", "transaction_items (product_id, transaction_id)"),
+    ("ix_products_store_id_product_type_status", "products (store_id, product_type, status)"),
+    ("ix_products_pending_manufacturer", f"products (id) WHERE {PENDING_MANUFACTURER_PREDICATE}"),
+    ("ix_products_received_from_mfr", f"products (store_id, product_type, id) WHERE {RECEIVED_FROM_MFR_PREDICATE}"),
+]
+
+async def add_indexes():
+    async with async_session_maker() as session:
+        print("Adding indexes...")
+        try:
+            for name, target in INDEXES:
+                await session.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target};"))
+                print(f"  Added '{name}'.")
+
+            await session.commit()
+            print("Done. Schema updated successfully.")
+        except Exception as e:
+            print(f"Error: {e}")
+            await session.rollback()
+
+if __name__ == "__main__":
+    asyncio.run(add_indexes())
@@ -0,0 +1,238 @@
+"""Per-process index of AVAILABLE product ids by (store_id, product_type).
+
+Each key holds an `array('q')` of ids plus a slot map for O(1) add, remove and
+pick (removal swaps the last id into the hole). The index is loaded at startup and
+follows product writes:
+
+- flushed Product instances are recorded with their final status, store and type;
+- bulk UPDATEs are recorded by ProductRepository.update_many / update_each, with
+  whatever of status, store_id and product_type they set.
+
+Changes are applied when the session commits and dropped on rollback. A change
+that makes a product AVAILABLE without saying where (e.g. a buyback's
+status-only UPDATE) removes the id until `resolve()` reads its store and type.
+
+The index only hints which rows to pick, never whether stock is available: it can
+lag commits of other worker processes until `verify()` repairs the drift, so a
+count from it could turn away a sale the database would allow. Picks lock the
+hinted rows and re-check them in the database, falling back to the plain query
+when the hint comes up short, and stock checks are the outcome of that claim.
+"""
+import asyncio
+import logging
+from array import array
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from app.db.models import Product, ProductStatus
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[int, str]
+# id -> (status, store_id, product_type); None marks a value the write did not set
+Change = Tuple[Optional[str], Optional[int], Optional[str]]
+
+# Status recorded for deleted products: anything but AVAILABLE drops the id
+DELETED = "deleted"
+_STAGED_KEY = "availability_staged"
+_UNRESOLVED_KEY = "availability_unresolved"
+
+class AvailabilityIndex:
+    def __init__(self):
+        self.loaded = False
+        self.verifications = 0
+        self.repairs = 0
+        self._ids: Dict[Key, array] = {}
+        self._slots: Dict[int, Tuple[Key, int]] = {}
+        # Ids changed by commits while verify() is reading, which its reads may predate
+        self._changed_during_verify: Optional[Set[int]] = None
+
+    # --- O(1) operations ---
+
+    def add(self, product_id: int, key: Key):
+        slot = self._slots.get(product_id)
+        if slot is not None:
+            if slot[0] == key:
+                return
+            self.discard(product_id)
+        ids = self._ids.setdefault(key, array("q"))
+        self._slots[product_id] = (key, len(ids))
+        ids.append(product_id)
+
+    def discard(self, product_id: int):
+        slot = self._slots.pop(product_id, None)
+        if slot is None:
+            return
+        key, pos = slot
+        ids = self._ids[key]
+        last = ids.pop()
+        if last != product_id:
+            ids[pos] = last
+            self._slots[last] = (key, pos)
+
+    def pick(self, store_id: int, product_type: str, count: int) -> List[int]:
+        """Up to `count` ids believed AVAILABLE; the caller locks and re-checks them."""
+        ids = self._ids.get((store_id, product_type))
+        return ids[:count].tolist() if ids is not None else []
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    # --- Write tracking ---
+
+    def stage(self, session: Session, changes: Dict[int, Change]):
+        """Record product changes of the session's open transaction, applied on commit."""
+        staged = session.info.setdefault(_STAGED_KEY, {})
+        for product_id, (status, store_id, product_type) in changes.items():
+            previous = staged.get(product_id, (None, None, None))
+            staged[product_id] = (
+                status if status is not None else previous[0],
+                store_id if store_id is not None else previous[1],
+                product_type if product_type is not None else previous[2],
+            )
+
+    def _note_changes(self, ids):
+        if self._changed_during_verify is not None:
+            self._changed_during_verify.update(ids)
+
+    def _apply(self, session: Session, staged: Dict[int, Change]):
+        self._note_changes(staged)
+        unresolved = session.info.setdefault(_UNRESOLVED_KEY, set())
+        for product_id, (status, store_id, product_type) in staged.items():
+            if status is not None and status != ProductStatus.AVAILABLE:
+                self.discard(product_id)
+                unresolved.discard(product_id)
+            elif status is not None and store_id is not None and product_type is not None:
+                self.add(product_id, (store_id, product_type))
+                unresolved.discard(product_id)
+            else:
+                # Availability or placement unknown here: drop it until resolve() reads it
+                self.discard(product_id)
+                unresolved.add(product_id)
+
+    async def resolve(self, db):
+        """Read store, type and status of the products committed with an unknown placement."""
+        unresolved: Set[int] = db.info.pop(_UNRESOLVED_KEY, None) or set()
+        if not unresolved or not self.loaded:
+            return
+        placements = await self._read(db, unresolved)
+        self._note_changes(unresolved)
+        for product_id, key in placements.items():
+            if key is not None:
+                self.add(product_id, key)
+
+    async def _read(self, db, ids: Set[int]) -> Dict[int, Optional[Key]]:
+        """Current placement of `ids`: (store_id, product_type) when AVAILABLE, else None."""
+        result = await db.execute(
+            select(Product.id, Product.store_id, Product.product_type, Product.status)
+            .where(Product.id.in_(ids))
+        )
+        placements = dict.fromkeys(ids)
+        for row in result.all():
+            if row.status == ProductStatus.AVAILABLE:
+                placements[row.id] = (row.store_id, row.product_type)
+        return placements
+
+    # --- Loading and verification ---
+
+    async def _snapshot(self, db) -> Dict[int, Key]:
+        result = await db.execute(
+            select(Product.id, Product.store_id, Product.product_type)
+            .where(Product.status == ProductStatus.AVAILABLE)
+        )
+        return {row.id: (row.store_id, row.product_type) for row in result.all()}
+
+    def _replace(self, snapshot: Dict[int, Key]):
+        self._ids, self._slots = {}, {}
+        for product_id, key in sorted(snapshot.items()):
+            self.add(product_id, key)
+
+    async def load(self, db):
+        self._replace(await self._snapshot(db))
+        self.loaded = True
+
+    def _key(self, product_id: int) -> Optional[Key]:
+        slot = self._slots.get(product_id)
+        return slot[0] if slot is not None else None
+
+    async def verify(self, db) -> int:
+        """Compare with the database and repair the ids that differ; returns how many did.
+
+        A difference against the full snapshot may only mean a commit was applied after
+        the snapshot was read, so differing ids are read again, and ids that commits
+        change while verify() is reading are left to those commits.
+        """
+        if not self.loaded:
+            await self.load(db)
+            return 0
+        self._changed_during_verify = set()
+        try:
+            snapshot = await self._snapshot(db)
+            differing = {
+                product_id for product_id in snapshot.keys() | self._slots.keys()
+                if snapshot.get(product_id) != self._key(product_id)
+            } - self._changed_during_verify
+            placements = await self._read(db, differing) if differing else {}
+            changed = self._changed_during_verify
+        finally:
+            self._changed_during_verify = None
+        self.verifications += 1
+        drift = 0
+        for product_id, key in placements.items():
+            if product_id in changed or key == self._key(product_id):
+                continue
+            drift += 1
+            if key is None:
+                self.discard(product_id)
+            else:
+                self.add(product_id, key)
+        if drift:
+            self.repairs += 1
+            logger.warning("Availability index differed from the database on %d products; repaired", drift)
+        self.loaded = True
+        return drift
+
+    async def run_verifier(self, open_session: Callable, interval: float):
+        """Verify every `interval` seconds with a fresh session, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with open_session() as db:
+                    await self.verify(db)
+            except Exception:
+                logger.exception("Availability index verification failed")
+
+    def clear(self):
+        self._ids, self._slots = {}, {}
+        self.loaded = False
+
+    def counters(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "products": len(self._slots),
+            "keys": sum(1 for ids in self._ids.values() if ids),
+            "verifications": self.verifications,
+            "repairs": self.repairs,
+        }
+
+availability_index = AvailabilityIndex()
+
+@event.listens_for(Session, "after_flush")
+def _stage_flushed_products(session, flush_context):
+    changes = {
+        obj.id: (obj.status, obj.store_id, obj.product_type)
+        for obj in (*session.new, *session.dirty) if isinstance(obj, Product)
+    }
+    changes.update({obj.id: (DELETED, None, None) for obj in session.deleted if isinstance(obj, Product)})
+    if changes:
+        availability_index.stage(session, changes)
+
+@event.listens_for(Session, "after_commit")
+def _apply_committed(session):
+    staged = session.info.pop(_STAGED_KEY, None)
+    if staged:
+        availability_index._apply(session, staged)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_rolled_back(session):
+    session.info.pop(_STAGED_KEY, None)
@@ -0,0 +1,131 @@
+"""Sparse fieldsets (`?fields=`) and opt-in expansions (`?include=`) for list endpoints.
+
+`fields` names the scalar fields to return (all of them when omitted), `include`
+the related objects to load and embed (none when omitted; "items.product" style
+names reach one level down and imply their parent). Leaving both out keeps an
+endpoint's full default response. The
+repository builds its loader options from the same expansion set, so relations
+that are not returned are not queried either (they are `raiseload`-ed, and
+`dump_sparse` never reads them).
+"""
+from typing import Dict, Iterable, List, Optional, Set
+from pydantic import BaseModel, TypeAdapter
+
+class Fieldset:
+    def __init__(self, fields: Optional[Set[str]], include: Optional[Set[str]], is_default: bool = False):
+        self.fields = fields
+        self.include = include
+        self.is_default = is_default
+
+    def returns(self, name: str) -> bool:
+        """Whether scalar field `name` is in the response."""
+        return self.fields is None or name in self.fields
+
+    def expands(self, name: str) -> bool:
+        """Whether relation `name` is loaded: always for the default response."""
+        return self.include is None or name in self.include
+
+DEFAULT_FIELDSET = Fieldset(None, None, is_default=True)
+
+def _parse_names(value: Optional[str], allowed: Iterable[str], param: str) -> Optional[Set[str]]:
+    if value is None:
+        return None
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    unknown = names - set(allowed)
+    if unknown:
+        raise ValueError(f"Unknown {param}: {', '.join(sorted(unknown))}")
+    return names
+
+def parse_fieldset(fields: Optional[str], include: Optional[str], schema: type, relations: Iterable[str], default_fields: Optional[Iterable[str]] = None) -> Fieldset:
+    """Validate the query parameters against `schema` (scalar fields) and `relations`.
+
+    `default_fields` are the scalars returned when only `include` is given, for endpoints
+    whose default response uses a narrower schema than `schema`.
+    """
+    if fields is None and include is None:
+        return DEFAULT_FIELDSET
+    relations = list(relations)
+    top_level = {name.split(".")[0] for name in relations}
+    scalars = [name for name in schema.model_fields if name not in top_level]
+    # Once either parameter is given, only the relations named in `include` are embedded
+    included = _parse_names(include, relations, "include") or set()
+    # "items.product" needs items
+    included |= {name.rsplit(".", 1)[0] for name in included if "." in name}
+    requested = _parse_names(fields, scalars, "fields")
+    if requested is None and default_fields is not None:
+        requested = set(default_fields)
+    return Fieldset(requested, included)
+
+def _spec(schema: type, fieldset: Fieldset, relations: List[str], prefix: str = "") -> Dict[str, object]:
+    """Pydantic `include` spec of `schema` for the fields and relations requested."""
+    nested = {name[len(prefix):] for name in relations if name.startswith(prefix) and "." not in name[len(prefix):]}
+    spec = {}
+    for name, field in schema.model_fields.items():
+        if name in nested:
+            if fieldset.expands(prefix + name):
+                child = _nested_schema(field.annotation)
+                child_relations = [r for r in relations if r.startswith(f"{prefix}{name}.")]
+                if child is not None and child_relations:
+                    child_spec = _spec(child, fieldset, relations, f"{prefix}{name}.")
+                    spec[name] = {"__all__": child_spec} if _is_list(field.annotation) else child_spec
+                else:
+                    spec[name] = True
+        elif prefix or fieldset.returns(name) or name == "id":
+            spec[name] = True
+    return spec
+
+def _is_list(annotation) -> bool:
+    return getattr(annotation, "__origin__", None) in (list, List)
+
+def _nested_schema(annotation) -> Optional[type]:
+    for arg in getattr(annotation, "__args__", ()) or (annotation,):
+        if _is_list(arg):
+            return _nested_schema(arg)
+        if isinstance(arg, type) and issubclass(arg, BaseModel):
+            return arg
+    return None
+
+_MISSING = object()
+
+def _extract(schema: type, obj, fieldset: Fieldset, relations: List[str], prefix: str = "") -> dict:
+    """`obj`'s attributes for `schema`, skipping relations left out of `include`: those
+    were not loaded and must not be touched (they are raiseload-ed). Left out, they
+    validate as the schema's defaults and are then cut by the dump's include spec."""
+    nested = {name[len(prefix):] for name in relations if name.startswith(prefix) and "." not in name[len(prefix):]}
+    data = {}
+    for name, field in schema.model_fields.items():
+        if name in nested:
+            if not fieldset.expands(prefix + name):
+                continue
+            value = getattr(obj, name)
+            child = _nested_schema(field.annotation)
+            if child is not None and value is not None and any(r.startswith(f"{prefix}{name}.") for r in relations):
+                if _is_list(_list_annotation(field.annotation)):
+                    value = [_extract(child, v, fieldset, relations, f"{prefix}{name}.") for v in value]
+                else:
+                    value = _extract(child, value, fieldset, relations, f"{prefix}{name}.")
+            data[name] = value
+        else:
+            value = getattr(obj, name, _MISSING)
+            if value is not _MISSING:
+                data[name] = value
+    return data
+
+def _list_annotation(annotation):
+    """`annotation` itself, or the List[...] inside an Optional[List[...]]."""
+    for arg in getattr(annotation, "__args__", ()) or ():
+        if _is_list(arg):
+            return arg
+    return annotation
+
+def dump_sparse(schema: type, objects: list, fieldset: Fieldset, relations: Iterable[str]) -> list:
+    """JSON-ready dicts of `objects` validated as `schema`, cut down to the fieldset.
+
+    Only the relations named in `include` are read from the objects, so the others
+    can be left unloaded.
+    """
+    relations = list(relations)
+    adapter = TypeAdapter(List[schema])
+    data = [_extract(schema, obj, fieldset, relations) for obj in objects]
+    validated = adapter.validate_python(data, from_attributes=True)
+    return adapter.dump_python(validated, mode="json", include={"__all__": _spec(schema, fieldset, relations)})
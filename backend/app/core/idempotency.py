@@ -0,0 +1,175 @@
+"""Idempotency-Key support for write endpoints.
+
+A router built with `route_class=IdempotentRoute` answers a repeated POST carrying
+the same `Idempotency-Key` header with the stored response instead of running the
+endpoint again. Successful (2xx) responses are kept in the `idempotency_keys` table
+and in a per-process LRU in front of it; a duplicate that arrives while the first
+request is still running waits for it rather than racing it. Waiting only spans
+one process; across workers the table row written after the first success is what
+later retries see.
+
+Keys are honoured for KEY_TTL; older rows are ignored, overwritten by a new request
+with the same key, and deleted in passing by a save at most every PURGE_INTERVAL.
+Storing the response is best effort: the write has already committed, so a failure
+to save is logged and the real response still returned.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import delete, select
+from app.db.dialects import insert_for
+from app.db.models import IdempotencyKey
+from app.db.session import session_scope
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+REPLAY_HEADER = "Idempotent-Replayed"
+KEY_TTL = timedelta(hours=24)
+PURGE_INTERVAL = 3600.0
+
+class StoredResponse:
+    def __init__(self, request_hash: str, status_code: int, body: str, created_at: Optional[datetime] = None):
+        self.request_hash = request_hash
+        self.status_code = status_code
+        self.body = body
+        self.created_at = created_at or datetime.now()
+
+    def expired(self) -> bool:
+        return self.created_at < datetime.now() - KEY_TTL
+
+    def to_response(self) -> Response:
+        return Response(
+            content=self.body,
+            status_code=self.status_code,
+            media_type="application/json",
+            headers={REPLAY_HEADER: "true"},
+        )
+
+class ResponseLRU:
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[str, StoredResponse]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[StoredResponse]:
+        stored = self._items.get(key)
+        if stored is not None and stored.expired():
+            del self._items[key]
+            return None
+        if stored is not None:
+            self._items.move_to_end(key)
+        return stored
+
+    def put(self, key: str, stored: StoredResponse):
+        self._items[key] = stored
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+cache = ResponseLRU()
+_in_flight: Dict[str, asyncio.Future] = {}
+_last_purge = 0.0
+
+async def _request_hash(request: Request) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.url.path}?{request.url.query}\n".encode())
+    digest.update(await request.body())
+    return digest.hexdigest()
+
+def _open_db(request: Request):
+    return session_scope(request.app)
+
+async def _load(request: Request, key: str) -> Optional[StoredResponse]:
+    async with _open_db(request) as db:
+        row = (await db.execute(
+            select(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.created_at >= datetime.now() - KEY_TTL)
+        )).scalar_one_or_none()
+        if row is None:
+            return None
+        return StoredResponse(row.request_hash, row.status_code, row.response_body, row.created_at)
+
+async def purge_expired(db) -> int:
+    """Delete stored responses older than KEY_TTL; returns how many were removed."""
+    result = await db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < datetime.now() - KEY_TTL))
+    return result.rowcount
+
+async def _save(request: Request, key: str, stored: StoredResponse):
+    global _last_purge
+    async with _open_db(request) as db:
+        insert = insert_for(db)
+        stmt = insert(IdempotencyKey).values(
+            key=key, request_hash=stored.request_hash, status_code=stored.status_code,
+            response_body=stored.body, created_at=stored.created_at
+        )
+        # A row left by an expired use of the key is replaced; a live one is kept
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=["key"],
+            set_={
+                "request_hash": stmt.excluded.request_hash, "status_code": stmt.excluded.status_code,
+                "response_body": stmt.excluded.response_body, "created_at": stmt.excluded.created_at,
+            },
+            where=IdempotencyKey.created_at < datetime.now() - KEY_TTL,
+        ))
+        if time.monotonic() - _last_purge > PURGE_INTERVAL:
+            _last_purge = time.monotonic()
+            await purge_expired(db)
+        await db.commit()
+
+def _mismatch() -> Response:
+    return JSONResponse(status_code=422, content={"detail": f"{HEADER} was already used for a different request"})
+
+class IdempotentRoute(APIRoute):
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        if "POST" not in self.methods:
+            return handler
+
+        async def idempotent_handler(request: Request) -> Response:
+            key = request.headers.get(HEADER)
+            if not key:
+                return await handler(request)
+            request_hash = await _request_hash(request)
+
+            while True:
+                stored = cache.get(key)
+                if stored is not None:
+                    return stored.to_response() if stored.request_hash == request_hash else _mismatch()
+                running = _in_flight.get(key)
+                if running is None:
+                    break
+                # Same key already being handled in this process: wait for it, then re-check the cache
+                await asyncio.shield(running)
+
+            running = asyncio.get_running_loop().create_future()
+            _in_flight[key] = running
+            try:
+                stored = await _load(request, key)
+                if stored is not None:
+                    cache.put(key, stored)
+                    return stored.to_response() if stored.request_hash == request_hash else _mismatch()
+
+                response = await handler(request)
+                if 200 <= response.status_code < 300 and isinstance(getattr(response, "body", None), bytes):
+                    stored = StoredResponse(request_hash, response.status_code, response.body.decode())
+                    try:
+                        await _save(request, key, stored)
+                    except Exception:
+                        # The write is committed; a 500 here would make the client retry it
+                        logger.exception("Could not store the response for %s %s", HEADER, key)
+                    cache.put(key, stored)
+                return response
+            finally:
+                del _in_flight[key]
+                running.set_result(None)
+
+        return idempotent_handler
@@ -0,0 +1,55 @@
+"""Per-request database commit counting.
+
+Every SQLAlchemy session commit is attributed to the HTTP request that issued it,
+so write endpoints can be checked to commit exactly once per business operation.
+Enabled by settings.DB_COMMIT_METRICS.
+"""
+from contextvars import ContextVar
+from typing import Dict, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+class RequestDBStats:
+    def __init__(self):
+        self.commits = 0
+
+class RouteCommitStats:
+    def __init__(self):
+        self.requests = 0
+        self.commits = 0
+        self.max_commits = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "commits": self.commits,
+            "commits_per_request": self.commits / self.requests if self.requests else 0.0,
+            "max_commits": self.max_commits,
+        }
+
+# Route key of requests that matched no endpoint (404s), whatever their path
+UNMATCHED_ROUTE = "unmatched"
+
+_current_request: ContextVar[Optional[RequestDBStats]] = ContextVar("db_request_stats", default=None)
+_route_stats: Dict[str, RouteCommitStats] = {}
+
+@event.listens_for(Session, "after_commit")
+def _count_commit(session):
+    stats = _current_request.get()
+    if stats is not None:
+        stats.commits += 1
+
+def begin_request() -> RequestDBStats:
+    stats = RequestDBStats()
+    _current_request.set(stats)
+    return stats
+
+def record_request(route: str, stats: RequestDBStats):
+    """Fold one finished request into the per-route totals, keyed e.g. 'POST create_order'."""
+    route_stats = _route_stats.setdefault(route, RouteCommitStats())
+    route_stats.requests += 1
+    route_stats.commits += stats.commits
+    route_stats.max_commits = max(route_stats.max_commits, stats.commits)
+
+def commit_stats() -> Dict[str, dict]:
+    return {route: s.as_dict() for route, s in sorted(_route_stats.items())}
@@ -0,0 +1,25 @@
+"""Opaque keyset cursors.
+
+A cursor wraps the sort key of the last row a client has seen, e.g.
+(created_at, id) for the transaction list, so the next page can start with
+`WHERE (created_at, id) < (:created_at, :id)` instead of an OFFSET scan.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Tuple
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("Invalid cursor") from e
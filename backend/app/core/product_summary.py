@@ -0,0 +1,79 @@
+"""Per-process snapshot of the inventory summary (product counts and value by group).
+
+SQLAlchemy session events mark a session that writes products, whether through
+ORM instances (flush) or bulk insert/update/delete statements on Product; its
+commit bumps a generation counter and the snapshot taken under an older
+generation is recomputed on the next read. `max_age` bounds staleness from
+writes made by other worker processes.
+"""
+import time
+from typing import Any, Awaitable, Callable, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.db.models import Product
+
+_WRITES_KEY = "product_writes"
+
+class ProductSummarySnapshot:
+    def __init__(self, max_age: float = 60.0):
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._value: Optional[Any] = None
+        self._value_generation = -1
+        self._computed_at = 0.0
+
+    def invalidate(self):
+        self.generation += 1
+
+    async def get(self, load: Callable[[], Awaitable[Any]]) -> Any:
+        """The snapshot, recomputed with `load()` when a product write committed since
+        or it is older than max_age."""
+        now = time.monotonic()
+        if self._value_generation == self.generation and now - self._computed_at <= self.max_age:
+            self.hits += 1
+            return self._value
+        self.misses += 1
+        # Generation taken before querying, so a write committed meanwhile leaves it stale
+        generation = self.generation
+        value = await load()
+        self._value, self._value_generation, self._computed_at = value, generation, now
+        return value
+
+    def clear(self):
+        self._value = None
+        self._value_generation = -1
+
+    def counters(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "generation": self.generation,
+        }
+
+product_summary = ProductSummarySnapshot()
+
+@event.listens_for(Session, "after_flush")
+def _mark_flushed_products(session, flush_context):
+    if any(isinstance(obj, Product) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info[_WRITES_KEY] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_product_statements(orm_execute_state):
+    if orm_execute_state.is_select:
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ is Product:
+        orm_execute_state.session.info[_WRITES_KEY] = True
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session):
+    if session.info.pop(_WRITES_KEY, False):
+        product_summary.invalidate()
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back(session):
+    session.info.pop(_WRITES_KEY, None)
@@ -0,0 +1,145 @@
+"""Per-process result cache for the stats endpoints.
+
+Entries are keyed by (endpoint, start_date, end_date). Every TransactionService
+commit bumps a version counter for each day it touched; an entry computed before
+a later bump of any day inside its range is stale, as is any entry older than
+`max_age` (which bounds staleness from writes made by other worker processes).
+
+A stale entry is still served for up to `max_stale` seconds while one background
+task recomputes it; past that window the caller recomputes inline. Misses always
+compute inline, and concurrent misses for the same key share one computation.
+"""
+import asyncio
+import logging
+import time
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[str, Optional[date], Optional[date]]
+Loader = Callable[[], Awaitable[Any]]
+
+class CacheEntry:
+    def __init__(self, value: Any, version: int, computed_at: float):
+        self.value = value
+        self.version = version
+        self.computed_at = computed_at
+
+class StatsCache:
+    def __init__(self, max_age: float = 300.0, max_stale: float = 30.0, maxsize: int = 256):
+        self.max_age = max_age
+        self.max_stale = max_stale
+        self.maxsize = maxsize
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self._version = 0
+        self._day_versions: Dict[date, Tuple[int, float]] = {}
+        self._entries: Dict[Key, CacheEntry] = {}
+        self._loading: Dict[Key, asyncio.Future] = {}
+        self._refreshing: Dict[Key, asyncio.Task] = {}
+
+    def invalidate(self, days: Iterable[date]):
+        """Record committed writes on `days`; entries whose range covers one go stale."""
+        now = time.monotonic()
+        for day in days:
+            self._version += 1
+            self._day_versions[day] = (self._version, now)
+        # Entries older than a bump of max_age are stale by age anyway
+        for day in [d for d, (_, at) in self._day_versions.items() if now - at > self.max_age]:
+            del self._day_versions[day]
+
+    def _stale_since(self, key: Key, entry: CacheEntry, now: float) -> Optional[float]:
+        """When the entry went stale (monotonic time), or None while it is fresh."""
+        _, start_date, end_date = key
+        since = None
+        if now - entry.computed_at > self.max_age:
+            since = entry.computed_at + self.max_age
+        for day, (version, at) in self._day_versions.items():
+            if version > entry.version and (start_date is None or day >= start_date) and (end_date is None or day <= end_date):
+                since = at if since is None else min(since, at)
+        return since
+
+    async def get(self, endpoint: str, start_date: Optional[date], end_date: Optional[date], load: Loader, refresh: Optional[Loader] = None) -> Any:
+        """Cached result of `load()` for the range.
+
+        `refresh` recomputes the value outside the caller's request (its own session);
+        without it stale entries are recomputed inline.
+        """
+        key = (endpoint, start_date, end_date)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            stale_since = self._stale_since(key, entry, now)
+            if stale_since is None:
+                self.hits += 1
+                return entry.value
+            if refresh is not None and now - stale_since <= self.max_stale:
+                self.stale_hits += 1
+                if key not in self._refreshing:
+                    self._refreshing[key] = asyncio.create_task(self._refresh(key, refresh))
+                return entry.value
+
+        self.misses += 1
+        loading = self._loading.get(key)
+        if loading is not None:
+            return await asyncio.shield(loading)
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[key] = loading
+        try:
+            value = await self._compute(key, load)
+        except Exception as e:
+            loading.set_exception(e)
+            loading.exception()  # retrieved: waiters re-raise it, no "never retrieved" warning
+            raise
+        else:
+            loading.set_result(value)
+            return value
+        finally:
+            del self._loading[key]
+
+    async def _compute(self, key: Key, load: Loader) -> Any:
+        # Version taken before querying, so a write committed meanwhile leaves the entry stale
+        version, computed_at = self._version, time.monotonic()
+        value = await load()
+        self._entries[key] = CacheEntry(value, version, computed_at)
+        while len(self._entries) > self.maxsize:
+            del self._entries[next(iter(self._entries))]
+        return value
+
+    async def _refresh(self, key: Key, refresh: Loader):
+        try:
+            await self._compute(key, refresh)
+            self.refreshes += 1
+        except Exception:
+            # The stale entry stays; the next request past max_stale recomputes inline
+            self.refresh_failures += 1
+            logger.exception("Background refresh of stats %s failed", key)
+        finally:
+            del self._refreshing[key]
+
+    async def drain(self):
+        """Wait for the background refreshes in progress."""
+        while self._refreshing:
+            await asyncio.gather(*self._refreshing.values(), return_exceptions=True)
+
+    def clear(self):
+        self._entries.clear()
+        self._day_versions.clear()
+
+    def counters(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+stats_cache = StatsCache()
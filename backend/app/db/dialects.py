@@ -0,0 +1,14 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects import postgresql, sqlite
+
+def dialect_name(db: AsyncSession) -> str:
+    return db.get_bind().dialect.name
+
+def insert_for(db: AsyncSession):
+    """Return the dialect-specific `insert` construct (supports ON CONFLICT) for this session.
+
+    Production runs on Postgres; SQLite is used by the test suite.
+    """
+    if dialect_name(db) == "sqlite":
+        return sqlite.insert
+    return postgresql.insert
@@ -1,6 +1,6 @@
 from enum import Enum
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Date, Boolean
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Date, Boolean, Text, Index, text
 from sqlalchemy.orm import relationship
 from app.db.base import Base
 
@@ -18,6 +18,10 @@ class ProductStatus(str, Enum):
     SOLD_BACK_MFR = "Đã bán lại NSX"  # Product sold back to manufacturer
     RECEIVED_FROM_MFR = "Đã nhận hàng NSX"  # Product received from manufacturer
 
+# Queue predicates of the partial product indexes (and of the repository queries they serve)
+PENDING_MANUFACTURER_PREDICATE = f"is_ordered = false AND status = '{ProductStatus.SOLD.value}'"
+RECEIVED_FROM_MFR_PREDICATE = f"status = '{ProductStatus.RECEIVED_FROM_MFR.value}'"
+
 class TransactionType(str, Enum):
     SALE = "Đơn cọc"            # Money In (Staff -> Customer)
     BUYBACK = "Mua lại"         # Money Out (Customer -> Staff)
@@ -61,6 +65,19 @@ class Customer(Base):
 
 class Product(Base):
     __tablename__ = "products"
+    __table_args__ = (
+        # Stock lookups: AVAILABLE products of a type in a store
+        Index("ix_products_store_id_product_type_status", "store_id", "product_type", "status"),
+        # Work queues, indexed on their predicates only: they stay small while products grow
+        Index(
+            "ix_products_pending_manufacturer", "id",
+            postgresql_where=text(PENDING_MANUFACTURER_PREDICATE), sqlite_where=text(PENDING_MANUFACTURER_PREDICATE),
+        ),
+        Index(
+            "ix_products_received_from_mfr", "store_id", "product_type", "id",
+            postgresql_where=text(RECEIVED_FROM_MFR_PREDICATE), sqlite_where=text(RECEIVED_FROM_MFR_PREDICATE),
+        ),
+    )
     id = Column(Integer, primary_key=True)
     product_type = Column(String) # e.g., ProductType.LUONG_5
     product_code = Column(String, unique=True, nullable=True) # generated code like 1L-15-02-2026-00001
@@ -83,6 +100,17 @@ class Product(Base):
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        # Keyset pagination of the transaction list: ORDER BY created_at DESC, id DESC
+        Index("ix_transactions_created_at_id", "created_at", "id"),
+        # Stats and type-filtered lists: type = ? AND created_at in a range
+        Index("ix_transactions_type_created_at", "type", "created_at"),
+        # Linked flows: buybacks/fulfillments/receipts pointing at an order
+        Index("ix_transactions_linked_transaction_id_type", "linked_transaction_id", "type"),
+        Index("ix_transactions_customer_id_created_at", "customer_id", "created_at"),
+        # Open/closed order lists: type = SALE AND order_status IS NULL
+        Index("ix_transactions_type_order_status", "type", "order_status"),
+    )
     id = Column(Integer, primary_key=True)
     type = Column(String) # TransactionType
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True)
@@ -107,6 +135,10 @@ class Transaction(Base):
     transaction_code = Column(String, nullable=True, unique=True) # Auto-generated system code
     due_date = Column(Date, nullable=True)  # Ngày hẹn trả
     delivered_to_kc = Column(Boolean, default=False)
+    # Outcome of a sale, written by the buyback/fulfillment that closes it:
+    # 'Mua lại' (bought back) or 'Đã giao' (fulfilled); NULL while still open
+    order_status = Column(String, nullable=True)
+    fulfillment_date = Column(DateTime, nullable=True)
     
     product_items = relationship(
         "Product",
@@ -120,6 +152,11 @@ class Transaction(Base):
 class TransactionItem(Base):
     """Junction table recording the price of each item at the time of order."""
     __tablename__ = "transaction_items"
+    __table_args__ = (
+        Index("ix_transaction_items_transaction_id", "transaction_id"),
+        # Per-product history lookups (latest sale/receipt of a product)
+        Index("ix_transaction_items_product_id_transaction_id", "product_id", "transaction_id"),
+    )
     id = Column(Integer, primary_key=True)
     transaction_id = Column(Integer, ForeignKey("transactions.id"))
     product_id = Column(Integer, ForeignKey("products.id"))
@@ -133,3 +170,56 @@ class TransactionItem(Base):
     transaction = relationship("Transaction", back_populates="items")
     product = relationship("Product", foreign_keys=[product_id])
     original_product = relationship("Product", foreign_keys=[original_product_id])
+
+class CodeSequence(Base):
+    """Per-(prefix, day) counter for generated codes, e.g. prefix '1L-15-02-2026-' or 'HĐ-15-02-2026-'."""
+    __tablename__ = "code_sequences"
+    prefix = Column(String, primary_key=True)
+    last_value = Column(Integer, nullable=False, default=0)
+
+class IdempotencyKey(Base):
+    """Stored 2xx response for a client-supplied Idempotency-Key header."""
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    request_hash = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=False)
+    response_body = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+class ProductState(Base):
+    """Current state of a product, projected from its transaction history.
+
+    Written by TransactionService in the same commit as the transaction that changes it,
+    so per-product lookups are primary-key reads instead of window queries over
+    transaction_items. rebuild_product_states.py regenerates it from history.
+    """
+    __tablename__ = "product_states"
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    # Latest SALE the product is on, and that sale's customer (current holder)
+    sale_transaction_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True)
+    sale_date = Column(DateTime, nullable=True)
+    # Latest MANUFACTURER_RECEIVED of the product, and the manufacturer order it was received against
+    received_date = Column(DateTime, nullable=True)
+    manufacturer_order_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
+
+class DailyRollup(Base):
+    """Per-day transaction totals behind the stats endpoints.
+
+    One row per (day, store, staff, type, payment method); missing store/staff ids are
+    stored as 0 and a missing payment method as '' so they can be part of the key.
+    TransactionService adds each write's change to the rows of its keys, in the same
+    commit; rebuild_daily_rollup.py and the startup backfill regenerate the whole table.
+    """
+    __tablename__ = "daily_rollup"
+    day = Column(Date, primary_key=True)
+    store_id = Column(Integer, primary_key=True)
+    staff_id = Column(Integer, primary_key=True)
+    tx_type = Column(String, primary_key=True)
+    payment_method = Column(String, primary_key=True)
+    tx_count = Column(Integer, nullable=False, default=0)
+    tx_with_items_count = Column(Integer, nullable=False, default=0)
+    item_total = Column(Float, nullable=False, default=0.0)
+    # Cash/bank split of item totals: mixed payments use their recorded amounts
+    cash_amount = Column(Float, nullable=False, default=0.0)
+    bank_transfer_amount = Column(Float, nullable=False, default=0.0)
@@ -0,0 +1,51 @@
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.models import CodeSequence
+from app.db.dialects import insert_for
+
+async def allocate_block(db: AsyncSession, prefix: str, count: int, code_column) -> int:
+    """Reserve `count` consecutive sequence numbers for `prefix` and return the first one.
+
+    The counter row lives in `code_sequences` and is bumped inside the caller's
+    transaction, on the caller's connection: a rollback hands the numbers back (no
+    gaps), and concurrent writers queue on the row lock instead of colliding on the
+    unique code constraint. The lock is held until the caller commits, so writes take
+    it as late as they can and in one order: transaction and product rows first, then
+    the day's HĐ- counter, then that day's product counters. Multi-day writes take
+    their HĐ- counters in day order.
+
+    `code_column` (e.g. Product.product_code) is only scanned the first time a
+    prefix is seen, to continue numbering from codes issued before the counter existed.
+    """
+    result = await db.execute(
+        update(CodeSequence)
+        .where(CodeSequence.prefix == prefix)
+        .values(last_value=CodeSequence.last_value + count)
+        .returning(CodeSequence.last_value)
+    )
+    last_value = result.scalar_one_or_none()
+    if last_value is not None:
+        return last_value - count + 1
+
+    # First allocation for this prefix: seed from any existing codes
+    stmt = select(code_column).where(
+        code_column.like(f"{prefix}%")
+    ).order_by(code_column.desc()).limit(1)
+    last_code = (await db.execute(stmt)).scalar_one_or_none()
+
+    seed = 0
+    if last_code:
+        try:
+            seed = int(last_code.split('-')[-1])
+        except ValueError:
+            pass
+
+    insert = insert_for(db)
+    stmt = insert(CodeSequence).values(prefix=prefix, last_value=seed + count)
+    # Another writer may have created the row since our UPDATE; fall back to bumping it
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CodeSequence.prefix],
+        set_={"last_value": CodeSequence.last_value + count}
+    ).returning(CodeSequence.last_value)
+    last_value = (await db.execute(stmt)).scalar_one()
+    return last_value - count + 1
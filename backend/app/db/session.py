@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
@@ -14,3 +16,9 @@ async_session_maker = async_sessionmaker(engine, expire_on_commit=False, class_=
 async def get_db():
     async with async_session_maker() as session:
         yield session
+
+def session_scope(app: FastAPI):
+    """A session from the provider the app's endpoints use (honours dependency overrides),
+    for work that runs outside a request's own dependency scope."""
+    provider = app.dependency_overrides.get(get_db, get_db)
+    return asynccontextmanager(provider)()
@@ -1,12 +1,21 @@
-from fastapi import FastAPI
-from app.core import config
+import asyncio
+import logging
+from fastapi import FastAPI, HTTPException, Request
+from app.core import config, metrics
+from app.core.availability import availability_index
+from app.core.stats_cache import stats_cache
+from app.core.product_summary import product_summary
 from app.db import session, models
 from app.db.base import Base
 from app.modules.customers import router as customers
 from app.modules.stores import router as stores
 from app.modules.staff import router as staff
 from app.modules.products import router as products
+from app.modules.products.repository import ProductRepository
 from app.modules.transactions import router as transactions
+from app.modules.transactions.repository import TransactionRepository
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Silver Distribution System", version="1.0.0")
 
@@ -16,11 +25,66 @@ app.include_router(staff.router, prefix="/api/v1/staff", tags=["staff"])
 app.include_router(products.router, prefix="/api/v1/products", tags=["products"])
 app.include_router(transactions.router, prefix="/api/v1/transactions", tags=["transactions"])
 
+@app.middleware("http")
+async def count_db_commits(request: Request, call_next):
+    if not config.settings.DB_COMMIT_METRICS:
+        return await call_next(request)
+    stats = metrics.begin_request()
+    response = await call_next(request)
+    endpoint = request.scope.get("endpoint")
+    # Requests matching no route share one key, so path scans cannot grow the table
+    name = endpoint.__name__ if endpoint else metrics.UNMATCHED_ROUTE
+    metrics.record_request(f"{request.method} {name}", stats)
+    response.headers["X-DB-Commits"] = str(stats.commits)
+    return response
+
+# Seconds between checks of the availability index against the database
+AVAILABILITY_VERIFY_INTERVAL = 300.0
+
 @app.on_event("startup")
 async def startup_event():
     async with session.engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    async with session.async_session_maker() as db:
+        if await ProductRepository(db).ensure_states():
+            logger.warning("product_states was empty; rebuilt it from transaction history")
+        await db.commit()
+        if await TransactionRepository(db).ensure_daily_rollup():
+            logger.warning("daily_rollup was empty; rebuilt it from transaction history")
+        await db.commit()
+        await availability_index.load(db)
+    app.state.availability_verifier = asyncio.create_task(
+        availability_index.run_verifier(session.async_session_maker, AVAILABILITY_VERIFY_INTERVAL)
+    )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    verifier = getattr(app.state, "availability_verifier", None)
+    if verifier is not None:
+        verifier.cancel()
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to Silver Distribution System API"}
+
+@app.get("/metrics/db-commits")
+async def db_commit_metrics():
+    """Commits issued per route since startup (write routes should stay at 1 per request)"""
+    if not config.settings.DB_COMMIT_METRICS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return metrics.commit_stats()
+
+@app.get("/metrics/stats-cache")
+async def stats_cache_metrics():
+    """Hit/miss counters of the stats endpoints' result cache since startup"""
+    return stats_cache.counters()
+
+@app.get("/metrics/product-summary")
+async def product_summary_metrics():
+    """Hit/miss counters of the inventory summary snapshot since startup"""
+    return product_summary.counters()
+
+@app.get("/metrics/availability-index")
+async def availability_index_metrics():
+    """Size and verification counters of the in-memory availability index"""
+    return availability_index.counters()
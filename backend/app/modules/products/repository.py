@@ -1,7 +1,10 @@
+from typing import Dict, List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
-from app.db.models import Product, ProductStatus, Transaction
+from sqlalchemy import select, update, delete, insert, func, or_, and_, literal, literal_column, union_all, String, text
+from sqlalchemy.orm import selectinload, raiseload, aliased
+from app.core.availability import availability_index
+from app.db.dialects import dialect_name, insert_for
+from app.db.models import Customer, Product, Store, ProductStatus, ProductState, Transaction, TransactionItem, TransactionType
 from . import schemas as product_schema
 
 class ProductRepository:
@@ -18,14 +21,118 @@ class ProductRepository:
         result = await self.db.execute(query)
         return result.scalar_one_or_none()
 
-    async def get_multi(self, skip: int = 0, limit: int = 100):
-        # Also eager load here if we want to show it in list
+    async def get_statuses(self, ids: List[int]) -> Dict[int, str]:
+        """id -> status for the products that exist, in one query."""
+        if not ids:
+            return {}
+        result = await self.db.execute(select(Product.id, Product.status).where(Product.id.in_(ids)))
+        return {row.id: row.status for row in result.all()}
+
+    async def get_status_history(self, ids: List[int]) -> Dict[int, Dict[str, tuple]]:
+        """Per product, its latest SALE and BUYBACK and the latest SWAP of a sale it was swapped out of.
+
+        One UNION ALL of two window queries; returns {product_id: {"sale"|"buyback"|"swap":
+        (transaction_code or code, created_at, customer name)}}.
+        """
+        if not ids:
+            return {}
+        code = func.coalesce(Transaction.transaction_code, Transaction.code)
+        own = (
+            select(
+                TransactionItem.product_id.label("product_id"),
+                Transaction.type.label("kind"),
+                code.label("code"),
+                Transaction.created_at.label("created_at"),
+                Customer.name.label("customer_name"),
+                func.row_number().over(
+                    partition_by=(TransactionItem.product_id, Transaction.type),
+                    order_by=(Transaction.created_at.desc(), Transaction.id.desc())
+                ).label("rn"),
+            )
+            .join(Transaction, Transaction.id == TransactionItem.transaction_id)
+            .outerjoin(Customer, Customer.id == Transaction.customer_id)
+            .where(
+                TransactionItem.product_id.in_(ids),
+                Transaction.type.in_([TransactionType.SALE, TransactionType.BUYBACK]),
+            )
+        )
+        # Swapped-out products stay as original_product_id on the SALE item; the SWAP links to that sale
+        swapped = (
+            select(
+                TransactionItem.original_product_id.label("product_id"),
+                Transaction.type.label("kind"),
+                code.label("code"),
+                Transaction.created_at.label("created_at"),
+                literal(None, String).label("customer_name"),
+                func.row_number().over(
+                    partition_by=TransactionItem.original_product_id,
+                    order_by=(Transaction.created_at.desc(), Transaction.id.desc())
+                ).label("rn"),
+            )
+            .join(Transaction, Transaction.linked_transaction_id == TransactionItem.transaction_id)
+            .where(
+                TransactionItem.original_product_id.in_(ids),
+                Transaction.type == TransactionType.SWAP,
+            )
+        )
+        ranked = union_all(own, swapped).subquery()
+        result = await self.db.execute(
+            select(ranked.c.product_id, ranked.c.kind, ranked.c.code, ranked.c.created_at, ranked.c.customer_name)
+            .where(ranked.c.rn == 1)
+        )
+        kinds = {TransactionType.SALE: "sale", TransactionType.BUYBACK: "buyback", TransactionType.SWAP: "swap"}
+        history = {}
+        for row in result.all():
+            history.setdefault(row.product_id, {})[kinds[row.kind]] = (row.code, row.created_at, row.customer_name)
+        return history
+
+    async def get_multi(self, skip: int = 0, limit: int = 100, with_sale: bool = False, with_store: bool = False):
+        """A page of products, as (product, latest sale) pairs when `with_sale` (see _latest_sale),
+        otherwise products alone. `with_store` loads Product.store; nothing else is loaded."""
         query = select(Product).options(
-            selectinload(Product.transactions).selectinload(Transaction.customer),
-            selectinload(Product.transactions).selectinload(Transaction.store)
-        ).offset(skip).limit(limit)
+            selectinload(Product.store) if with_store else raiseload(Product.store),
+            raiseload(Product.transactions),
+        )
+        if with_sale:
+            query = self._latest_sale(query)
+        result = await self.db.execute(query.offset(skip).limit(limit))
+        return result.all() if with_sale else result.scalars().all()
+
+    @staticmethod
+    def _latest_sale(query):
+        """Add the product's latest SALE (from product_states) as customer_name, order_date and
+        store_name columns: one row per product, no transaction history loaded."""
+        sale_store = aliased(Store)
+        return (
+            query.add_columns(
+                Customer.name.label("customer_name"),
+                Transaction.created_at.label("order_date"),
+                sale_store.name.label("store_name"),
+            )
+            .outerjoin(ProductState, ProductState.product_id == Product.id)
+            .outerjoin(Transaction, Transaction.id == ProductState.sale_transaction_id)
+            .outerjoin(Customer, Customer.id == Transaction.customer_id)
+            .outerjoin(sale_store, sale_store.id == Transaction.store_id)
+        )
+
+    async def get_summary(self) -> List[dict]:
+        """Product count and summed last_price per store, type, status, is_ordered and
+        is_delivered, in one GROUP BY."""
+        query = (
+            select(
+                Product.store_id, Store.name.label("store_name"), Product.product_type, Product.status,
+                func.coalesce(Product.is_ordered, False).label("is_ordered"),
+                func.coalesce(Product.is_delivered, False).label("is_delivered"),
+                func.count().label("count"),
+                func.coalesce(func.sum(Product.last_price), 0).label("total_value"),
+            )
+            .outerjoin(Store, Store.id == Product.store_id)
+            .group_by(Product.store_id, Store.name, Product.product_type, Product.status,
+                      func.coalesce(Product.is_ordered, False), func.coalesce(Product.is_delivered, False))
+            .order_by(Product.store_id, Product.product_type, Product.status)
+        )
         result = await self.db.execute(query)
-        return result.scalars().all()
+        return [dict(row._mapping) for row in result.all()]
 
     async def get_available(self, skip: int = 0, limit: int = 100):
         """Get available products with store info"""
@@ -36,28 +143,122 @@ class ProductRepository:
         return result.scalars().all()
 
     async def get_available_by_store(self, store_id: int):
-        """Get available products for a specific store"""
-        query = select(Product).options(
-            selectinload(Product.store),
-            selectinload(Product.transactions)
-        ).where(
-            Product.status == ProductStatus.AVAILABLE,
-            Product.store_id == store_id
-        ).order_by(Product.id)
+        """Available products of a store, each with its latest transaction and its latest
+        transaction carrying a manufacturer code: rows of (product, latest_code, latest_date,
+        coded_code, coded_date). The picks are ROW_NUMBER windows over the store's stock only."""
+        stock = select(Product.id).where(Product.status == ProductStatus.AVAILABLE, Product.store_id == store_id)
+        ranked = (
+            select(
+                TransactionItem.product_id, Transaction.code, Transaction.created_at,
+                func.row_number().over(
+                    partition_by=TransactionItem.product_id,
+                    order_by=(Transaction.created_at.desc(), Transaction.id.desc())
+                ).label("rn"),
+                func.row_number().over(
+                    partition_by=TransactionItem.product_id,
+                    order_by=(Transaction.code.is_(None), Transaction.created_at.desc(), Transaction.id.desc())
+                ).label("coded_rn"),
+            )
+            .join(Transaction, Transaction.id == TransactionItem.transaction_id)
+            .where(TransactionItem.product_id.in_(stock))
+            .subquery()
+        )
+        latest, coded = ranked.alias(), ranked.alias()
+        query = (
+            select(Product, latest.c.code, latest.c.created_at, coded.c.code, coded.c.created_at)
+            .options(selectinload(Product.store), raiseload(Product.transactions))
+            .outerjoin(latest, and_(latest.c.product_id == Product.id, latest.c.rn == 1))
+            .outerjoin(coded, and_(coded.c.product_id == Product.id, coded.c.coded_rn == 1, coded.c.code.isnot(None)))
+            .where(Product.status == ProductStatus.AVAILABLE, Product.store_id == store_id)
+            .order_by(Product.id)
+        )
+        result = await self.db.execute(query)
+        return result.all()
+
+    async def get_many_for_update(self, ids: List[int]) -> List[Product]:
+        """Load products by id in one query and lock the rows until commit.
+
+        Only product columns are loaded - no transaction history.
+        """
+        if not ids:
+            return []
+        query = select(Product).where(
+            Product.id.in_(ids)
+        ).order_by(Product.id).with_for_update().execution_options(populate_existing=True)
         result = await self.db.execute(query)
         return result.scalars().all()
 
+    async def update_many(self, ids: List[int], **values):
+        """Apply the same values to many products with a single UPDATE ... WHERE id IN (...)."""
+        if ids:
+            await self.db.execute(update(Product).where(Product.id.in_(ids)).values(**values))
+            self._stage_availability({"id": id, **values} for id in ids)
+
+    async def set_delivered(self, ids: List[int], is_delivered: bool) -> List[int]:
+        """Set is_delivered on many products with one UPDATE ... RETURNING; returns the ids that exist."""
+        if not ids:
+            return []
+        result = await self.db.execute(
+            update(Product).where(Product.id.in_(ids)).values(is_delivered=is_delivered).returning(Product.id)
+        )
+        return list(result.scalars().all())
+
+    async def commit(self):
+        await self.db.commit()
+
+    async def update_each(self, rows: List[dict]):
+        """Apply per-product values (each row carries its `id`) as one executemany UPDATE by primary key."""
+        if rows:
+            await self.db.execute(update(Product), rows)
+            self._stage_availability(rows)
+
+    def _stage_availability(self, rows):
+        """Tell the availability index about bulk UPDATEs that move products in or out of stock."""
+        changes = {
+            row["id"]: (row.get("status"), row.get("store_id"), row.get("product_type"))
+            for row in rows if row.keys() & {"status", "store_id", "product_type"}
+        }
+        if changes:
+            availability_index.stage(self.db, changes)
+
     async def find_available_by_type(self, store_id: int, product_type: str):
+        products = await self.claim_available(store_id=store_id, product_type=product_type, count=1)
+        return products[0] if products else None
+
+    async def claim_available(self, store_id: int, product_type: str, count: int) -> List[Product]:
+        """Lock up to `count` AVAILABLE products of a type in a store, in one query.
+
+        Rows already locked by a concurrent sale are skipped (FOR UPDATE SKIP LOCKED), so
+        simultaneous orders take disjoint products instead of queueing on the same rows.
+        The locks hold until the caller's transaction commits; a short result means
+        the store does not have `count` unclaimed units.
+        """
+        stock = (
+            Product.store_id == store_id,
+            Product.product_type == product_type,
+            Product.status == ProductStatus.AVAILABLE
+        )
+        # The availability index names candidates, so the lock is a primary-key lookup;
+        # rows that are gone or locked meanwhile send the claim to the plain query
+        hinted = availability_index.pick(store_id, product_type, count) if availability_index.loaded else []
+        if len(hinted) == count:
+            result = await self.db.execute(
+                select(Product).where(Product.id.in_(hinted), *stock)
+                .order_by(Product.id)
+                .with_for_update(skip_locked=True)
+                .execution_options(populate_existing=True)
+            )
+            products = list(result.scalars().all())
+            if len(products) == count:
+                return products
         result = await self.db.execute(
-            select(Product).where(
-                Product.store_id == store_id,
-                Product.product_type == product_type,
-                Product.status == ProductStatus.AVAILABLE
-            ).limit(1)
+            select(Product).where(*stock).order_by(Product.id).limit(count)
+            .with_for_update(skip_locked=True)
+            .execution_options(populate_existing=True)
         )
-        return result.scalar_one_or_none()
+        return list(result.scalars().all())
 
-    async def create(self, obj_in: product_schema.ProductCreate):
+    async def create(self, obj_in: product_schema.ProductCreate, commit: bool = True):
         db_obj = Product(
             product_type=obj_in.product_type,
             product_code=obj_in.product_code,
@@ -67,14 +268,43 @@ class ProductRepository:
             is_ordered=obj_in.is_ordered
         )
         self.db.add(db_obj)
+        if not commit:
+            # Unit-of-work mode: the calling service commits once for the whole operation
+            await self.db.flush()
+            return db_obj
         await self.db.commit()
         await self.db.refresh(db_obj)
         return db_obj
 
-    async def update(self, *, db_obj: Product, obj_in: product_schema.ProductUpdate):
+    async def create_many(self, objs_in: List[product_schema.ProductCreate]) -> List[Product]:
+        """Stage many products and flush them as one multi-row INSERT ... RETURNING.
+
+        Does not commit: the caller owns the surrounding transaction.
+        """
+        db_objs = [
+            Product(
+                product_type=obj_in.product_type,
+                product_code=obj_in.product_code,
+                status=obj_in.status,
+                last_price=obj_in.last_price,
+                store_id=obj_in.store_id,
+                is_ordered=obj_in.is_ordered
+            )
+            for obj_in in objs_in
+        ]
+        self.db.add_all(db_objs)
+        await self.db.flush()
+        return db_objs
+
+    async def update(self, *, db_obj: Product, obj_in: product_schema.ProductUpdate, commit: bool = True):
         for field, value in obj_in.model_dump(exclude_unset=True).items():
             setattr(db_obj, field, value)
         self.db.add(db_obj)
+        if not commit:
+            # Unit-of-work mode: flush so later queries in the operation see the change,
+            # and leave the commit to the calling service
+            await self.db.flush()
+            return db_obj
         await self.db.commit()
         await self.db.refresh(db_obj)
         return db_obj
@@ -88,78 +318,159 @@ class ProductRepository:
     async def get_received_unassigned(self):
         """Get products with status RECEIVED_FROM_MFR that are not assigned to any customer.
         A product is 'assigned' if it appears in a SALE transaction that has NOT been bought back.
+        Rows of (product, received_date from product_states).
         """
-        from app.db.models import TransactionItem, TransactionType
-
-        # Sale transaction IDs that were bought back
-        bought_back_ids = select(Transaction.linked_transaction_id).where(
-            Transaction.type == TransactionType.BUYBACK,
-            Transaction.linked_transaction_id.isnot(None)
-        )
-
-        # Product IDs in active (not bought back) sale transactions
-        sold_product_ids = select(TransactionItem.product_id).join(
-            Transaction, TransactionItem.transaction_id == Transaction.id
-        ).where(
-            Transaction.type == TransactionType.SALE,
-            Transaction.id.notin_(bought_back_ids)
+        # NOT EXISTS anti-joins: index probes per queued product instead of materialising
+        # every sold product id, and no NOT IN surprises from NULL product ids
+        bought_back = aliased(Transaction)
+        assigned = (
+            select(TransactionItem.id)
+            .join(Transaction, TransactionItem.transaction_id == Transaction.id)
+            .where(
+                TransactionItem.product_id == Product.id,
+                Transaction.type == TransactionType.SALE,
+                ~select(bought_back.id).where(
+                    bought_back.linked_transaction_id == Transaction.id,
+                    bought_back.type == TransactionType.BUYBACK,
+                ).exists(),
+            )
         )
 
-        query = select(Product).options(
+        query = select(Product, ProductState.received_date).options(
             selectinload(Product.store),
-            selectinload(Product.transactions)
-        ).where(
+            raiseload(Product.transactions)
+        ).outerjoin(ProductState, ProductState.product_id == Product.id).where(
             Product.status == ProductStatus.RECEIVED_FROM_MFR,
-            Product.id.notin_(sold_product_ids)
+            ~assigned.exists()
         ).order_by(Product.store_id, Product.product_type, Product.id)
 
         result = await self.db.execute(query)
-        return result.scalars().all()
+        return result.all()
 
     async def get_manufacturer_codes_for_products(self, product_ids: list) -> dict:
-        """Returns {product_id: manufacturer_code} by traversing:
-        product -> Nhận hàng NSX tx -> linked Đặt hàng NSX tx -> code
+        """Returns {product_id: manufacturer_code}: the code of the Đặt hàng NSX order the
+        product was last received against (product_states.manufacturer_order_id).
+        """
+        query = (
+            select(ProductState.product_id, Transaction.code)
+            .join(Transaction, Transaction.id == ProductState.manufacturer_order_id)
+            .where(ProductState.product_id.in_(product_ids))
+        )
+        result = await self.db.execute(query)
+        return {row.product_id: row.code for row in result.all() if row.code}
+
+    # --- product_states projection ---
+
+    async def record_sales(self, rows: List[dict]):
+        """Upsert the sale part of product_states.
+
+        rows: product_id, sale_transaction_id, customer_id, sale_date. A row only
+        replaces the stored sale if it is not older (back-dated orders keep the newer one).
         """
-        from app.db.models import TransactionItem, TransactionType
+        await self._upsert_states(rows, ["sale_transaction_id", "customer_id", "sale_date"], ProductState.sale_date, "sale_date")
 
-        received_subq = (
-            select(
-                TransactionItem.product_id,
-                Transaction.linked_transaction_id
+    async def record_receipts(self, rows: List[dict]):
+        """Upsert the receipt part of product_states. rows: product_id, received_date, manufacturer_order_id."""
+        await self._upsert_states(rows, ["received_date", "manufacturer_order_id"], ProductState.received_date, "received_date")
+
+    async def _upsert_states(self, rows: List[dict], columns: List[str], date_column, date_key: str, chunk_size: int = 1000):
+        # One row per product: Postgres rejects an upsert that hits the same key twice
+        rows = list({row["product_id"]: row for row in rows}.values())
+        insert_stmt = insert_for(self.db)
+        for start in range(0, len(rows), chunk_size):
+            stmt = insert_stmt(ProductState).values(rows[start:start + chunk_size])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[ProductState.product_id],
+                set_={column: stmt.excluded[column] for column in columns},
+                where=or_(date_column.is_(None), date_column <= stmt.excluded[date_key])
             )
-            .join(Transaction, TransactionItem.transaction_id == Transaction.id)
-            .where(
-                TransactionItem.product_id.in_(product_ids),
-                Transaction.type == TransactionType.MANUFACTURER_RECEIVED
+            await self.db.execute(stmt)
+
+    async def rebuild_states(self, product_ids: Optional[List[int]] = None):
+        """Regenerate product_states from transaction history, for some products or all of them."""
+        await self.db.flush()
+        if product_ids is not None and not product_ids:
+            return
+
+        def latest(tx_type, *columns):
+            query = (
+                select(
+                    TransactionItem.product_id, *columns,
+                    func.row_number().over(
+                        partition_by=TransactionItem.product_id,
+                        order_by=(Transaction.created_at.desc(), Transaction.id.desc())
+                    ).label("rn"),
+                )
+                .join(Transaction, Transaction.id == TransactionItem.transaction_id)
+                .where(Transaction.type == tx_type)
             )
-            .subquery()
-        )
+            if product_ids is not None:
+                query = query.where(TransactionItem.product_id.in_(product_ids))
+            return query.subquery()
 
-        mfr_tx = Transaction.__table__.alias('mfr_tx')
+        sale = latest(
+            TransactionType.SALE,
+            Transaction.id.label("transaction_id"), Transaction.customer_id, Transaction.created_at
+        )
+        receipt = latest(
+            TransactionType.MANUFACTURER_RECEIVED,
+            Transaction.created_at, Transaction.linked_transaction_id
+        )
         query = (
-            select(received_subq.c.product_id, mfr_tx.c.code)
-            .join(mfr_tx, mfr_tx.c.id == received_subq.c.linked_transaction_id)
+            select(
+                Product.id, sale.c.transaction_id, sale.c.customer_id, sale.c.created_at,
+                receipt.c.created_at, receipt.c.linked_transaction_id
+            )
+            .outerjoin(sale, and_(sale.c.product_id == Product.id, sale.c.rn == 1))
+            .outerjoin(receipt, and_(receipt.c.product_id == Product.id, receipt.c.rn == 1))
+            .where(or_(sale.c.product_id.isnot(None), receipt.c.product_id.isnot(None)))
         )
 
-        result = await self.db.execute(query)
-        return {row.product_id: row.code for row in result.all() if row.code}
+        clear = delete(ProductState)
+        if product_ids is not None:
+            query = query.where(Product.id.in_(product_ids))
+            clear = clear.where(ProductState.product_id.in_(product_ids))
+        await self.db.execute(clear)
+        await self.db.execute(insert(ProductState).from_select(
+            ["product_id", "sale_transaction_id", "customer_id", "sale_date", "received_date", "manufacturer_order_id"],
+            query
+        ))
+
+    async def ensure_states(self) -> bool:
+        """Rebuild product_states when it is empty but products have transaction history.
+
+        A database that predates the table starts with it empty, and its readers would
+        show blank customer names, received dates and manufacturer codes. Returns whether
+        it rebuilt; the caller commits.
+        """
+        if dialect_name(self.db) == "postgresql":
+            # Workers starting together wait here, then find the table filled
+            await self.db.execute(text("LOCK TABLE product_states IN SHARE ROW EXCLUSIVE MODE"))
+        if await self.db.scalar(select(ProductState.product_id).limit(1)) is not None:
+            return False
+        history = select(TransactionItem.id).where(TransactionItem.product_id.isnot(None)).limit(1)
+        if await self.db.scalar(history) is None:
+            return False
+        await self.rebuild_states()
+        return True
 
     async def get_pending_manufacturer_order(self):
         """Get products from customer orders that are not yet ordered from manufacturer.
-        These are products with is_ordered=False and status=SOLD (from customer sales).
+        These are products with is_ordered=False and status=SOLD (from customer sales),
+        as (product, customer_name, order_date, store_name) rows (see _latest_sale).
+        The predicate matches the partial index ix_products_pending_manufacturer.
         """
-        from app.db.models import TransactionItem, TransactionType
-        
         # Get products that:
         # 1. Have is_ordered = False (not ordered from manufacturer yet)
         # 2. Are linked to a sale transaction (customer order)
         query = select(Product).options(
             selectinload(Product.store),
-            selectinload(Product.transactions).selectinload(Transaction.customer)
+            raiseload(Product.transactions)
         ).where(
-            Product.is_ordered == False,
+            # Literal false, as in the index predicate (a bound 0 does not match it on SQLite)
+            Product.is_ordered == literal_column("false"),
             Product.status == ProductStatus.SOLD  # From customer sales
         ).order_by(Product.id.desc())
         
-        result = await self.db.execute(query)
-        return result.scalars().all()
+        result = await self.db.execute(self._latest_sale(query))
+        return result.all()
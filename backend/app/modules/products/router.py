@@ -1,6 +1,8 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, Body
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Body, Query
+from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.fieldsets import Fieldset, dump_sparse, parse_fieldset
 from app.db.session import get_db
 from . import schemas as product_schema
 from .service import ProductService
@@ -13,13 +15,31 @@ def get_service(db: AsyncSession = Depends(get_db)) -> ProductService:
     repository = ProductRepository(db)
     return ProductService(repository)
 
+def product_fieldset(
+    fields: Optional[str] = Query(None, description="Comma-separated Product fields to return (id is always included); customer_name, order_date and store_name come from the sale"),
+    include: Optional[str] = Query(None, description="Comma-separated relations to embed: " + ", ".join(product_schema.PRODUCT_RELATIONS)),
+) -> Fieldset:
+    """The ProductInDBBase response unless `fields` or `include` is given."""
+    try:
+        return parse_fieldset(
+            fields, include, product_schema.Product, product_schema.PRODUCT_RELATIONS,
+            default_fields=product_schema.ProductInDBBase.model_fields
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/", response_model=List[product_schema.ProductInDBBase])
 async def read_products(
     skip: int = 0, 
     limit: int = 100, 
+    fieldset: Fieldset = Depends(product_fieldset),
     service: ProductService = Depends(get_service)
 ):
-    return await service.get_products(skip=skip, limit=limit)
+    """`fields`/`include` switch to the sparse Product shape and load only what it needs."""
+    products = await service.get_products(skip=skip, limit=limit, fieldset=fieldset)
+    if fieldset.is_default:
+        return products
+    return JSONResponse(content=dump_sparse(product_schema.Product, products, fieldset, product_schema.PRODUCT_RELATIONS))
 
 @router.get("/available", response_model=List[product_schema.Product])
 async def read_available_products(
@@ -30,6 +50,16 @@ async def read_available_products(
     """Get available products with store name and last price"""
     return await service.get_available_products(skip=skip, limit=limit)
 
+@router.get("/summary", response_model=List[product_schema.ProductSummaryGroup])
+async def read_products_summary(
+    store_id: Optional[int] = None,
+    status: Optional[product_schema.ProductStatus] = None,
+    fresh: bool = Query(False, description="Recompute instead of reading the in-memory snapshot"),
+    service: ProductService = Depends(get_service)
+):
+    """Product counts and value by store, type, status, is_ordered and is_delivered"""
+    return await service.get_summary(store_id=store_id, status=status, fresh=fresh)
+
 @router.get("/pending-manufacturer", response_model=List[product_schema.Product])
 async def read_pending_manufacturer_products(
     service: ProductService = Depends(get_service)
@@ -97,8 +127,8 @@ async def update_delivery_status_batch(
     """Batch update delivery status for multiple products (from manufacturer)"""
     try:
         updates = [{"product_id": u.product_id, "is_delivered": u.is_delivered} for u in payload.updates]
-        await service.update_delivery_status_batch(updates)
-        return {"ok": True, "updated_count": len(updates)}
+        updated_ids = await service.update_delivery_status_batch(updates)
+        return {"ok": True, "updated_count": len(updated_ids), "updated_ids": updated_ids}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -56,6 +56,10 @@ class Product(ProductInDBBase):
     received_date: Optional[datetime] = None
     transaction_code: Optional[str] = None
 
+# Expansions and sale-derived fields for `?include=` / `?fields=` on the product list
+PRODUCT_RELATIONS = ("store",)
+PRODUCT_SALE_FIELDS = ("customer_name", "order_date", "store_name")
+
 
 class ProductWithTransactions(ProductInDBBase):
     pass
@@ -75,3 +79,14 @@ class ProductStatusInfo(BaseModel):
     buyback_info: Optional[BuybackInfo] = None
     sale_info: Optional[BuybackInfo] = None
     swap_info: Optional[BuybackInfo] = None  # Returned to inventory via swap (Hoán đổi)
+
+class ProductSummaryGroup(BaseModel):
+    """Products of one store/type/status/is_ordered/is_delivered combination."""
+    store_id: Optional[int] = None
+    store_name: Optional[str] = None
+    product_type: Optional[str] = None
+    status: ProductStatus
+    is_ordered: bool
+    is_delivered: bool
+    count: int
+    total_value: float
@@ -1,9 +1,11 @@
 from typing import List, Optional
-import asyncio
 from sqlalchemy import select
+from app.core.fieldsets import DEFAULT_FIELDSET, Fieldset
+from app.core.product_summary import product_summary
 from .repository import ProductRepository
 from . import schemas
 from app.db.models import Product, TransactionType, ProductStatus, TransactionItem, Transaction
+from app.db.sequences import allocate_block
 
 class ProductService:
     def __init__(self, repository: ProductRepository):
@@ -29,6 +31,11 @@ class ProductService:
         return product
 
     async def generate_product_code(self, product_type: str, created_at: Optional['datetime'] = None) -> str:
+        codes = await self.generate_product_codes(product_type, created_at, count=1)
+        return codes[0]
+
+    async def generate_product_codes(self, product_type: str, created_at: Optional['datetime'] = None, count: int = 1) -> List[str]:
+        """Allocate `count` consecutive product codes for one type and day in a single round trip."""
         # Format: XX-DD-MM-YYYY-ZZZZZ
         # XX: 1L (1 lượng), 5L (5 lượng), 1K (1 kg)
         from datetime import datetime
@@ -45,41 +52,37 @@ class ProductService:
         
         prefix = f"{code_prefix}-{date_str}-"
         
-        # Get last sequence for this prefix
-        stmt = select(Product.product_code).where(
-            Product.product_code.like(f"{prefix}%")
-        ).order_by(Product.product_code.desc()).limit(1)
-        
-        result = await self.repository.db.execute(stmt)
-        last_code = result.scalar_one_or_none()
-        
-        new_seq = 1
-        if last_code:
-            try:
-                parts = last_code.split('-')
-                new_seq = int(parts[-1]) + 1
-            except ValueError:
-                pass
-                
-        return f"{prefix}{new_seq:05d}"
+        first_seq = await allocate_block(self.repository.db, prefix, count, Product.product_code)
+        return [f"{prefix}{seq:05d}" for seq in range(first_seq, first_seq + count)]
 
 
     ## NOTE: swap_products moved to TransactionService for proper audit tracking
 
-    async def get_products(self, skip: int = 0, limit: int = 100) -> List[schemas.Product]:
-        products = await self.repository.get_multi(skip=skip, limit=limit)
-        # Manually flatten data if needed, or rely on properties
-        for p in products:
-             # Find the SALE transaction
-            # Using viewonly relation `transactions` which returns Transaction objects.
-            # We eager loaded store and customer for transactions.
-            sale_tx = next((t for t in p.transactions if t.type == TransactionType.SALE), None)
-            if sale_tx:
-                p.customer_name = sale_tx.customer.name if sale_tx.customer else None
-                p.order_date = sale_tx.created_at
-                p.store_name = sale_tx.store.name if sale_tx.store else None
+    async def get_products(self, skip: int = 0, limit: int = 100, fieldset: Fieldset = DEFAULT_FIELDSET) -> List[schemas.Product]:
+        # The default response (ProductInDBBase) has no sale fields, so only sparse requests
+        # that ask for them load the transaction history
+        with_sale = not fieldset.is_default and any(fieldset.returns(f) for f in schemas.PRODUCT_SALE_FIELDS)
+        rows = await self.repository.get_multi(
+            skip=skip, limit=limit, with_sale=with_sale,
+            with_store=not fieldset.is_default and fieldset.expands("store")
+        )
+        if not with_sale:
+            return rows
+        # Customer, date and store of the product's latest SALE
+        products = []
+        for p, customer_name, order_date, store_name in rows:
+            p.customer_name, p.order_date, p.store_name = customer_name, order_date, store_name
+            products.append(p)
         return products
 
+    async def get_summary(self, store_id: Optional[int] = None, status: Optional[str] = None, fresh: bool = False) -> List[dict]:
+        """Inventory counts and value by group, from the in-memory snapshot unless `fresh`."""
+        groups = await (self.repository.get_summary() if fresh else product_summary.get(self.repository.get_summary))
+        return [
+            g for g in groups
+            if (store_id is None or g["store_id"] == store_id) and (status is None or g["status"] == status)
+        ]
+
     async def get_available_products(self, skip: int = 0, limit: int = 100) -> List[schemas.Product]:
         """Get available products with store name"""
         products = await self.repository.get_available(skip=skip, limit=limit)
@@ -89,23 +92,17 @@ class ProductService:
 
     async def get_available_by_store(self, store_id: int) -> List[schemas.Product]:
         """Get available products for a specific store"""
-        products = await self.repository.get_available_by_store(store_id=store_id)
-        for p in products:
+        rows = await self.repository.get_available_by_store(store_id=store_id)
+        products = []
+        for p, latest_code, latest_date, coded_code, coded_date in rows:
             p.store_name = p.store.name if p.store else None
-            # Find the most recent transaction to link
-            if getattr(p, 'transactions', None):
-                sorted_txs = sorted(p.transactions, key=lambda x: x.created_at, reverse=True)
-                latest_tx = sorted_txs[0]
-                p.transaction_code = latest_tx.code
-                p.order_date = latest_tx.created_at
-                
-                if p.status == ProductStatus.AVAILABLE and getattr(p, 'is_ordered', False):
-                    # Find transaction with a valid 'code' column (not transaction_code)
-                    for tx in sorted_txs:
-                        if getattr(tx, 'code', None):
-                            p.transaction_code = tx.code
-                            p.order_date = tx.created_at
-                            break
+            # Link the most recent transaction; for products ordered from the manufacturer,
+            # the most recent one with a manufacturer code (not transaction_code)
+            if latest_date is not None:
+                p.transaction_code, p.order_date = latest_code, latest_date
+                if p.status == ProductStatus.AVAILABLE and p.is_ordered and coded_code:
+                    p.transaction_code, p.order_date = coded_code, coded_date
+            products.append(p)
         return products
 
     async def move_product(self, product_id: int, new_store_id: int) -> Product:
@@ -150,136 +147,84 @@ class ProductService:
         if not product_ids:
             return []
             
-        # Get products with transactions eagerly loaded
-        products = await asyncio.gather(*[self.repository.get(pid) for pid in product_ids])
-
-        # Products swapped out have original_product_id set on the SALE item, not on SWAP items.
-        # Find TransactionItems with original_product_id in product_ids (these are in SALE txns),
-        # then find the SWAP transaction linked to that sale (linked_transaction_id = sale.id).
-        item_stmt = (
-            select(TransactionItem.original_product_id, TransactionItem.transaction_id)
-            .where(
-                TransactionItem.original_product_id.in_(product_ids),
-                TransactionItem.original_product_id.isnot(None)
-            )
-        )
-        item_result = await self.repository.db.execute(item_stmt)
-        item_rows = item_result.all()
-        sale_ids = {row.transaction_id for row in item_rows}
-        orig_to_sale = {row.original_product_id: row.transaction_id for row in item_rows}
+        statuses = await self.repository.get_statuses(product_ids)
+        history = await self.repository.get_status_history(list(statuses))
 
-        swap_by_product = {}
-        if sale_ids:
-            swap_stmt = (
-                select(Transaction)
-                .where(
-                    Transaction.type == TransactionType.SWAP,
-                    Transaction.linked_transaction_id.in_(sale_ids)
-                )
-                .order_by(Transaction.created_at.desc())
-            )
-            swap_result = await self.repository.db.execute(swap_stmt)
-            swap_txs = swap_result.scalars().all()
-            sale_to_swap = {tx.linked_transaction_id: tx for tx in swap_txs}
-            for orig_pid, sale_id in orig_to_sale.items():
-                if sale_id in sale_to_swap:
-                    swap_by_product[orig_pid] = sale_to_swap[sale_id]
+        def info_of(entry, customer_name=None):
+            code, created_at, name = entry
+            return schemas.BuybackInfo(transaction_code=code, created_at=created_at, customer_name=customer_name or name)
 
         results = []
-        for p in products:
-            if not p:
+        for pid in product_ids:
+            status = statuses.get(pid)
+            if status is None:
                 continue
-                
-            info = schemas.ProductStatusInfo(id=p.id, status=p.status)
-            
+            info = schemas.ProductStatusInfo(id=pid, status=status)
+            events = history.get(pid, {})
+
             # SALE (Sold to Customer)
-            sales = [t for t in p.transactions if t.type == TransactionType.SALE]
-            sales.sort(key=lambda x: x.created_at, reverse=True)
-            latest_sale = sales[0] if sales else None
-            
-            if latest_sale:
-                info.sale_info = schemas.BuybackInfo(
-                    transaction_code=latest_sale.transaction_code or latest_sale.code,
-                    created_at=latest_sale.created_at,
-                    customer_name=latest_sale.customer.name if latest_sale.customer else None
-                )
-            
+            sale = events.get("sale")
+            if sale:
+                info.sale_info = info_of(sale)
+
             # BUYBACK (Bought back from Customer)
-            buybacks = [t for t in p.transactions if t.type == TransactionType.BUYBACK]
-            buybacks.sort(key=lambda x: x.created_at, reverse=True)
-            latest_buyback = buybacks[0] if buybacks else None
-            
-            if latest_buyback:
-                # Don't show buyback as "current" if product is currently SOLD (e.g. swapped into another sale)
-                is_curr_buyback = p.status != ProductStatus.SOLD
-                if latest_sale and latest_buyback.created_at < latest_sale.created_at:
-                    is_curr_buyback = False
-                if is_curr_buyback:
-                    info.buyback_info = schemas.BuybackInfo(
-                        transaction_code=latest_buyback.transaction_code or latest_buyback.code,
-                        created_at=latest_buyback.created_at,
-                        customer_name=latest_buyback.customer.name if latest_buyback.customer else None
-                    )
+            buyback = events.get("buyback")
+            # Don't show buyback as "current" if product is currently SOLD (e.g. swapped into another sale)
+            if buyback and status != ProductStatus.SOLD and not (sale and buyback[1] < sale[1]):
+                info.buyback_info = info_of(buyback)
 
             # SWAP (Returned to inventory via swap) — show info for products that came back via swap
-            if p.status == ProductStatus.AVAILABLE and p.id in swap_by_product:
-                swap_tx = swap_by_product[p.id]
-                info.swap_info = schemas.BuybackInfo(
-                    transaction_code=swap_tx.transaction_code or swap_tx.code,
-                    created_at=swap_tx.created_at,
-                    customer_name="Hoán đổi"
-                )
-            
+            swap = events.get("swap")
+            if swap and status == ProductStatus.AVAILABLE:
+                info.swap_info = info_of(swap, customer_name="Hoán đổi")
+
             results.append(info)
-            
+
         return results
 
     async def get_received_unassigned(self) -> List[schemas.Product]:
         """Get products with status RECEIVED_FROM_MFR not assigned to any customer"""
-        products = await self.repository.get_received_unassigned()
-        if not products:
-            return products
+        rows = await self.repository.get_received_unassigned()
+        if not rows:
+            return []
 
-        product_ids = [p.id for p in products]
-        manufacturer_codes = await self.repository.get_manufacturer_codes_for_products(product_ids)
+        products = [p for p, _ in rows]
+        manufacturer_codes = await self.repository.get_manufacturer_codes_for_products([p.id for p in products])
 
-        for p in products:
+        for p, received_date in rows:
             p.store_name = p.store.name if p.store else None
             p.transaction_code = manufacturer_codes.get(p.id)
-            received_tx = next(
-                (t for t in getattr(p, 'transactions', []) if t.type == TransactionType.MANUFACTURER_RECEIVED),
-                None
-            )
-            if received_tx:
-                p.order_date = received_tx.created_at
+            if received_date:
+                p.order_date = received_date
         return products
 
     async def get_pending_manufacturer_order(self) -> List[schemas.Product]:
         """Get products from customer orders not yet ordered from manufacturer"""
-        products = await self.repository.get_pending_manufacturer_order()
-        for p in products:
+        rows = await self.repository.get_pending_manufacturer_order()
+        products = []
+        for p, customer_name, order_date, _ in rows:
             p.store_name = p.store.name if p.store else None
-            # Get customer info from the sale transaction
-            sale_tx = next((t for t in p.transactions if t.type == TransactionType.SALE), None)
-            if sale_tx:
-                p.customer_name = sale_tx.customer.name if sale_tx.customer else None
-                p.order_date = sale_tx.created_at
+            # Customer info from the latest sale transaction
+            p.customer_name, p.order_date = customer_name, order_date
+            products.append(p)
         return products
 
-    async def update_delivery_status_batch(self, updates: List[dict]) -> List[Product]:
+    async def update_delivery_status_batch(self, updates: List[dict]) -> List[int]:
         """Batch update delivery status for multiple products.
         
+        One UPDATE per flag value and a single commit; if a product appears
+        more than once the last entry wins.
+
         Args:
             updates: List of dicts with product_id and is_delivered
         
         Returns:
-            List of updated products
+            Ids of the products that were updated (unknown ids are skipped)
         """
-        updated_products = []
-        for update in updates:
-            product = await self.repository.get(id=update['product_id'])
-            if product:
-                update_data = schemas.ProductUpdate(is_delivered=update['is_delivered'])
-                updated = await self.repository.update(db_obj=product, obj_in=update_data)
-                updated_products.append(updated)
-        return updated_products
+        latest = {u['product_id']: bool(u['is_delivered']) for u in updates}
+        updated_ids = []
+        for value in (True, False):
+            ids = [pid for pid, flag in latest.items() if flag is value]
+            updated_ids.extend(await self.repository.set_delivered(ids, value))
+        await self.repository.commit()
+        return sorted(updated_ids)
@@ -1,11 +1,104 @@
-from datetime import date, datetime
-from typing import Optional, List, Dict
-from sqlalchemy import select, extract, cast, Date, func
-from sqlalchemy.orm import selectinload
+from datetime import date, datetime, time, timedelta
+from typing import Optional, List, Dict, Tuple
+from sqlalchemy import select, update, delete, insert, extract, func, inspect, tuple_, case, and_, or_, bindparam, text
+from sqlalchemy.orm import selectinload, joinedload, raiseload, aliased
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.db.models import Transaction, TransactionItem, Product, Customer, Store, Staff, TransactionType, ProductStatus
+from app.db.models import Transaction, TransactionItem, Product, ProductState, DailyRollup, Customer, Store, Staff, TransactionType, ProductStatus
+from app.core.fieldsets import DEFAULT_FIELDSET, Fieldset
+from app.db.dialects import dialect_name, insert_for
 from . import schemas as transaction_schema
 
+# daily_rollup key columns and the measures summed under them
+ROLLUP_KEY = ("day", "store_id", "staff_id", "tx_type", "payment_method")
+ROLLUP_MEASURES = ("tx_count", "tx_with_items_count", "item_total", "cash_amount", "bank_transfer_amount")
+
+# `order_status` filter value for sales that have not been bought back or fulfilled yet
+ORDER_STATUS_OPEN = "open"
+
+def created_at_range(start_date: Optional[date] = None, end_date: Optional[date] = None) -> list:
+    """Conditions for transactions created on [start_date, end_date], both days inclusive.
+
+    Written as a half-open range on the raw column (`>= start 00:00`, `< day after end`)
+    so the created_at indexes can be used; `cast(created_at, Date)` would hide the column.
+    """
+    conditions = []
+    if start_date:
+        conditions.append(Transaction.created_at >= datetime.combine(start_date, time.min))
+    if end_date:
+        conditions.append(Transaction.created_at < datetime.combine(end_date + timedelta(days=1), time.min))
+    return conditions
+
+def _prefixed(entity, prefix: str) -> list:
+    """All mapped columns of `entity` (a model or alias), labelled `prefix` + column key."""
+    return [getattr(entity, c.key).label(prefix + c.key) for c in inspect(entity).mapper.column_attrs]
+
+# Fixed parts of get_multi_rows, built once: aliasing and labelling dominate the cost
+# of constructing these statements per request
+_LIST_CUSTOMER, _LIST_STORE, _LIST_STAFF = aliased(Customer), aliased(Store), aliased(Staff)
+_LIST_PARTY_COLUMNS = [
+    *_prefixed(_LIST_CUSTOMER, "customer__"),
+    *_prefixed(_LIST_STORE, "store__"),
+    *_prefixed(_LIST_STAFF, "staff__"),
+]
+
+def _list_items_query():
+    columns = list(TransactionItem.__table__.columns)
+    joins = []
+    for key, fk in (("product__", TransactionItem.product_id), ("original_product__", TransactionItem.original_product_id)):
+        product, product_store = aliased(Product), aliased(Store)
+        state, holder = aliased(ProductState), aliased(Customer)
+        columns += [
+            *_prefixed(product, key),
+            *_prefixed(product_store, f"{key}store__"),
+            # get_product_customer_names: holder of the latest sale unless back in stock
+            case(
+                (and_(state.sale_transaction_id.isnot(None), product.status != ProductStatus.AVAILABLE), func.coalesce(holder.name, "")),
+            ).label(f"{key}customer_name"),
+            state.received_date.label(f"{key}received_date"),
+        ]
+        joins += [
+            (product, product.id == fk),
+            (product_store, product_store.id == product.store_id),
+            (state, state.product_id == product.id),
+            (holder, holder.id == state.customer_id),
+        ]
+    query = select(*columns).select_from(TransactionItem)
+    for target, onclause in joins:
+        query = query.outerjoin(target, onclause)
+    return (
+        query.where(TransactionItem.transaction_id.in_(bindparam("transaction_ids", expanding=True)))
+        .order_by(TransactionItem.transaction_id, TransactionItem.id)
+    )
+
+_LIST_ITEMS_QUERY = _list_items_query()
+
+def _graph_options(fieldset: Fieldset) -> list:
+    """Loader options for the Transaction response graph; relations left out of the
+    fieldset's `include` are raiseload-ed rather than queried."""
+    def load(relation, name, *options):
+        return selectinload(relation).options(*options) if fieldset.expands(name) else raiseload(relation)
+    return [
+        load(
+            Transaction.items, "items",
+            load(TransactionItem.product, "items.product", selectinload(Product.store)),
+            load(TransactionItem.original_product, "items.original_product"),
+        ),
+        load(Transaction.customer, "customer"),
+        load(Transaction.store, "store"),
+        load(Transaction.staff, "staff"),
+    ]
+
+def rollup_day_range(start_date: Optional[date] = None, end_date: Optional[date] = None) -> list:
+    """Conditions for daily_rollup rows on [start_date, end_date], both days inclusive."""
+    conditions = []
+    if start_date:
+        conditions.append(DailyRollup.day >= start_date)
+    if end_date:
+        conditions.append(DailyRollup.day <= end_date)
+    return conditions
+
 class TransactionRepository:
     def __init__(self, db: AsyncSession):
         self.db = db
@@ -24,20 +117,45 @@ class TransactionRepository:
         result = await self.db.execute(query)
         return result.scalar_one_or_none()
 
-    async def get_multi(self, skip: int = 0, limit: int = 100, start_date: Optional[date] = None, end_date: Optional[date] = None, tx_type: Optional[str] = None, customer_search: Optional[str] = None):
-        query = select(Transaction).options(
-            selectinload(Transaction.items).options(
-                selectinload(TransactionItem.product).selectinload(Product.store),
-                selectinload(TransactionItem.original_product),
-            ),
-            selectinload(Transaction.customer),
-            selectinload(Transaction.store),
-            selectinload(Transaction.staff)
-        )
-        
+    async def get_plain(self, id: int, for_update: bool = False):
+        """Transaction row only, without items or related objects.
+
+        With `for_update` the row is locked (and re-read) until commit.
+        """
+        if for_update:
+            return await self.db.get(Transaction, id, with_for_update=True, populate_existing=True)
+        return await self.db.get(Transaction, id)
+
+    async def existing_ids(self, model, ids) -> set:
+        """Subset of `ids` that exist in `model`'s table, in one query."""
+        if not ids:
+            return set()
+        result = await self.db.execute(select(model.id).where(model.id.in_(list(ids))))
+        return set(result.scalars().all())
+
+    async def get_multi(self, skip: int = 0, limit: int = 100, start_date: Optional[date] = None, end_date: Optional[date] = None, tx_type: Optional[str] = None, customer_search: Optional[str] = None, after: Optional[Tuple[datetime, int]] = None, order_status: Optional[str] = None, sort: Optional[str] = None, fieldset: Fieldset = DEFAULT_FIELDSET):
+        """Newest first, ordered by (created_at, id).
+
+        `after` is the (created_at, id) of the last row of the previous page; it seeks
+        straight into ix_transactions_created_at_id instead of skipping rows with OFFSET.
+        `order_status` filters on the stored status (ORDER_STATUS_OPEN for orders not yet
+        bought back or fulfilled); `sort="order_status"` lists open orders first.
+        """
+        query = select(Transaction).options(*_graph_options(fieldset))
+        query = self._list_page(query, skip, limit, start_date, end_date, tx_type, customer_search, after, order_status, sort)
+        result = await self.db.execute(query)
+        return result.scalars().all()
+
+    def _list_page(self, query, skip, limit, start_date, end_date, tx_type, customer_search, after, order_status, sort):
+        """Filters, order and page bounds shared by get_multi and get_multi_rows."""
         if tx_type:
             query = query.where(Transaction.type == tx_type)
 
+        if order_status == ORDER_STATUS_OPEN:
+            query = query.where(Transaction.type == TransactionType.SALE, Transaction.order_status.is_(None))
+        elif order_status:
+            query = query.where(Transaction.order_status == order_status)
+
         if customer_search:
             term = f"%{customer_search}%"
             query = query.join(Customer, Customer.id == Transaction.customer_id).where(
@@ -46,16 +164,44 @@ class TransactionRepository:
                 (Customer.cccd.ilike(term))
             )
         
-        if start_date:
-            query = query.where(func.date(Transaction.created_at) >= start_date)
-            
-        if end_date:
-            query = query.where(func.date(Transaction.created_at) <= end_date)
+        query = query.where(*created_at_range(start_date, end_date))
             
-        query = query.order_by(Transaction.created_at.desc())
+        if after:
+            query = query.where(tuple_(Transaction.created_at, Transaction.id) < tuple_(*after))
+        else:
+            query = query.offset(skip)
 
-        result = await self.db.execute(query.offset(skip).limit(limit))
-        return result.scalars().all()
+        if sort == "order_status":
+            query = query.order_by(Transaction.order_status.asc().nulls_first())
+        query = query.order_by(Transaction.created_at.desc(), Transaction.id.desc())
+
+        return query.limit(limit)
+
+    async def get_multi_rows(self, skip: int = 0, limit: int = 100, start_date: Optional[date] = None, end_date: Optional[date] = None, tx_type: Optional[str] = None, customer_search: Optional[str] = None, after: Optional[Tuple[datetime, int]] = None, order_status: Optional[str] = None, sort: Optional[str] = None):
+        """The get_multi page as flat column projections instead of an ORM graph.
+
+        Returns (transactions, items): one mapping per transaction with its customer/store/staff
+        columns under "customer__", "store__" and "staff__" keys, and one mapping per item
+        (ordered by transaction, then id) with its product under "product__" and
+        "original_product__" (each product's store under "...store__"). A product's
+        customer_name and received_date come from product_states, as on the ORM path.
+        """
+        # Page first, then join: the planner keeps the (created_at, id) index walk under LIMIT
+        page = self._list_page(select(Transaction.__table__), skip, limit, start_date, end_date, tx_type, customer_search, after, order_status, sort).subquery()
+        query = (
+            select(*page.columns, *_LIST_PARTY_COLUMNS)
+            .outerjoin(_LIST_CUSTOMER, _LIST_CUSTOMER.id == page.c.customer_id)
+            .outerjoin(_LIST_STORE, _LIST_STORE.id == page.c.store_id)
+            .outerjoin(_LIST_STAFF, _LIST_STAFF.id == page.c.staff_id)
+        )
+        if sort == "order_status":
+            query = query.order_by(page.c.order_status.asc().nulls_first())
+        query = query.order_by(page.c.created_at.desc(), page.c.id.desc())
+        transactions = (await self.db.execute(query)).mappings().all()
+        if not transactions:
+            return transactions, []
+        items = (await self.db.execute(_LIST_ITEMS_QUERY, {"transaction_ids": [t["id"] for t in transactions]})).mappings().all()
+        return transactions, items
 
     async def create(self, obj_in: transaction_schema.TransactionCreate):
         # This is basic create. Complex logic is in Service.
@@ -67,24 +213,75 @@ class TransactionRepository:
 
     async def add_transaction_item(self, item: TransactionItem):
         self.db.add(item)
+
+    async def add_transaction_items(self, items: List[TransactionItem]):
+        """Stage items and flush them as one multi-row INSERT ... RETURNING."""
+        self.db.add_all(items)
+        await self.db.flush()
         
+    async def load_response_graph(self, transaction: Transaction, items: List[TransactionItem]) -> Transaction:
+        """Attach everything the Transaction response schema reads, preferring objects already
+        in the session identity map. Anything missing is fetched with one IN query per model."""
+        product_ids = [pid for item in items for pid in (item.product_id, item.original_product_id)]
+        products = await self._get_many(Product, product_ids)
+        stores = await self._get_many(Store, [transaction.store_id] + [p.store_id for p in products.values()])
+        customers = await self._get_many(Customer, [transaction.customer_id])
+        staff = await self._get_many(Staff, [transaction.staff_id])
+
+        for product in products.values():
+            set_committed_value(product, "store", stores.get(product.store_id))
+        for item in items:
+            set_committed_value(item, "product", products.get(item.product_id))
+            set_committed_value(item, "original_product", products.get(item.original_product_id))
+        set_committed_value(transaction, "items", items)
+        set_committed_value(transaction, "customer", customers.get(transaction.customer_id))
+        set_committed_value(transaction, "store", stores.get(transaction.store_id))
+        set_committed_value(transaction, "staff", staff.get(transaction.staff_id))
+        return transaction
+
+    async def _get_many(self, model, ids) -> dict:
+        ids = {id for id in ids if id is not None}
+        found = {}
+        for id in ids:
+            obj = self.db.identity_map.get(identity_key(model, id))
+            if obj is not None and not inspect(obj).expired_attributes:
+                found[id] = obj
+        missing = ids - found.keys()
+        if missing:
+            result = await self.db.execute(select(model).where(model.id.in_(missing)))
+            found.update({obj.id: obj for obj in result.scalars().all()})
+        return found
+
+    async def update_items(self, rows: List[dict]):
+        """Apply per-item values (each row carries its `id`) as one executemany UPDATE by primary key."""
+        if rows:
+            await self.db.execute(update(TransactionItem), rows)
+
+    async def delete_items(self, ids: List[int]):
+        if ids:
+            await self.db.execute(delete(TransactionItem).where(TransactionItem.id.in_(ids)))
+
     async def commit(self):
         await self.db.commit()
 
+    async def set_delivered_to_kc(self, ids: List[int], delivered_to_kc: bool) -> List[int]:
+        """Set delivered_to_kc on many transactions with one UPDATE ... RETURNING; returns the ids that exist."""
+        if not ids:
+            return []
+        result = await self.db.execute(
+            update(Transaction).where(Transaction.id.in_(ids)).values(delivered_to_kc=delivered_to_kc).returning(Transaction.id)
+        )
+        return list(result.scalars().all())
+
+    async def rollback(self):
+        await self.db.rollback()
+
     async def refresh(self, obj):
         await self.db.refresh(obj)
 
-    async def get_by_customer(self, customer_id: int, tx_type: str = None):
+    async def get_by_customer(self, customer_id: int, tx_type: str = None, fieldset: Fieldset = DEFAULT_FIELDSET):
         """Get transactions by customer ID, optionally filtered by type"""
-        query = select(Transaction).options(
-            selectinload(Transaction.items).options(
-                selectinload(TransactionItem.product).selectinload(Product.store),
-                selectinload(TransactionItem.original_product),
-            ),
-            selectinload(Transaction.customer),
-            selectinload(Transaction.store),
-            selectinload(Transaction.staff)
-        ).where(Transaction.customer_id == customer_id)
+        query = select(Transaction).options(*_graph_options(fieldset)).where(Transaction.customer_id == customer_id)
         
         if tx_type:
             query = query.where(Transaction.type == tx_type)
@@ -93,6 +290,34 @@ class TransactionRepository:
         result = await self.db.execute(query)
         return result.scalars().all()
 
+    async def get_active_sale_items(self, product_ids: List[int]) -> Dict[int, TransactionItem]:
+        """For each product, the item of its most recent SALE transaction (with the transaction loaded)."""
+        if not product_ids:
+            return {}
+        ranked = (
+            select(
+                TransactionItem.id,
+                func.row_number().over(
+                    partition_by=TransactionItem.product_id,
+                    order_by=Transaction.created_at.desc()
+                ).label("rn"),
+            )
+            .join(Transaction, Transaction.id == TransactionItem.transaction_id)
+            .where(
+                TransactionItem.product_id.in_(product_ids),
+                Transaction.type == TransactionType.SALE,
+            )
+            .subquery()
+        )
+        query = (
+            select(TransactionItem)
+            .join(ranked, ranked.c.id == TransactionItem.id)
+            .where(ranked.c.rn == 1)
+            .options(joinedload(TransactionItem.transaction))
+        )
+        result = await self.db.execute(query)
+        return {item.product_id: item for item in result.scalars().all()}
+
     async def get_linked_statuses(self, transaction_ids: list):
         """Get linked transaction types (buyback/fulfillment) for given transaction IDs.
         Returns a dict: {original_tx_id: {"status": status_type, "fulfillment_date": datetime|None}}
@@ -134,121 +359,74 @@ class TransactionRepository:
         return status_map
 
     async def get_product_customer_names(self, product_ids: List[int]) -> Dict[int, str]:
-        """For each product_id, get the customer name from the latest SALE transaction that has this product."""
+        """For each product_id that is not back in stock, the customer of its latest SALE (from product_states)."""
         if not product_ids:
             return {}
-        # Subquery: latest sale transaction per product (by item.product_id)
-        subq = (
-            select(
-                TransactionItem.product_id,
-                Transaction.customer_id,
-                func.row_number().over(
-                    partition_by=TransactionItem.product_id,
-                    order_by=Transaction.created_at.desc()
-                ).label("rn"),
-            )
-            .select_from(TransactionItem)
-            .join(Transaction, Transaction.id == TransactionItem.transaction_id)
+        query = (
+            select(ProductState.product_id, Customer.name)
+            .join(Product, Product.id == ProductState.product_id)
+            .outerjoin(Customer, Customer.id == ProductState.customer_id)
             .where(
-                TransactionItem.product_id.in_(product_ids),
-                Transaction.type == TransactionType.SALE,
+                ProductState.product_id.in_(product_ids),
+                ProductState.sale_transaction_id.isnot(None),
+                Product.status != ProductStatus.AVAILABLE,
             )
         )
-        subq = subq.subquery()
-        query = (
-            select(subq.c.product_id, Customer.name)
-            .join(Product, Product.id == subq.c.product_id)
-            .outerjoin(Customer, Customer.id == subq.c.customer_id)
-            .where(subq.c.rn == 1)
-            .where(Product.status != ProductStatus.AVAILABLE)
-        )
         result = await self.db.execute(query)
         return {row.product_id: (row.name or "") for row in result.all()}
 
     async def get_product_received_dates(self, product_ids: List[int]) -> Dict[int, datetime]:
-        """For each product_id, get the created_at from the latest MANUFACTURER_RECEIVED transaction that has this product."""
+        """For each product_id, the created_at of its latest MANUFACTURER_RECEIVED transaction (from product_states)."""
         if not product_ids:
             return {}
-        subq = (
-            select(
-                TransactionItem.product_id,
-                Transaction.created_at,
-                func.row_number().over(
-                    partition_by=TransactionItem.product_id,
-                    order_by=Transaction.created_at.desc()
-                ).label("rn"),
-            )
-            .select_from(TransactionItem)
-            .join(Transaction, Transaction.id == TransactionItem.transaction_id)
-            .where(
-                TransactionItem.product_id.in_(product_ids),
-                Transaction.type == TransactionType.MANUFACTURER_RECEIVED,
-            )
-        )
-        subq = subq.subquery()
-        query = (
-            select(subq.c.product_id, subq.c.created_at)
-            .where(subq.c.rn == 1)
+        query = select(ProductState.product_id, ProductState.received_date).where(
+            ProductState.product_id.in_(product_ids),
+            ProductState.received_date.isnot(None),
         )
         result = await self.db.execute(query)
-        return {row.product_id: row.created_at for row in result.all()}
+        return {row.product_id: row.received_date for row in result.all()}
 
     async def get_stats(self, start_date: Optional[date] = None, end_date: Optional[date] = None):
-        # Base query for Sales
-        base_query = select(Transaction).where(Transaction.type == TransactionType.SALE)
-        
-        if start_date:
-            base_query = base_query.where(cast(Transaction.created_at, Date) >= start_date)
-        if end_date:
-            base_query = base_query.where(cast(Transaction.created_at, Date) <= end_date)
-
-        # 1. Total Orders
-        total_orders_query = select(func.count()).select_from(base_query.subquery())
-        total_orders = (await self.db.execute(total_orders_query)).scalar_one()
-
-        # 2. Total Revenue (sum of items price)
-        # Assuming we need to join TransactionItem
-        revenue_query = select(func.sum(TransactionItem.price_at_time))\
-            .join(Transaction, TransactionItem.transaction_id == Transaction.id)\
-            .where(Transaction.type == TransactionType.SALE)
-            
-        if start_date:
-            revenue_query = revenue_query.where(cast(Transaction.created_at, Date) >= start_date)
-        if end_date:
-            revenue_query = revenue_query.where(cast(Transaction.created_at, Date) <= end_date)
-
-        total_revenue = (await self.db.execute(revenue_query)).scalar() or 0.0
-
-        # 3. By Payment Method
-        pm_query = select(Transaction.payment_method, func.sum(TransactionItem.price_at_time))\
-            .join(TransactionItem, TransactionItem.transaction_id == Transaction.id)\
-            .where(Transaction.type == TransactionType.SALE)\
-            .group_by(Transaction.payment_method)
-
-        if start_date:
-            pm_query = pm_query.where(cast(Transaction.created_at, Date) >= start_date)
-        if end_date:
-            pm_query = pm_query.where(cast(Transaction.created_at, Date) <= end_date)
-            
-        pm_results = (await self.db.execute(pm_query)).all()
-        payment_method_stats = {row[0] or "unknown": row[1] or 0.0 for row in pm_results}
-
-        # 4. By Store
-        store_query = select(Store.name, func.count(Transaction.id.distinct()), func.sum(TransactionItem.price_at_time))\
-            .join(Transaction, Transaction.store_id == Store.id)\
-            .join(TransactionItem, TransactionItem.transaction_id == Transaction.id)\
-            .where(Transaction.type == TransactionType.SALE)\
-            .group_by(Store.name)
-
-        if start_date:
-            store_query = store_query.where(cast(Transaction.created_at, Date) >= start_date)
-        if end_date:
-            store_query = store_query.where(cast(Transaction.created_at, Date) <= end_date)
-
-        store_results = (await self.db.execute(store_query)).all()
+        """Sales totals, by payment method and by store, read from daily_rollup.
+
+        One GROUP BY (payment_method, store) over the period's SALE rollup rows; every sale
+        has a single payment method and store, so the overall and per-dimension figures
+        are exact sums of these groups.
+        """
+        query = (
+            select(
+                DailyRollup.payment_method,
+                Store.name,
+                func.sum(DailyRollup.tx_count),
+                # Sales with items, which is what the per-store/per-method breakdowns count
+                func.sum(DailyRollup.tx_with_items_count),
+                func.sum(DailyRollup.item_total),
+            )
+            .outerjoin(Store, Store.id == DailyRollup.store_id)
+            .where(DailyRollup.tx_type == TransactionType.SALE, *rollup_day_range(start_date, end_date))
+            .group_by(DailyRollup.payment_method, Store.name)
+        )
+        rows = (await self.db.execute(query)).all()
+
+        total_orders = 0
+        total_revenue = 0.0
+        payment_method_stats = {}
+        store_totals = {}
+        for payment_method, store_name, orders, orders_with_items, revenue in rows:
+            revenue = revenue or 0.0
+            total_orders += orders
+            total_revenue += revenue
+            if not orders_with_items:
+                continue
+            key = payment_method or "unknown"
+            payment_method_stats[key] = payment_method_stats.get(key, 0.0) + revenue
+            if store_name is not None:
+                store_orders, store_revenue = store_totals.get(store_name, (0, 0.0))
+                store_totals[store_name] = (store_orders + orders_with_items, store_revenue + revenue)
+
         store_stats = [
-            {"store_name": row[0], "total_orders": row[1], "revenue": row[2] or 0.0}
-            for row in store_results
+            {"store_name": name, "total_orders": orders, "revenue": revenue}
+            for name, (orders, revenue) in sorted(store_totals.items())
         ]
 
         return {
@@ -259,46 +437,23 @@ class TransactionRepository:
         }
 
     async def get_financial_stats(self, start_date: date, end_date: date):
-        # Money In: SALE + SELL_BACK_MFR
-        async def get_sum(tx_types):
-            query = select(func.sum(TransactionItem.price_at_time))\
-                .join(Transaction, TransactionItem.transaction_id == Transaction.id)\
-                .where(Transaction.type.in_(tx_types))\
-                .where(cast(Transaction.created_at, Date) >= start_date)\
-                .where(cast(Transaction.created_at, Date) <= end_date)
-            
-            return (await self.db.execute(query)).scalar() or 0.0
+        """Money in/out for the period in one statement of conditional aggregates over daily_rollup."""
+        money_in = DailyRollup.tx_type.in_([TransactionType.SALE, TransactionType.SELL_BACK_MFR])
+
+        def total_of(tx_type):
+            return func.sum(case((DailyRollup.tx_type == tx_type, DailyRollup.item_total), else_=0.0))
+
+        query = select(
+            total_of(TransactionType.SALE),
+            total_of(TransactionType.SELL_BACK_MFR),
+            func.sum(case((money_in, DailyRollup.cash_amount), else_=0.0)),
+            func.sum(case((money_in, DailyRollup.bank_transfer_amount), else_=0.0)),
+            total_of(TransactionType.BUYBACK),
+            total_of(TransactionType.MANUFACTURER),
+        ).where(*rollup_day_range(start_date, end_date))
+        row = (await self.db.execute(query)).one()
+        sale_total, sell_back_mfr_total, cash_in, bank_in, buyback_total, manufacturer_order_total = (v or 0.0 for v in row)
 
-        sale_total = await get_sum([TransactionType.SALE])
-        sell_back_mfr_total = await get_sum([TransactionType.SELL_BACK_MFR])
-        
-        # Correctly evaluate cash_in and bank_in for mixed and legacy
-        query = select(Transaction)\
-            .where(Transaction.type.in_([TransactionType.SALE, TransactionType.SELL_BACK_MFR]))\
-            .where(cast(Transaction.created_at, Date) >= start_date)\
-            .where(cast(Transaction.created_at, Date) <= end_date)\
-            .options(selectinload(Transaction.items))
-        
-        result = await self.db.execute(query)
-        transactions = result.scalars().all()
-        
-        cash_in = 0.0
-        bank_in = 0.0
-        
-        for t in transactions:
-            total_items_price = sum(item.price_at_time or 0.0 for item in t.items)
-            if t.payment_method == "mixed":
-                cash_in += t.cash_amount or 0.0
-                bank_in += t.bank_transfer_amount or 0.0
-            elif t.payment_method == "cash":
-                cash_in += total_items_price
-            elif t.payment_method == "bank_transfer":
-                bank_in += total_items_price
-
-        # Money Out: BUYBACK + MANUFACTURER
-        buyback_total = await get_sum([TransactionType.BUYBACK])
-        manufacturer_order_total = await get_sum([TransactionType.MANUFACTURER])
-        
         return {
             "money_in": sale_total + sell_back_mfr_total,
             "money_in_breakdown": {
@@ -313,3 +468,113 @@ class TransactionRepository:
                 "order_from_mfr": manufacturer_order_total
             }
         }
+
+    def _rollup_query(self, *conditions):
+        """daily_rollup rows aggregated from the transactions matching `conditions`.
+
+        Item totals are summed per transaction first, so mixed payments contribute their
+        recorded cash/bank amounts once per transaction rather than once per item.
+        """
+        items_total = (
+            select(TransactionItem.transaction_id, func.sum(TransactionItem.price_at_time).label("total"))
+            .join(Transaction, TransactionItem.transaction_id == Transaction.id)
+            .where(*conditions)
+            .group_by(TransactionItem.transaction_id)
+            .subquery()
+        )
+        total = func.coalesce(items_total.c.total, 0.0)
+        day = func.date(Transaction.created_at)
+        store_id = func.coalesce(Transaction.store_id, 0)
+        staff_id = func.coalesce(Transaction.staff_id, 0)
+        tx_type = func.coalesce(Transaction.type, "")
+        payment_method = func.coalesce(Transaction.payment_method, "")
+        return (
+            select(
+                day, store_id, staff_id, tx_type, payment_method,
+                func.count(Transaction.id),
+                func.count(items_total.c.transaction_id),
+                func.sum(total),
+                func.sum(case(
+                    (Transaction.payment_method == "mixed", func.coalesce(Transaction.cash_amount, 0.0)),
+                    (Transaction.payment_method == "cash", total),
+                    else_=0.0
+                )),
+                func.sum(case(
+                    (Transaction.payment_method == "mixed", func.coalesce(Transaction.bank_transfer_amount, 0.0)),
+                    (Transaction.payment_method == "bank_transfer", total),
+                    else_=0.0
+                )),
+            )
+            .outerjoin(items_total, items_total.c.transaction_id == Transaction.id)
+            .where(Transaction.created_at.isnot(None), *conditions)
+            .group_by(day, store_id, staff_id, tx_type, payment_method)
+        )
+
+    async def rollup_contributions(self, transaction_ids, chunk_size: int = 1000) -> Dict[tuple, tuple]:
+        """What the given transactions add to daily_rollup as stored now, by rollup key."""
+        await self.db.flush()
+        ids = sorted(set(transaction_ids))
+        contributions = {}
+        for start in range(0, len(ids), chunk_size):
+            query = self._rollup_query(Transaction.id.in_(ids[start:start + chunk_size]))
+            for row in (await self.db.execute(query)).all():
+                day = row[0] if isinstance(row[0], date) else date.fromisoformat(row[0])
+                key = (day, *row[1:5])
+                previous = contributions.get(key, (0,) * len(ROLLUP_MEASURES))
+                contributions[key] = tuple(a + (b or 0) for a, b in zip(previous, row[5:]))
+        return contributions
+
+    async def add_to_daily_rollup(self, deltas: Dict[tuple, tuple]):
+        """Add per-key deltas to daily_rollup rows, creating missing rows and dropping emptied ones.
+
+        Each write only changes the rows of its own keys, in key order so concurrent
+        writers cannot deadlock; the row locks of an upsert are all it waits on.
+        """
+        rows = [
+            {**dict(zip(ROLLUP_KEY, key)), **dict(zip(ROLLUP_MEASURES, delta))}
+            for key, delta in sorted(deltas.items()) if any(delta)
+        ]
+        if not rows:
+            return
+        stmt = insert_for(self.db)(DailyRollup).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[getattr(DailyRollup, column) for column in ROLLUP_KEY],
+            set_={column: getattr(DailyRollup, column) + stmt.excluded[column] for column in ROLLUP_MEASURES}
+        )
+        await self.db.execute(stmt)
+        # A key whose last transaction moved away or changed is left without any
+        emptied = [tuple(row[column] for column in ROLLUP_KEY) for row in rows if row["tx_count"] < 0]
+        if emptied:
+            await self.db.execute(delete(DailyRollup).where(
+                tuple_(*(getattr(DailyRollup, column) for column in ROLLUP_KEY)).in_(emptied),
+                DailyRollup.tx_count <= 0
+            ))
+
+    async def refresh_daily_rollup(self):
+        """Regenerate the whole daily_rollup table from transactions.
+
+        Used by rebuild_daily_rollup.py and the startup backfill; writes apply deltas with
+        add_to_daily_rollup instead. On Postgres the table is locked until commit, so
+        writers' deltas wait and land on the rebuilt rows.
+        """
+        await self.db.flush()
+        if dialect_name(self.db) == "postgresql":
+            await self.db.execute(text("LOCK TABLE daily_rollup IN SHARE ROW EXCLUSIVE MODE"))
+        await self.db.execute(delete(DailyRollup))
+        await self.db.execute(insert(DailyRollup).from_select([*ROLLUP_KEY, *ROLLUP_MEASURES], self._rollup_query()))
+
+    async def ensure_daily_rollup(self) -> bool:
+        """Rebuild daily_rollup when it is empty but dated transactions exist.
+
+        A database that predates the table would otherwise serve zeros from the stats
+        endpoints. Returns whether it rebuilt; the caller commits.
+        """
+        if dialect_name(self.db) == "postgresql":
+            # Workers starting together wait here, then find the table filled
+            await self.db.execute(text("LOCK TABLE daily_rollup IN SHARE ROW EXCLUSIVE MODE"))
+        if await self.db.scalar(select(DailyRollup.day).limit(1)) is not None:
+            return False
+        if await self.db.scalar(select(Transaction.id).where(Transaction.created_at.isnot(None)).limit(1)) is None:
+            return False
+        await self.refresh_daily_rollup()
+        return True
@@ -1,22 +1,54 @@
 from datetime import date
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException
+from typing import List, Optional, Union
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.db.session import get_db
+from app.core.fieldsets import Fieldset, dump_sparse, parse_fieldset
+from app.core.idempotency import IdempotentRoute
+from app.db.session import get_db, session_scope
 from app.modules.products.repository import ProductRepository
 from app.modules.products.service import ProductService
 from . import schemas as transaction_schema
 from .service import TransactionService
 from .repository import TransactionRepository
 
-router = APIRouter()
+# POST endpoints honour an Idempotency-Key header (see app.core.idempotency)
+router = APIRouter(route_class=IdempotentRoute)
 
 # Dependency Injection
-def get_service(db: AsyncSession = Depends(get_db)) -> TransactionService:
+def get_service(request: Request, db: AsyncSession = Depends(get_db)) -> TransactionService:
     repository = TransactionRepository(db)
     product_repository = ProductRepository(db)
     product_service = ProductService(product_repository)
-    return TransactionService(repository, product_service)
+    return TransactionService(repository, product_service, open_session=lambda: session_scope(request.app))
+
+def return_minimal(return_: Optional[str] = Query(None, alias="return")) -> bool:
+    """`?return=minimal` makes write endpoints answer with just id/transaction_code"""
+    return return_ == "minimal"
+
+def write_response(transaction, minimal: bool):
+    if minimal:
+        return transaction_schema.TransactionMinimal.model_validate(transaction)
+    return transaction
+
+def transaction_fieldset(
+    fields: Optional[str] = Query(None, description="Comma-separated Transaction fields to return (id is always included)"),
+    include: Optional[str] = Query(None, description="Comma-separated relations to embed: " + ", ".join(transaction_schema.TRANSACTION_RELATIONS)),
+) -> Fieldset:
+    """Full responses unless `fields` or `include` is given."""
+    try:
+        return parse_fieldset(fields, include, transaction_schema.Transaction, transaction_schema.TRANSACTION_RELATIONS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def sparse_response(transactions, fieldset: Fieldset, response: Optional[Response] = None):
+    if fieldset.is_default:
+        return transactions
+    content = dump_sparse(transaction_schema.Transaction, transactions, fieldset, transaction_schema.TRANSACTION_RELATIONS)
+    headers = {"X-Next-Cursor": response.headers["X-Next-Cursor"]} if response is not None and "X-Next-Cursor" in response.headers else None
+    return JSONResponse(content=content, headers=headers)
+
+WriteResponse = Union[transaction_schema.Transaction, transaction_schema.TransactionMinimal]
 
 @router.get("/stats", response_model=transaction_schema.TransactionStats)
 async def get_transaction_stats(
@@ -35,24 +67,66 @@ async def get_financial_stats(
     return await service.get_financial_stats(start_date=start_date, end_date=end_date)
 @router.get("/", response_model=List[transaction_schema.Transaction])
 async def read_transactions(
+    response: Response,
     skip: int = 0, 
     limit: int = 100, 
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     tx_type: Optional[str] = None,
     customer_search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    order_status: Optional[str] = None,
+    sort: Optional[str] = None,
+    fieldset: Fieldset = Depends(transaction_fieldset),
+    service: TransactionService = Depends(get_service)
+):
+    """Newest first. Pass the `X-Next-Cursor` header of a page as `cursor` to fetch the next one (`skip` is ignored then).
+
+    `order_status` filters by stored status ('Mua lại', 'Đã giao', or 'open' for sales not yet
+    bought back or fulfilled); `sort=order_status` lists open orders first (offset paging only).
+    `fields`/`include` trim the response and the queries behind it.
+    """
+    try:
+        transactions = await service.get_transactions(skip=skip, limit=limit, start_date=start_date, end_date=end_date, tx_type=tx_type, customer_search=customer_search, cursor=cursor, order_status=order_status, sort=sort, fieldset=fieldset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    next_cursor = service.next_cursor(transactions, limit) if sort in (None, "created_at") else None
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return sparse_response(transactions, fieldset, response)
+
+@router.get("/stream", response_model=List[transaction_schema.Transaction])
+async def stream_transactions(
+    skip: int = 0,
+    limit: int = 100,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    tx_type: Optional[str] = None,
+    customer_search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    order_status: Optional[str] = None,
+    sort: Optional[str] = None,
     service: TransactionService = Depends(get_service)
 ):
-    return await service.get_transactions(skip=skip, limit=limit, start_date=start_date, end_date=end_date, tx_type=tx_type, customer_search=customer_search)
+    """Same page, body and `X-Next-Cursor` header as GET /, assembled from flat column
+    projections and streamed one transaction at a time (for large pages)."""
+    try:
+        chunks, next_cursor = await service.get_transactions_json(skip=skip, limit=limit, start_date=start_date, end_date=end_date, tx_type=tx_type, customer_search=customer_search, cursor=cursor, order_status=order_status, sort=sort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return StreamingResponse(chunks, media_type="application/json", headers=headers)
 
 @router.get("/customer/{customer_id}", response_model=List[transaction_schema.Transaction])
 async def get_customer_transactions(
     customer_id: int,
     tx_type: Optional[str] = None,
+    fieldset: Fieldset = Depends(transaction_fieldset),
     service: TransactionService = Depends(get_service)
 ):
     """Get all transactions for a specific customer"""
-    return await service.get_transactions_by_customer(customer_id=customer_id, tx_type=tx_type)
+    transactions = await service.get_transactions_by_customer(customer_id=customer_id, tx_type=tx_type, fieldset=fieldset)
+    return sparse_response(transactions, fieldset)
 
 @router.get("/{id}", response_model=transaction_schema.Transaction)
 async def read_transaction(
@@ -64,80 +138,107 @@ async def read_transaction(
         raise HTTPException(status_code=404, detail="Transaction not found")
     return transaction
 
-@router.post("/order", response_model=transaction_schema.Transaction)
+@router.post("/order", response_model=WriteResponse)
 async def create_order(
     order: transaction_schema.OrderCreate, 
+    minimal: bool = Depends(return_minimal),
     service: TransactionService = Depends(get_service)
 ):
     try:
-        return await service.create_order(order_in=order)
+        return write_response(await service.create_order(order_in=order, minimal=minimal), minimal)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-@router.post("/manufacturer-order", response_model=transaction_schema.Transaction)
+
+@router.post("/order/batch", response_model=transaction_schema.OrderBatchResult)
+async def import_orders(
+    batch: transaction_schema.OrderBatchCreate,
+    service: TransactionService = Depends(get_service)
+):
+    """Back-office import of many orders; invalid rows are reported per index and skipped"""
+    results = await service.import_orders(orders=batch.orders)
+    created = sum(1 for r in results if r.ok)
+    return transaction_schema.OrderBatchResult(created=created, failed=len(results) - created, results=results)
+
+@router.post("/manufacturer-order", response_model=WriteResponse)
 async def create_manufacturer_order(
     order: transaction_schema.ManufacturerOrderCreate, 
+    minimal: bool = Depends(return_minimal),
     service: TransactionService = Depends(get_service)
 ):
     try:
-        return await service.create_manufacturer_order(order_in=order)
+        return write_response(await service.create_manufacturer_order(order_in=order, minimal=minimal), minimal)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.post("/buyback", response_model=transaction_schema.Transaction)
+@router.post("/buyback", response_model=WriteResponse)
 async def create_buyback(
     buyback: transaction_schema.BuybackCreate,
+    minimal: bool = Depends(return_minimal),
     service: TransactionService = Depends(get_service)
 ):
     """Create a buyback transaction - products become available again"""
     try:
-        return await service.create_buyback(buyback_in=buyback)
+        return write_response(await service.create_buyback(buyback_in=buyback, minimal=minimal), minimal)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.post("/fulfillment", response_model=transaction_schema.Transaction)
+@router.post("/fulfillment", response_model=WriteResponse)
 async def create_fulfillment(
     fulfillment: transaction_schema.FulfillmentCreate,
+    minimal: bool = Depends(return_minimal),
     service: TransactionService = Depends(get_service)
 ):
     """Create a fulfillment transaction - products delivered to customer"""
     try:
-        return await service.create_fulfillment(fulfillment_in=fulfillment)
+        return write_response(await service.create_fulfillment(fulfillment_in=fulfillment, minimal=minimal), minimal)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.post("/sell-back", response_model=transaction_schema.Transaction)
+@router.post("/sell-back", response_model=WriteResponse)
 async def create_sell_back(
     sell_back: transaction_schema.SellBackCreate,
+    minimal: bool = Depends(return_minimal),
     service: TransactionService = Depends(get_service)
 ):
     """Create a sell-back transaction - products sold back to manufacturer"""
     try:
-        return await service.create_sell_back(sell_back_in=sell_back)
+        return write_response(await service.create_sell_back(sell_back_in=sell_back, minimal=minimal), minimal)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.post("/manufacturer-receive", response_model=transaction_schema.Transaction)
+@router.post("/manufacturer-receive", response_model=WriteResponse)
 async def create_manufacturer_receive(
     receive: transaction_schema.ManufacturerReceiveCreate,
+    minimal: bool = Depends(return_minimal),
     service: TransactionService = Depends(get_service)
 ):
     """Create a manufacturer receive transaction - products received from manufacturer"""
     try:
-        return await service.create_manufacturer_receive(receive_in=receive)
+        return write_response(await service.create_manufacturer_receive(receive_in=receive, minimal=minimal), minimal)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.post("/swap", response_model=transaction_schema.Transaction)
+@router.post("/swap", response_model=WriteResponse)
 async def create_swap(
     swap: transaction_schema.SwapCreate,
+    minimal: bool = Depends(return_minimal),
     service: TransactionService = Depends(get_service)
 ):
     """Swap two products between customers/inventory with audit trail"""
     try:
-        return await service.create_swap(swap_in=swap)
+        return write_response(await service.create_swap(swap_in=swap, minimal=minimal), minimal)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.post("/delivered-to-kc/batch")
+async def update_kc_status_batch(
+    payload: transaction_schema.BatchKCStatusUpdate,
+    service: TransactionService = Depends(get_service)
+):
+    """Batch update the delivered-to-KC flag for multiple orders"""
+    updated_ids = await service.update_kc_status_batch(payload.updates)
+    return {"ok": True, "updated_count": len(updated_ids), "updated_ids": updated_ids}
+
 @router.put("/order/{id}", response_model=transaction_schema.Transaction)
 async def update_order(
     id: int,
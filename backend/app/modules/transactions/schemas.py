@@ -55,6 +55,21 @@ class OrderCreate(BaseModel):
     cash_amount: Optional[float] = 0.0
     bank_transfer_amount: Optional[float] = 0.0
 
+class OrderBatchCreate(BaseModel):
+    orders: List[OrderCreate]
+
+class OrderImportResult(BaseModel):
+    index: int
+    ok: bool
+    id: Optional[int] = None
+    transaction_code: Optional[str] = None
+    error: Optional[str] = None
+
+class OrderBatchResult(BaseModel):
+    created: int
+    failed: int
+    results: List[OrderImportResult]
+
 class ManufacturerOrderItem(BaseModel):
     product_id: Optional[int] = None # For existing
     product_type: Optional[str] = None # For new
@@ -99,7 +114,7 @@ class Transaction(TransactionInDBBase):
     customer: Optional[Customer] = None
     store: Optional[Store] = None
     staff: Optional[Staff] = None
-    order_status: Optional[str] = None  # Derived field: 'buyback', 'fulfilled', or None
+    order_status: Optional[str] = None  # Stored on sales: 'Mua lại', 'Đã giao', or None while open
     fulfillment_date: Optional[datetime] = None  # Date of fulfillment transaction
     code: Optional[str] = None  # Manufacturer order code (manual)
     transaction_code: Optional[str] = None  # Transaction code (auto-generated)
@@ -109,6 +124,22 @@ class Transaction(TransactionInDBBase):
     bank_transfer_amount: float = 0.0
     delivered_to_kc: bool = False
 
+# Expansions a Transaction list can `?include=` (see app.core.fieldsets)
+TRANSACTION_RELATIONS = ("items", "items.product", "items.original_product", "customer", "store", "staff")
+
+class KCStatusUpdate(BaseModel):
+    transaction_id: int
+    delivered_to_kc: bool
+
+class BatchKCStatusUpdate(BaseModel):
+    updates: List[KCStatusUpdate]
+
+class TransactionMinimal(BaseModel):
+    """Write response for `?return=minimal`"""
+    id: int
+    transaction_code: Optional[str] = None
+    model_config = ConfigDict(from_attributes=True)
+
 from typing import Dict
 
 class StoreStats(BaseModel):
@@ -1,19 +1,164 @@
-from typing import List, Optional
+import functools
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 from sqlalchemy import select
 from datetime import date, datetime, timezone
-from app.db.models import Transaction, TransactionItem, TransactionType, ProductStatus, Product
-from .repository import TransactionRepository
+from app.db.models import Transaction, TransactionItem, TransactionType, ProductStatus, Product, Staff, Customer, Store
+from app.core.fieldsets import DEFAULT_FIELDSET, Fieldset
+from app.core.pagination import decode_cursor, encode_cursor
+from app.core.availability import availability_index
+from app.core.stats_cache import stats_cache
+from app.db.sequences import allocate_block
+from .repository import ROLLUP_MEASURES, TransactionRepository
 from app.modules.products.service import ProductService
 from app.modules.products import schemas as product_schemas
 from . import schemas as transaction_schemas
+from app.modules.customers import schemas as customer_schemas
+from app.modules.stores import schemas as store_schemas
+from app.modules.staff import schemas as staff_schemas
+
+# Stored on a sale by the transaction that closes it (see Transaction.order_status)
+ORDER_STATUS_BOUGHT_BACK = TransactionType.BUYBACK.value
+ORDER_STATUS_FULFILLED = "Đã giao"
+
+class _Projection:
+    """Builds the JSON-ready dict of a response schema from one flat row.
+
+    Keys follow the schema's field order; fields are read from "<prefix><field>" columns,
+    nested schemas from their own prefix, and fields with no column take the schema
+    default, mirroring what `from_attributes` validation would produce.
+    """
+    def __init__(self, schema, prefix: str = "", nested: Optional[Dict[str, "_Projection"]] = None, state_fields: tuple = ()):
+        nested = nested or {}
+        self.id_key = prefix + "id"
+        # Product fields the ORM path only fills in for the page's item products
+        self.state_fields = state_fields
+        self.fields = [
+            (name, prefix + name, nested.get(name), field.get_default())
+            for name, field in schema.model_fields.items()
+        ]
+
+    def build(self, row: dict, page_product_ids: set, **given) -> Optional[dict]:
+        id = row.get(self.id_key)
+        if id is None:
+            return None
+        hide_state = self.state_fields and id not in page_product_ids
+        out = {}
+        for name, key, nested, default in self.fields:
+            if name in given:
+                out[name] = given[name]
+            elif nested is not None:
+                out[name] = nested.build(row, page_product_ids)
+            elif hide_state and name in self.state_fields:
+                out[name] = default
+            else:
+                out[name] = row.get(key, default)
+        return out
+
+def _product_projection(prefix: str) -> _Projection:
+    return _Projection(
+        product_schemas.Product, prefix,
+        nested={"store": _Projection(store_schemas.Store, f"{prefix}store__")},
+        state_fields=("customer_name", "received_date"),
+    )
+
+_ITEM = _Projection(transaction_schemas.TransactionItem, nested={
+    "product": _product_projection("product__"),
+    "original_product": _product_projection("original_product__"),
+})
+_TRANSACTION = _Projection(transaction_schemas.Transaction, nested={
+    "customer": _Projection(customer_schemas.Customer, "customer__"),
+    "store": _Projection(store_schemas.Store, "store__"),
+    "staff": _Projection(staff_schemas.Staff, "staff__"),
+})
+
+def _json_default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _json(value) -> bytes:
+    # Same separators/escaping as FastAPI's JSONResponse
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+SWAPPABLE_STATUSES = {ProductStatus.SOLD, ProductStatus.AVAILABLE, ProductStatus.ORDERED, ProductStatus.RECEIVED_FROM_MFR}
+
+# Supported swaps, keyed by (status of group A, status of group B); the reverse
+# order is handled by swapping the groups. Each rule gives:
+#   links    - whose active SALE items are re-pointed: "ab" moves A's sale items
+#              onto B's products, "ba" the other way round
+#   exchange - whether the two groups also trade status and store
+SWAP_TRANSITIONS = {
+    (ProductStatus.SOLD, ProductStatus.SOLD): (("ab", "ba"), False),  # Customer A <-> Customer B
+    (ProductStatus.SOLD, ProductStatus.AVAILABLE): (("ab",), True),  # Customer returns A, takes B
+    (ProductStatus.ORDERED, ProductStatus.AVAILABLE): (("ab",), True),
+    (ProductStatus.ORDERED, ProductStatus.RECEIVED_FROM_MFR): (("ab",), False),
+    (ProductStatus.SOLD, ProductStatus.RECEIVED_FROM_MFR): (("ab",), False),
+    (ProductStatus.RECEIVED_FROM_MFR, ProductStatus.RECEIVED_FROM_MFR): (("ab", "ba"), False),
+}
+
+def unit_of_work(method):
+    """Roll back everything a write method staged if it fails before its single commit."""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        try:
+            return await method(self, *args, **kwargs)
+        except Exception:
+            self._forget_touched()
+            await self.repository.rollback()
+            raise
+    return wrapper
 
 class TransactionService:
-    def __init__(self, repository: TransactionRepository, product_service: ProductService):
+    def __init__(self, repository: TransactionRepository, product_service: ProductService, open_session: Optional[Callable] = None):
         self.repository = repository
+        self.open_session = open_session
         self.product_service = product_service
         self.product_repository = product_service.repository
+        # Transactions the pending commit adds to or changes in daily_rollup, and what
+        # the changed ones contributed before the write
+        self._touched = set()
+        self._rollup_before = {}
+
+    def _touch(self, *transactions: Transaction):
+        """Mark transactions created by the pending write for daily_rollup."""
+        for transaction in transactions:
+            self._touched.add(transaction)
+
+    async def _touch_existing(self, transaction: Transaction):
+        """Mark a stored transaction the pending write is about to change; call before changing it."""
+        if transaction in self._touched:
+            return
+        self._touched.add(transaction)
+        for key, values in (await self.repository.rollup_contributions([transaction.id])).items():
+            previous = self._rollup_before.get(key, (0,) * len(ROLLUP_MEASURES))
+            self._rollup_before[key] = tuple(a + b for a, b in zip(previous, values))
+
+    def _forget_touched(self):
+        self._touched.clear()
+        self._rollup_before.clear()
+
+    async def _commit(self):
+        """Commit the staged write together with its change to daily_rollup, then mark
+        cached stats covering the days it changed stale and settle the availability index."""
+        days = set()
+        if self._touched:
+            after = await self.repository.rollup_contributions(t.id for t in self._touched)
+            zero = (0,) * len(ROLLUP_MEASURES)
+            deltas = {
+                key: tuple(a - b for a, b in zip(after.get(key, zero), self._rollup_before.get(key, zero)))
+                for key in after.keys() | self._rollup_before.keys()
+            }
+            await self.repository.add_to_daily_rollup(deltas)
+            days = {key[0] for key, delta in deltas.items() if any(delta)}
+        await self.repository.commit()
+        stats_cache.invalidate(days)
+        self._forget_touched()
+        # Products returned to stock by status-only UPDATEs: read where they are
+        await availability_index.resolve(self.repository.db)
 
-    async def get_transactions(self, skip: int = 0, limit: int = 100, start_date: Optional[date] = None, end_date: Optional[date] = None, tx_type: Optional[str] = None, customer_search: Optional[str] = None) -> List[Transaction]:
+    def _list_filters(self, skip: int = 0, limit: int = 100, start_date: Optional[date] = None, end_date: Optional[date] = None, tx_type: Optional[str] = None, customer_search: Optional[str] = None, cursor: Optional[str] = None, order_status: Optional[str] = None, sort: Optional[str] = None) -> dict:
+        """Validated repository arguments for a transaction list page."""
         if tx_type:
             normalized = tx_type.replace("+", " ").strip()
             if normalized in (TransactionType.SALE.value, "sale", "SALE"):
@@ -22,17 +167,18 @@ class TransactionService:
                 tx_type = normalized
             else:
                 tx_type = normalized
-        transactions = await self.repository.get_multi(skip=skip, limit=limit, start_date=start_date, end_date=end_date, tx_type=tx_type, customer_search=customer_search)
-        
-        # Get linked statuses for sale transactions
-        sale_ids = [t.id for t in transactions if t.type == TransactionType.SALE]
-        status_map = await self.repository.get_linked_statuses(sale_ids)
-
-        # Populate order_status and fulfillment_date for each transaction
-        for t in transactions:
-            if t.id in status_map:
-                t.order_status = status_map[t.id]["status"]
-                t.fulfillment_date = status_map[t.id]["fulfillment_date"]
+        if sort not in (None, "created_at", "order_status"):
+            raise ValueError(f"Unsupported sort: {sort}")
+        if cursor and sort == "order_status":
+            raise ValueError("Cursor pagination is only supported with the default sort")
+        after = decode_cursor(cursor) if cursor else None
+        return dict(skip=skip, limit=limit, start_date=start_date, end_date=end_date, tx_type=tx_type, customer_search=customer_search, after=after, order_status=order_status, sort=sort)
+
+    async def get_transactions(self, fieldset: Fieldset = DEFAULT_FIELDSET, **filters) -> List[Transaction]:
+        # order_status/fulfillment_date are stored on the sale by the buyback/fulfillment that closes it
+        transactions = await self.repository.get_multi(**self._list_filters(**filters), fieldset=fieldset)
+        if not fieldset.expands("items.product"):
+            return transactions
 
         # Populate product.customer_name for all items (who will receive this product)
         product_ids = []
@@ -52,25 +198,158 @@ class TransactionService:
         
         return transactions
 
+    async def get_transactions_json(self, **filters) -> Tuple[AsyncIterator[bytes], Optional[str]]:
+        """The get_transactions page as JSON chunks (one per transaction), plus the next cursor.
+
+        Built from flat column projections rather than ORM objects and response-model
+        validation; the bytes match the `List[Transaction]` response of GET /.
+        """
+        args = self._list_filters(**filters)
+        rows, item_rows = await self.repository.get_multi_rows(**args)
+        rows, item_rows = [dict(row) for row in rows], [dict(item) for item in item_rows]
+        items_by_tx = {}
+        for item in item_rows:
+            items_by_tx.setdefault(item["transaction_id"], []).append(item)
+        # The ORM path sets customer_name/received_date on the page's item products only;
+        # an original product shares them when it is also one of those (same identity)
+        page_product_ids = {item["product_id"] for item in item_rows}
+
+        async def chunks():
+            # Async, so the response streams it on the event loop rather than via a thread per chunk
+            yield b"["
+            for i, row in enumerate(rows):
+                items = [_ITEM.build(item, page_product_ids) for item in items_by_tx.get(row["id"], [])]
+                body = _json(_TRANSACTION.build(row, page_product_ids, items=items))
+                yield (b"," if i else b"") + body
+            yield b"]"
+
+        cursor = None
+        if args["sort"] in (None, "created_at") and rows and len(rows) >= args["limit"] and rows[-1]["created_at"] is not None:
+            cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+        return chunks(), cursor
+
+    @staticmethod
+    def next_cursor(transactions: List[Transaction], limit: int) -> Optional[str]:
+        """Cursor for the page after `transactions`, or None when the page was not full.
+
+        Also None when the last row has no created_at: where NULLs sort differs between
+        databases, so such a page can only be continued with `skip`.
+        """
+        if not transactions or len(transactions) < limit:
+            return None
+        last = transactions[-1]
+        if last.created_at is None:
+            return None
+        return encode_cursor(last.created_at, last.id)
+
     async def get_stats(self, start_date: Optional[date] = None, end_date: Optional[date] = None) -> transaction_schemas.TransactionStats:
-        return await self.repository.get_stats(start_date=start_date, end_date=end_date)
+        return await stats_cache.get(
+            "stats", start_date, end_date,
+            lambda: self.repository.get_stats(start_date=start_date, end_date=end_date),
+            self._background(lambda repository: repository.get_stats(start_date=start_date, end_date=end_date))
+        )
 
     async def get_financial_stats(self, start_date: date, end_date: date):
-        return await self.repository.get_financial_stats(start_date=start_date, end_date=end_date)
+        return await stats_cache.get(
+            "financial-stats", start_date, end_date,
+            lambda: self.repository.get_financial_stats(start_date=start_date, end_date=end_date),
+            self._background(lambda repository: repository.get_financial_stats(start_date=start_date, end_date=end_date))
+        )
+
+    def _background(self, query: Callable[[TransactionRepository], Awaitable]) -> Optional[Callable[[], Awaitable]]:
+        """Run `query` on a session of its own, so it can outlive the current request."""
+        if self.open_session is None:
+            return None
+        async def run():
+            async with self.open_session() as db:
+                return await query(TransactionRepository(db))
+        return run
 
     async def get_transaction(self, transaction_id: int) -> Optional[Transaction]:
         return await self.repository.get(id=transaction_id)
       
-    async def create_order(self, order_in: transaction_schemas.OrderCreate) -> Transaction:
+    @unit_of_work
+    async def create_order(self, order_in: transaction_schemas.OrderCreate, minimal: bool = False) -> Transaction:
         # Create Transaction logic is complex.
         # We need to manually construct the transaction object first
         
+        tx_created = self._order_created_at(order_in)
+
+        # Existing stock is locked before the code counters (see allocate_block)
+        claims = {}
+        for item in order_in.items:
+            if item.is_new:
+                continue
+            if item.product_id:
+                # Specific product requested
+                products = await self.product_repository.get_many_for_update([item.product_id])
+                if not products:
+                    raise ValueError(f"Product ID {item.product_id} not found")
+                if products[0].status != ProductStatus.AVAILABLE or item.quantity > 1:
+                    raise ValueError(f"Product ID {item.product_id} is not available")
+            else:
+                # Claim qty units of the type from store stock in one SKIP LOCKED query
+                products = await self.product_repository.claim_available(
+                    store_id=order_in.store_id,
+                    product_type=item.product_type,
+                    count=item.quantity
+                )
+                if len(products) < item.quantity:
+                    raise ValueError(f"No available product {item.product_type} in store")
+            # Marked SOLD right away, so a later line of the order cannot claim them again
+            await self.product_repository.update_many([p.id for p in products], status=ProductStatus.SOLD, last_price=item.price)
+            claims[id(item)] = products
+
+        transaction = self._build_sale(order_in, tx_created, await self._generate_transaction_code(tx_created))
+        
+        await self.repository.add_transaction(transaction)
+        # We need the ID, so we flush
+        await self.repository.db.flush() 
+
+        t_items = []
+        for item in order_in.items:
+            qty = item.quantity
+            price = item.price
+
+            if item.is_new:
+                # Create new products - from customer order, not yet ordered from manufacturer.
+                # All codes for the line are allocated at once and the rows go out as one INSERT.
+                codes = await self.product_service.generate_product_codes(item.product_type, tx_created, count=qty)
+                products = await self.product_repository.create_many([
+                    product_schemas.ProductCreate(
+                        product_type=item.product_type,
+                        product_code=code,
+                        status=ProductStatus.SOLD,
+                        last_price=price,
+                        store_id=order_in.store_id,
+                        is_ordered=False  # Not ordered from manufacturer yet
+                    )
+                    for code in codes
+                ])
+            else:
+                products = claims[id(item)]
+            for product in products:
+                t_items.append(TransactionItem(
+                    transaction_id=transaction.id,
+                    product_id=product.id,
+                    price_at_time=price
+                ))
+
+        await self.repository.add_transaction_items(t_items)
+        await self._record_sales(transaction, t_items)
+        self._touch(transaction)
+        await self._commit()
+        return await self._write_response(transaction, t_items, minimal)
+
+    def _order_created_at(self, order_in: transaction_schemas.OrderCreate) -> datetime:
         # Handle timezone: Use server local time (Hanoi)
         tx_created = order_in.created_at or datetime.now()
         if tx_created.tzinfo is not None:
              # Convert to naive local time if aware
              tx_created = tx_created.astimezone(None).replace(tzinfo=None)
+        return tx_created
 
+    def _build_sale(self, order_in: transaction_schemas.OrderCreate, tx_created: datetime, transaction_code: str) -> Transaction:
         # Calculate total amount to determine split if not explicit
         total_amount = sum(item.quantity * item.price for item in order_in.items)
         
@@ -86,7 +365,7 @@ class TransactionService:
         elif order_in.payment_method == "bank_transfer":
             bank_transfer_amount = total_amount
 
-        transaction = Transaction(
+        return Transaction(
             type=TransactionType.SALE,
             staff_id=order_in.staff_id,
             customer_id=order_in.customer_id,
@@ -95,69 +374,180 @@ class TransactionService:
             payment_method=order_in.payment_method,
             cash_amount=cash_amount,
             bank_transfer_amount=bank_transfer_amount,
-            transaction_code=await self._generate_transaction_code(tx_created)
+            transaction_code=transaction_code
         )
-        
-        await self.repository.add_transaction(transaction)
-        # We need the ID, so we flush
-        await self.repository.db.flush() 
 
-        for item in order_in.items:
-            qty = item.quantity
-            price = item.price
-            
-            for _ in range(qty):
-                product = None
+    @unit_of_work
+    async def import_orders(self, orders: List[transaction_schemas.OrderCreate]) -> List[transaction_schemas.OrderImportResult]:
+        """Back-office backfill of many customer orders in one database transaction.
+
+        Every row is validated up front with set-based lookups; rows that fail are
+        reported and skipped. Codes are allocated in blocks per day (and per product
+        type), and all transactions, products and items are written by a single flush,
+        which Postgres receives as batched multi-row INSERTs.
+        """
+        results = [transaction_schemas.OrderImportResult(index=i, ok=True) for i in range(len(orders))]
+
+        def fail(index: int, error: str):
+            results[index].ok = False
+            results[index].error = error
+
+        # 1. Referenced staff/customers/stores must exist
+        known_staff = await self.repository.existing_ids(Staff, {o.staff_id for o in orders})
+        known_customers = await self.repository.existing_ids(Customer, {o.customer_id for o in orders})
+        known_stores = await self.repository.existing_ids(Store, {o.store_id for o in orders})
+        for i, o in enumerate(orders):
+            if o.staff_id not in known_staff:
+                fail(i, f"Staff ID {o.staff_id} not found")
+            elif o.customer_id not in known_customers:
+                fail(i, f"Customer ID {o.customer_id} not found")
+            elif o.store_id not in known_stores:
+                fail(i, f"Store ID {o.store_id} not found")
+            elif not o.items or any(item.quantity < 1 for item in o.items):
+                fail(i, "Order must have items with a positive quantity")
+
+        # 2. Existing stock: specific products by id, the rest picked by type
+        requested_ids = {
+            item.product_id for i, o in enumerate(orders) if results[i].ok
+            for item in o.items if not item.is_new and item.product_id
+        }
+        stock = {p.id: p for p in await self.product_repository.get_many_for_update(list(requested_ids))}
+        wanted_by_type = {}
+        for i, o in enumerate(orders):
+            if results[i].ok:
+                for item in o.items:
+                    if not item.is_new and not item.product_id:
+                        key = (o.store_id, item.product_type)
+                        wanted_by_type[key] = wanted_by_type.get(key, 0) + item.quantity
+        pools = {}
+        for (store_id, product_type), count in wanted_by_type.items():
+            pools[(store_id, product_type)] = await self.product_repository.claim_available(
+                store_id=store_id, product_type=product_type, count=count
+            )
+
+        claimed = set()
+        # Unclaimed stock per (store, type), lowest id on top
+        free = {key: pool[::-1] for key, pool in pools.items()}
+        picks = {}  # order index -> [(order item, [products])]
+        for i, o in enumerate(orders):
+            if not results[i].ok:
+                continue
+            row_picks = []
+            row_claimed = []
+            row_popped = []  # (pool key, product) taken off `free`, pushed back if the row fails
+            error = None
+            for item in o.items:
                 if item.is_new:
-                    # Create new product - from customer order, not yet ordered from manufacturer
-                    prod_in = product_schemas.ProductCreate(
-                        product_type=item.product_type,
-                        product_code=await self.product_service.generate_product_code(item.product_type, tx_created),
-                        status=ProductStatus.SOLD,
-                        last_price=price,
-                        store_id=order_in.store_id,
-                        is_ordered=False  # Not ordered from manufacturer yet
-                    )
-                    product = await self.product_repository.create(prod_in)
+                    continue
+                if item.product_id:
+                    product = stock.get(item.product_id)
+                    if not product:
+                        error = f"Product ID {item.product_id} not found"
+                    elif product.status != ProductStatus.AVAILABLE or product.id in claimed or item.quantity != 1:
+                        error = f"Product ID {item.product_id} is not available"
+                    else:
+                        row_picks.append((item, [product]))
+                        claimed.add(product.id)
+                        row_claimed.append(product.id)
                 else:
-                    # Use specific product_id if provided, otherwise find by type
-                    if item.product_id:
-                        product = await self.product_repository.get(id=item.product_id)
-                        if not product:
-                            raise ValueError(f"Product ID {item.product_id} not found")
-                        if product.status != ProductStatus.AVAILABLE:
-                            raise ValueError(f"Product ID {item.product_id} is not available")
+                    key = (o.store_id, item.product_type)
+                    pool = free[key]
+                    picked = []
+                    while len(picked) < item.quantity and pool:
+                        product = pool.pop()
+                        row_popped.append((key, product))
+                        # Skip units a product_id line already claimed
+                        if product.id not in claimed:
+                            picked.append(product)
+                            claimed.add(product.id)
+                            row_claimed.append(product.id)
+                    if len(picked) < item.quantity:
+                        error = f"No available product {item.product_type} in store"
                     else:
-                        # Find available by type (legacy behavior)
-                        product = await self.product_repository.find_available_by_type(
-                            store_id=order_in.store_id, 
-                            product_type=item.product_type
+                        row_picks.append((item, picked))
+                if error:
+                    break
+            if error:
+                claimed.difference_update(row_claimed)
+                for key, product in reversed(row_popped):
+                    free[key].append(product)
+                fail(i, error)
+            else:
+                picks[i] = row_picks
+
+        valid = [i for i in range(len(orders)) if results[i].ok]
+        if not valid:
+            return results
+
+        # 3. Codes in blocks: one allocation per day for HĐ-, one per (type, day) for products
+        created_at = {i: self._order_created_at(orders[i]) for i in valid}
+        tx_codes = {}
+        # Days in order, so concurrent imports take their HĐ- counters in the same order
+        for day, indexes in sorted(self._group_by(valid, key=lambda i: created_at[i].date()).items()):
+            codes = await self._generate_transaction_codes(created_at[indexes[0]], count=len(indexes))
+            tx_codes.update(zip(indexes, codes))
+
+        new_lines = [(i, item) for i in valid for item in orders[i].items if item.is_new]
+        product_codes = {}
+        for (product_type, day), lines in self._group_by(new_lines, key=lambda line: (line[1].product_type, created_at[line[0]].date())).items():
+            codes = iter(await self.product_service.generate_product_codes(
+                product_type, created_at[lines[0][0]], count=sum(item.quantity for _, item in lines)
+            ))
+            for i, item in lines:
+                product_codes[(i, id(item))] = [next(codes) for _ in range(item.quantity)]
+
+        # 4. Stage everything and write it with one flush
+        stock_updates = []
+        staged = {}
+        for i in valid:
+            order_in = orders[i]
+            transaction = self._build_sale(order_in, created_at[i], tx_codes[i])
+            self.repository.db.add(transaction)
+            for item in order_in.items:
+                if item.is_new:
+                    products = [
+                        Product(
+                            product_type=item.product_type,
+                            product_code=code,
+                            status=ProductStatus.SOLD,
+                            last_price=item.price,
+                            store_id=order_in.store_id,
+                            is_ordered=False
                         )
-                        if not product:
-                            raise ValueError(f"No available product {item.product_type} in store")
-                    
-                    # Update status to SOLD
-                    update_schema = product_schemas.ProductUpdate(
-                        status=ProductStatus.SOLD,
-                        last_price=price
-                    )
-                    product = await self.product_repository.update(db_obj=product, obj_in=update_schema)
-
-                # Link Item
-                t_item = TransactionItem(
-                    transaction_id=transaction.id, 
-                    product_id=product.id, 
-                    price_at_time=price
-                )
-                await self.repository.add_transaction_item(t_item)
-        
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
-        
-        # Re-fetch to ensure all items are loaded
-        return await self.repository.get(id=transaction.id)
+                        for code in product_codes[(i, id(item))]
+                    ]
+                    self.repository.db.add_all(products)
+                else:
+                    products = next(ps for it, ps in picks[i] if it is item)
+                    stock_updates.extend({"id": p.id, "status": ProductStatus.SOLD, "last_price": item.price} for p in products)
+                self.repository.db.add_all([
+                    TransactionItem(transaction=transaction, product=product, price_at_time=item.price)
+                    for product in products
+                ])
+            staged[i] = transaction
 
-    async def create_manufacturer_order(self, order_in: transaction_schemas.ManufacturerOrderCreate) -> Transaction:
+        await self.repository.db.flush()
+        await self.product_repository.update_each(stock_updates)
+        await self.product_repository.record_sales([
+            row for transaction in staged.values() for row in self._sale_state_rows(transaction, transaction.items)
+        ])
+        self._touch(*staged.values())
+        await self._commit()
+
+        for i, transaction in staged.items():
+            results[i].id = transaction.id
+            results[i].transaction_code = transaction.transaction_code
+        return results
+
+    @staticmethod
+    def _group_by(values, key) -> dict:
+        groups = {}
+        for value in values:
+            groups.setdefault(key(value), []).append(value)
+        return groups
+
+    @unit_of_work
+    async def create_manufacturer_order(self, order_in: transaction_schemas.ManufacturerOrderCreate, minimal: bool = False) -> Transaction:
         # Handle timezone
         tx_created = order_in.created_at or datetime.now()
         if tx_created.tzinfo is not None:
@@ -177,6 +567,7 @@ class TransactionService:
         await self.repository.add_transaction(transaction)
         await self.repository.db.flush()
 
+        t_items = []
         for item in order_in.items:
             # Handle product_id (existing)
             if item.product_id:
@@ -190,42 +581,44 @@ class TransactionService:
                     "status": ProductStatus.ORDERED
                 }
                 update_schema = product_schemas.ProductUpdate(**update_data)
-                await self.product_repository.update(db_obj=product, obj_in=update_schema)
+                await self.product_repository.update(db_obj=product, obj_in=update_schema, commit=False)
                 
                 # Assume 1 existing product per item entry (quantity=1 for existing product)
-                t_item = TransactionItem(
+                t_items.append(TransactionItem(
                     transaction_id=transaction.id, 
                     product_id=product.id, 
                     price_at_time=item.manufacturer_price
-                )
-                await self.repository.add_transaction_item(t_item)
+                ))
 
             elif item.product_type:
-                # Handle product_type (new products)
-                qty = item.quantity
-                for i in range(qty):
-                    prod_in = product_schemas.ProductCreate(
+                # Handle product_type (new products), created in one batch per line
+                codes = await self.product_service.generate_product_codes(item.product_type, tx_created, count=item.quantity)
+                new_products = await self.product_repository.create_many([
+                    product_schemas.ProductCreate(
                         product_type=item.product_type,
-                        product_code=await self.product_service.generate_product_code(item.product_type, tx_created),
+                        product_code=code,
                         status=ProductStatus.AVAILABLE,  # Default new items to 'Có sẵn'
                         last_price=item.manufacturer_price,
                         store_id=order_in.store_id,
                         is_ordered=True  # Ordered from manufacturer
                     )
-                    new_product = await self.product_repository.create(prod_in)
-
-                    t_item = TransactionItem(
+                    for code in codes
+                ])
+                t_items.extend(
+                    TransactionItem(
                         transaction_id=transaction.id, 
                         product_id=new_product.id, 
                         price_at_time=item.manufacturer_price
                     )
-                    await self.repository.add_transaction_item(t_item)
+                    for new_product in new_products
+                )
 
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
-        return await self.repository.get(id=transaction.id)
+        await self.repository.add_transaction_items(t_items)
+        self._touch(transaction)
+        await self._commit()
+        return await self._write_response(transaction, t_items, minimal)
 
-    async def get_transactions_by_customer(self, customer_id: int, tx_type: str = None):
+    async def get_transactions_by_customer(self, customer_id: int, tx_type: str = None, fieldset: Fieldset = DEFAULT_FIELDSET):
         """Get all transactions for a customer, optionally filtered by type"""
         # Normalize tx_type so URL encoding (+ or %20 for space) matches DB enum value
         if tx_type:
@@ -237,22 +630,10 @@ class TransactionService:
                 tx_type = normalized
             else:
                 tx_type = normalized
-        transactions = await self.repository.get_by_customer(customer_id=customer_id, tx_type=tx_type)
-        
-        # Get linked statuses for sale transactions
-        sale_ids = [t.id for t in transactions if t.type == TransactionType.SALE]
-        if sale_ids:
-            status_map = await self.repository.get_linked_statuses(sale_ids)
+        return await self.repository.get_by_customer(customer_id=customer_id, tx_type=tx_type, fieldset=fieldset)
 
-            # Populate order_status and fulfillment_date for each transaction
-            for t in transactions:
-                if t.id in status_map:
-                    t.order_status = status_map[t.id]["status"]
-                    t.fulfillment_date = status_map[t.id]["fulfillment_date"]
-        
-        return transactions
-
-    async def create_buyback(self, buyback_in: transaction_schemas.BuybackCreate) -> Transaction:
+    @unit_of_work
+    async def create_buyback(self, buyback_in: transaction_schemas.BuybackCreate, minimal: bool = False) -> Transaction:
         """Create a buyback transaction - products become available again"""
         # Handle timezone
         tx_created = buyback_in.created_at or datetime.now()
@@ -260,14 +641,16 @@ class TransactionService:
             tx_created = tx_created.astimezone(None).replace(tzinfo=None)
 
         # Get original transaction to link and get customer
-        original_tx = await self.repository.get(id=buyback_in.original_transaction_id)
+        # Locked so a concurrent buyback/fulfillment of the same order waits and then sees its status
+        original_tx = await self.repository.get_plain(id=buyback_in.original_transaction_id, for_update=True)
         if not original_tx:
             raise ValueError(f"Original transaction {buyback_in.original_transaction_id} not found")
 
         # Check if already processed (buyback or fulfilled)
-        status_map = await self.repository.get_linked_statuses([original_tx.id])
-        if original_tx.id in status_map:
-            raise ValueError(f"Transaction {original_tx.id} has already been processed as {status_map[original_tx.id]}")
+        if original_tx.order_status:
+            raise ValueError(f"Transaction {original_tx.id} has already been processed as {original_tx.order_status}")
+
+        await self._lock_products([item.product_id for item in buyback_in.items])
 
         transaction = Transaction(
             type=TransactionType.BUYBACK,
@@ -282,32 +665,31 @@ class TransactionService:
         
         await self.repository.add_transaction(transaction)
         await self.repository.db.flush()
+        original_tx.order_status = ORDER_STATUS_BOUGHT_BACK
 
-        for item in buyback_in.items:
-            product = await self.product_repository.get(id=item.product_id)
-            if not product:
-                raise ValueError(f"Product ID {item.product_id} not found")
-            
-            # Update product: status back to available, update price
-            update_schema = product_schemas.ProductUpdate(
-                status=ProductStatus.AVAILABLE,
-                last_price=item.buyback_price
-            )
-            await self.product_repository.update(db_obj=product, obj_in=update_schema)
+        # Update products: status back to available, update price
+        await self.product_repository.update_each([
+            {"id": item.product_id, "status": ProductStatus.AVAILABLE, "last_price": item.buyback_price}
+            for item in buyback_in.items
+        ])
 
-            # Create transaction item with buyback price
-            t_item = TransactionItem(
+        # Create transaction items with buyback price
+        t_items = [
+            TransactionItem(
                 transaction_id=transaction.id,
-                product_id=product.id,
+                product_id=item.product_id,
                 price_at_time=item.buyback_price
             )
-            await self.repository.add_transaction_item(t_item)
+            for item in buyback_in.items
+        ]
+        await self.repository.add_transaction_items(t_items)
 
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
-        return await self.repository.get(id=transaction.id)
+        self._touch(transaction)
+        await self._commit()
+        return await self._write_response(transaction, t_items, minimal)
 
-    async def create_fulfillment(self, fulfillment_in: transaction_schemas.FulfillmentCreate):
+    @unit_of_work
+    async def create_fulfillment(self, fulfillment_in: transaction_schemas.FulfillmentCreate, minimal: bool = False):
         """Create a fulfillment transaction - delivering products to customer.
         
         This creates a fulfillment transaction linked to the original sale,
@@ -320,14 +702,16 @@ class TransactionService:
             tx_created = tx_created.astimezone(None).replace(tzinfo=None)
 
         # Get original transaction to link and get customer
-        original_tx = await self.repository.get(id=fulfillment_in.original_transaction_id)
+        # Locked so a concurrent buyback/fulfillment of the same order waits and then sees its status
+        original_tx = await self.repository.get_plain(id=fulfillment_in.original_transaction_id, for_update=True)
         if not original_tx:
             raise ValueError(f"Original transaction {fulfillment_in.original_transaction_id} not found")
 
         # Check if already processed (buyback or fulfilled)
-        status_map = await self.repository.get_linked_statuses([original_tx.id])
-        if original_tx.id in status_map:
-            raise ValueError(f"Transaction {original_tx.id} has already been processed as {status_map[original_tx.id]}")
+        if original_tx.order_status:
+            raise ValueError(f"Transaction {original_tx.id} has already been processed as {original_tx.order_status}")
+
+        products = await self._lock_products([item.product_id for item in fulfillment_in.items])
 
         transaction = Transaction(
             type=TransactionType.FULFILLMENT,
@@ -341,44 +725,44 @@ class TransactionService:
         
         await self.repository.add_transaction(transaction)
         await self.repository.db.flush()
+        original_tx.order_status = ORDER_STATUS_FULFILLED
+        original_tx.fulfillment_date = tx_created
 
-        for item in fulfillment_in.items:
-            product = await self.product_repository.get(id=item.product_id)
-            if not product:
-                raise ValueError(f"Product ID {item.product_id} not found")
-            
-            # Update product status to FULFILLED
-            update_schema = product_schemas.ProductUpdate(
-                status=ProductStatus.FULFILLED
-            )
-            await self.product_repository.update(db_obj=product, obj_in=update_schema)
-
-            # Create transaction item with the product's last price
-            t_item = TransactionItem(
+        # Create transaction items with the products' last price
+        t_items = [
+            TransactionItem(
                 transaction_id=transaction.id,
-                product_id=product.id,
-                price_at_time=product.last_price or 0
+                product_id=item.product_id,
+                price_at_time=products[item.product_id].last_price or 0
             )
-            await self.repository.add_transaction_item(t_item)
+            for item in fulfillment_in.items
+        ]
+        await self.repository.add_transaction_items(t_items)
 
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
-        return await self.repository.get(id=transaction.id)
+        # Update product status to FULFILLED
+        await self.product_repository.update_many(list(products), status=ProductStatus.FULFILLED)
+
+        self._touch(transaction)
+        await self._commit()
+        return await self._write_response(transaction, t_items, minimal)
 
-    async def create_sell_back(self, sell_back_in: transaction_schemas.SellBackCreate) -> Transaction:
+    @unit_of_work
+    async def create_sell_back(self, sell_back_in: transaction_schemas.SellBackCreate, minimal: bool = False) -> Transaction:
         """Create a sell-back transaction - products sold back to manufacturer"""
         tx_created = sell_back_in.created_at or datetime.now()
         if hasattr(tx_created, 'tzinfo') and tx_created.tzinfo is not None:
             tx_created = tx_created.astimezone(None).replace(tzinfo=None)
 
         # Get original manufacturer order transaction
-        original_tx = await self.repository.get(id=sell_back_in.original_transaction_id)
+        original_tx = await self.repository.get_plain(id=sell_back_in.original_transaction_id)
         if not original_tx:
             raise ValueError(f"Original transaction {sell_back_in.original_transaction_id} not found")
         
         if original_tx.type != TransactionType.MANUFACTURER:
             raise ValueError(f"Transaction {original_tx.id} is not a manufacturer order")
 
+        await self._lock_products([item.product_id for item in sell_back_in.items])
+
         transaction = Transaction(
             type=TransactionType.SELL_BACK_MFR,
             staff_id=sell_back_in.staff_id,
@@ -391,44 +775,44 @@ class TransactionService:
         await self.repository.add_transaction(transaction)
         await self.repository.db.flush()
 
-        for item in sell_back_in.items:
-            product = await self.product_repository.get(id=item.product_id)
-            if not product:
-                raise ValueError(f"Product ID {item.product_id} not found")
+        # Update product status to SOLD_BACK_MFR
+        await self.product_repository.update_each([
+            {"id": item.product_id, "status": ProductStatus.SOLD_BACK_MFR, "last_price": item.sell_back_price}
+            for item in sell_back_in.items
+        ])
 
-            # Update product status to SOLD_BACK_MFR
-            update_schema = product_schemas.ProductUpdate(
-                status=ProductStatus.SOLD_BACK_MFR,
-                last_price=item.sell_back_price
-            )
-            await self.product_repository.update(db_obj=product, obj_in=update_schema)
-
-            # Create transaction item with sell-back price
-            t_item = TransactionItem(
+        # Create transaction items with sell-back price
+        t_items = [
+            TransactionItem(
                 transaction_id=transaction.id,
-                product_id=product.id,
+                product_id=item.product_id,
                 price_at_time=item.sell_back_price
             )
-            await self.repository.add_transaction_item(t_item)
+            for item in sell_back_in.items
+        ]
+        await self.repository.add_transaction_items(t_items)
 
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
-        return await self.repository.get(id=transaction.id)
+        self._touch(transaction)
+        await self._commit()
+        return await self._write_response(transaction, t_items, minimal)
 
-    async def create_manufacturer_receive(self, receive_in: transaction_schemas.ManufacturerReceiveCreate) -> Transaction:
+    @unit_of_work
+    async def create_manufacturer_receive(self, receive_in: transaction_schemas.ManufacturerReceiveCreate, minimal: bool = False) -> Transaction:
         """Create a manufacturer receive transaction - products received from manufacturer"""
         tx_created = receive_in.created_at or datetime.now()
         if hasattr(tx_created, 'tzinfo') and tx_created.tzinfo is not None:
             tx_created = tx_created.astimezone(None).replace(tzinfo=None)
 
         # Get original manufacturer order transaction
-        original_tx = await self.repository.get(id=receive_in.original_transaction_id)
+        original_tx = await self.repository.get_plain(id=receive_in.original_transaction_id)
         if not original_tx:
             raise ValueError(f"Original transaction {receive_in.original_transaction_id} not found")
         
         if original_tx.type != TransactionType.MANUFACTURER:
             raise ValueError(f"Transaction {original_tx.id} is not a manufacturer order")
 
+        products = await self._lock_products([item.product_id for item in receive_in.items])
+
         transaction = Transaction(
             type=TransactionType.MANUFACTURER_RECEIVED,
             staff_id=receive_in.staff_id,
@@ -441,163 +825,129 @@ class TransactionService:
         await self.repository.add_transaction(transaction)
         await self.repository.db.flush()
 
-        for item in receive_in.items:
-            product = await self.product_repository.get(id=item.product_id)
-            if not product:
-                raise ValueError(f"Product ID {item.product_id} not found")
-
-            # Update product status to RECEIVED_FROM_MFR
-            # If price is provided, update it. Otherwise keep existing.
-            update_data = {
-                "status": ProductStatus.RECEIVED_FROM_MFR
-            }
-            if item.price is not None:
-                update_data["last_price"] = item.price
-                
-            update_schema = product_schemas.ProductUpdate(**update_data)
-            await self.product_repository.update(db_obj=product, obj_in=update_schema)
-
-            # Create transaction item with price (new price or existing)
-            price = item.price if item.price is not None else (product.last_price or 0)
-            t_item = TransactionItem(
+        # Create transaction items with price (new price or existing)
+        t_items = [
+            TransactionItem(
                 transaction_id=transaction.id,
-                product_id=product.id,
-                price_at_time=price
+                product_id=item.product_id,
+                price_at_time=item.price if item.price is not None else (products[item.product_id].last_price or 0)
             )
-            await self.repository.add_transaction_item(t_item)
-
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
-        return await self.repository.get(id=transaction.id)
-
-    async def create_swap(self, swap_in: transaction_schemas.SwapCreate) -> Transaction:
-        """Create an N-to-M swap transaction."""
+            for item in receive_in.items
+        ]
+        await self.repository.add_transaction_items(t_items)
+
+        # Update product status to RECEIVED_FROM_MFR
+        # If price is provided, update it. Otherwise keep existing.
+        await self.product_repository.update_each([
+            {"id": item.product_id, "status": ProductStatus.RECEIVED_FROM_MFR}
+            if item.price is None else
+            {"id": item.product_id, "status": ProductStatus.RECEIVED_FROM_MFR, "last_price": item.price}
+            for item in receive_in.items
+        ])
+        await self.product_repository.record_receipts([
+            {"product_id": item.product_id, "received_date": tx_created, "manufacturer_order_id": original_tx.id}
+            for item in receive_in.items
+        ])
+
+        self._touch(transaction)
+        await self._commit()
+        return await self._write_response(transaction, t_items, minimal)
+
+    @unit_of_work
+    async def create_swap(self, swap_in: transaction_schemas.SwapCreate, minimal: bool = False) -> Transaction:
+        """Create an N-to-M swap transaction.
+
+        Both groups and the active SALE items of their sold products are loaded up
+        front in two queries; the pairing is resolved in memory from SWAP_TRANSITIONS
+        and all re-links and status/store changes are written in bulk.
+        """
         tx_created = swap_in.created_at or datetime.now()
         if hasattr(tx_created, 'tzinfo') and tx_created.tzinfo is not None:
             tx_created = tx_created.astimezone(None).replace(tzinfo=None)
-        g1 = []
-        for pid in swap_in.product_ids_1:
-            p = await self.product_repository.get(id=pid)
-            if not p: raise ValueError(f"Product {pid} not found")
-            g1.append(p)
-            
-        g2 = []
-        for pid in swap_in.product_ids_2:
-            p = await self.product_repository.get(id=pid)
-            if not p: raise ValueError(f"Product {pid} not found")
-            g2.append(p)
+        if not swap_in.product_ids_1 or not swap_in.product_ids_2:
+            raise ValueError("Mỗi nhóm hoán đổi phải có ít nhất một sản phẩm.")
+
+        products = {p.id: p for p in await self.product_repository.get_many_for_update(
+            swap_in.product_ids_1 + swap_in.product_ids_2
+        )}
+        for pid in swap_in.product_ids_1 + swap_in.product_ids_2:
+            if pid not in products: raise ValueError(f"Product {pid} not found")
+        g1 = [products[pid] for pid in swap_in.product_ids_1]
+        g2 = [products[pid] for pid in swap_in.product_ids_2]
+
         def get_status(group):
-            if all(p.status == ProductStatus.SOLD for p in group): return ProductStatus.SOLD
-            if all(p.status == ProductStatus.AVAILABLE for p in group): return ProductStatus.AVAILABLE
-            if all(p.status == ProductStatus.ORDERED for p in group): return ProductStatus.ORDERED
-            if all(p.status == ProductStatus.RECEIVED_FROM_MFR for p in group): return ProductStatus.RECEIVED_FROM_MFR
+            statuses = {p.status for p in group}
+            if len(statuses) == 1 and statuses <= SWAPPABLE_STATUSES: return ProductStatus(statuses.pop())
             raise ValueError("Tất cả sản phẩm trong một nhóm phải có cùng trạng thái (Đã bán / Có sẵn / Đã đặt hàng / Đã nhận hàng NSX).")
         s1 = get_status(g1)
         s2 = get_status(g2)
+
+        # Normalize so that `a` is the group listed first in the transition table
+        if (s1, s2) in SWAP_TRANSITIONS:
+            a, b = g1, g2
+            links, exchange = SWAP_TRANSITIONS[(s1, s2)]
+        elif (s2, s1) in SWAP_TRANSITIONS:
+            a, b = g2, g1
+            links, exchange = SWAP_TRANSITIONS[(s2, s1)]
+        else:
+            raise ValueError("Hoán đổi chỉ hỗ trợ các trường hợp: Đã bán ↔ Có sẵn, Đã bán ↔ Đã bán, Đã đặt hàng ↔ Có sẵn, Đã đặt hàng ↔ Đã nhận hàng NSX, Đã bán ↔ Đã nhận hàng NSX, Đã nhận hàng NSX ↔ Đã nhận hàng NSX.")
+
+        # Resolve every sold -> incoming pairing against the pre-swap SALE items
+        pairings = [(a, b) if link == "ab" else (b, a) for link in links]
+        sale_items = await self.repository.get_active_sale_items(
+            [p.id for sold_group, _ in pairings for p in sold_group]
+        )
+
         customer_id = None
         linked_tx_id = None
-        async def link_and_swap_items(sold_group, incoming_group):
-            nonlocal customer_id, linked_tx_id
+        relinked_rows = []
+        dropped_item_ids = []
+        added_items = []
+        for sold_group, incoming_group in pairings:
             tx_items = []
-            sale_tx = None
             for p in sold_group:
-                tx_item = await self._get_active_sale_item(p.id)
+                tx_item = sale_items.get(p.id)
                 if not tx_item: raise ValueError(f"Không tìm thấy đơn hàng cho sản phẩm {p.id}")
                 tx_items.append(tx_item)
-                if not sale_tx:
-                    sale_tx = tx_item.transaction
-                    
-            if sale_tx:
-                customer_id = sale_tx.customer_id
-                linked_tx_id = sale_tx.id
+            sale_tx = tx_items[0].transaction
+            # Dropped/relinked items change the original sale's totals
+            await self._touch_existing(sale_tx)
+            customer_id = sale_tx.customer_id
+            linked_tx_id = sale_tx.id
+
             n = len(sold_group)
             m = len(incoming_group)
-            limit = max(n, m)
-            
-            for i in range(limit):
+            for i in range(max(n, m)):
                 if i < n and i < m:
                     # 1 to 1 Mapping
-                    tx_items[i].original_product_id = sold_group[i].id
-                    tx_items[i].product_id = incoming_group[i].id
-                    tx_items[i].swapped = True
-                    self.repository.db.add(tx_items[i])
-                elif i < n and i >= m:
+                    relinked_rows.append({
+                        "id": tx_items[i].id,
+                        "product_id": incoming_group[i].id,
+                        "original_product_id": sold_group[i].id,
+                        "swapped": True
+                    })
+                elif i < n:
                     # Excess old items
-                    await self.repository.db.delete(tx_items[i])
-                elif i >= n and i < m:
+                    dropped_item_ids.append(tx_items[i].id)
+                else:
                     # Excess new items
-                    new_t_item = TransactionItem(
+                    added_items.append(TransactionItem(
                         transaction_id=sale_tx.id,
                         product_id=incoming_group[i].id,
                         original_product_id=sold_group[0].id,
                         swapped=True,
                         price_at_time=incoming_group[i].last_price or 0
-                    )
-                    self.repository.db.add(new_t_item)
-        if s1 == ProductStatus.SOLD and s2 == ProductStatus.SOLD:
-            # Customer A <-> Customer B
-            await link_and_swap_items(g1, g2)
-            await link_and_swap_items(g2, g1)
-            # Store update: swap their store_ids to match their new owners? 
-            # Actually customer to customer doesn't change `status`
-            for p1, p2 in zip(g1, g2):
-                pass # Keep it simple, just update the store_id if needed
-                
-        elif s1 == ProductStatus.SOLD and s2 == ProductStatus.AVAILABLE:
-            # Customer returns g1, takes g2
-            await link_and_swap_items(g1, g2)
-            # Update statuses
-            for p in g1:
-                await self.product_repository.update(db_obj=p, obj_in=product_schemas.ProductUpdate(status=ProductStatus.AVAILABLE, store_id=g2[0].store_id))
-            for p in g2:
-                await self.product_repository.update(db_obj=p, obj_in=product_schemas.ProductUpdate(status=ProductStatus.SOLD, store_id=g1[0].store_id))
-                
-        elif s2 == ProductStatus.SOLD and s1 == ProductStatus.AVAILABLE:
-            # Customer returns g2, takes g1
-            await link_and_swap_items(g2, g1)
-            for p in g2:
-                await self.product_repository.update(db_obj=p, obj_in=product_schemas.ProductUpdate(status=ProductStatus.AVAILABLE, store_id=g1[0].store_id))
-            for p in g1:
-                await self.product_repository.update(db_obj=p, obj_in=product_schemas.ProductUpdate(status=ProductStatus.SOLD, store_id=g2[0].store_id))
-
-        elif s1 == ProductStatus.ORDERED and s2 == ProductStatus.AVAILABLE:
-            await link_and_swap_items(g1, g2)
-            for p in g1:
-                await self.product_repository.update(db_obj=p, obj_in=product_schemas.ProductUpdate(status=ProductStatus.AVAILABLE, store_id=g2[0].store_id))
-            for p in g2:
-                await self.product_repository.update(db_obj=p, obj_in=product_schemas.ProductUpdate(status=ProductStatus.ORDERED, store_id=g1[0].store_id))
-
-        elif s2 == ProductStatus.ORDERED and s1 == ProductStatus.AVAILABLE:
-            await link_and_swap_items(g2, g1)
-            for p in g2:
-                await self.product_repository.update(db_obj=p, obj_in=product_schemas.ProductUpdate(status=ProductStatus.AVAILABLE, store_id=g1[0].store_id))
-            for p in g1:
-                await self.product_repository.update(db_obj=p, obj_in=product_schemas.ProductUpdate(status=ProductStatus.ORDERED, store_id=g2[0].store_id))
-
-        elif s1 == ProductStatus.ORDERED and s2 == ProductStatus.RECEIVED_FROM_MFR:
-            await link_and_swap_items(g1, g2)
-            # No status changes — both products keep their original statuses
-
-        elif s2 == ProductStatus.ORDERED and s1 == ProductStatus.RECEIVED_FROM_MFR:
-            await link_and_swap_items(g2, g1)
-            # No status changes — both products keep their original statuses
-
-        elif s1 == ProductStatus.SOLD and s2 == ProductStatus.RECEIVED_FROM_MFR:
-            await link_and_swap_items(g1, g2)
-            # No status changes
-
-        elif s2 == ProductStatus.SOLD and s1 == ProductStatus.RECEIVED_FROM_MFR:
-            await link_and_swap_items(g2, g1)
-            # No status changes
-
-
-        elif s1 == ProductStatus.RECEIVED_FROM_MFR and s2 == ProductStatus.RECEIVED_FROM_MFR:
-            # Customer A <-> Customer B (both received from MFR)
-            await link_and_swap_items(g1, g2)
-            await link_and_swap_items(g2, g1)
+                    ))
+
+        await self.repository.update_items(relinked_rows)
+        await self.repository.delete_items(dropped_item_ids)
+
+        if exchange:
+            # The groups trade places: each takes the other's status and store
+            a_status, a_store_id = a[0].status, a[0].store_id
+            await self.product_repository.update_many([p.id for p in a], status=b[0].status, store_id=b[0].store_id)
+            await self.product_repository.update_many([p.id for p in b], status=a_status, store_id=a_store_id)
 
-        else:
-            raise ValueError("Hoán đổi chỉ hỗ trợ các trường hợp: Đã bán ↔ Có sẵn, Đã bán ↔ Đã bán, Đã đặt hàng ↔ Có sẵn, Đã đặt hàng ↔ Đã nhận hàng NSX, Đã bán ↔ Đã nhận hàng NSX, Đã nhận hàng NSX ↔ Đã nhận hàng NSX.")
         # Create SWAP transaction
         transaction = Transaction(
             type=TransactionType.SWAP,
@@ -609,52 +959,82 @@ class TransactionService:
             transaction_code=await self._generate_transaction_code(tx_created)
         )
         await self.repository.add_transaction(transaction)
-        await self.repository.db.flush()
-        for p in g1 + g2:
-            t_item = TransactionItem(
+        t_items = [
+            TransactionItem(
                 transaction_id=transaction.id,
                 product_id=p.id,
                 price_at_time=p.last_price or 0
             )
-            await self.repository.add_transaction_item(t_item)
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
-        return await self.repository.get(id=transaction.id)
+            for p in g1 + g2
+        ]
+        await self.repository.add_transaction_items(added_items + t_items)
+        # Sale items were re-linked: re-derive the current holder of every product involved
+        await self.product_repository.rebuild_states(list(products))
+        self._touch(transaction)
+        await self._commit()
+        return await self._write_response(transaction, t_items, minimal)
 
 
-    async def _get_active_sale_item(self, product_id: int):
-        """Find the most recent SALE transaction item for a product."""
-        from sqlalchemy import select as sa_select
-        stmt = sa_select(TransactionItem).join(Transaction).where(
-            TransactionItem.product_id == product_id,
-            Transaction.type == TransactionType.SALE
-        ).order_by(Transaction.created_at.desc()).limit(1)
-        result = await self.repository.db.execute(stmt)
-        return result.scalar_one_or_none()
+    async def _write_response(self, transaction: Transaction, items: List[TransactionItem], minimal: bool) -> Transaction:
+        """Return the just-committed transaction without re-reading it.
+
+        The response graph is wired from objects already in the session; with
+        `minimal` the caller only needs id/transaction_code, so nothing is loaded.
+        """
+        if minimal:
+            return transaction
+        return await self.repository.load_response_graph(transaction, items)
+
+    async def _record_sales(self, transaction: Transaction, items: List[TransactionItem]):
+        """Make `transaction` the latest sale of its products in product_states."""
+        await self.product_repository.record_sales(self._sale_state_rows(transaction, items))
+
+    @staticmethod
+    def _sale_state_rows(transaction: Transaction, items: List[TransactionItem]) -> List[dict]:
+        return [
+            {
+                "product_id": item.product_id,
+                "sale_transaction_id": transaction.id,
+                "customer_id": transaction.customer_id,
+                "sale_date": transaction.created_at,
+            }
+            for item in items
+        ]
+
+    async def _lock_products(self, product_ids: List[int]) -> dict:
+        """Load and lock all item products in one query; fail on the first missing id."""
+        products = {p.id: p for p in await self.product_repository.get_many_for_update(product_ids)}
+        for product_id in product_ids:
+            if product_id not in products:
+                raise ValueError(f"Product ID {product_id} not found")
+        return products
 
     async def _generate_transaction_code(self, created_at: datetime) -> str:
+        codes = await self._generate_transaction_codes(created_at, count=1)
+        return codes[0]
+
+    async def _generate_transaction_codes(self, created_at: datetime, count: int) -> List[str]:
         # Format: HĐ-dd-mm-yyyy-xxxxx
         date_str = created_at.strftime("%d-%m-%Y")
         prefix = f"HĐ-{date_str}-"
-        
-        stmt = select(Transaction.transaction_code).where(
-            Transaction.transaction_code.like(f"{prefix}%")
-        ).order_by(Transaction.transaction_code.desc()).limit(1)
-        
-        result = await self.repository.db.execute(stmt)
-        last_code = result.scalar_one_or_none()
-        
-        new_seq = 1
-        if last_code:
-            try:
-                parts = last_code.split('-')
-                new_seq = int(parts[-1]) + 1
-            except ValueError:
-                pass
-                
-        return f"{prefix}{new_seq:05d}"
-                
+        first_seq = await allocate_block(self.repository.db, prefix, count, Transaction.transaction_code)
+        return [f"{prefix}{seq:05d}" for seq in range(first_seq, first_seq + count)]
+
+    @unit_of_work
+    async def update_kc_status_batch(self, updates: List[transaction_schemas.KCStatusUpdate]) -> List[int]:
+        """Set delivered_to_kc for many orders: one UPDATE per flag value, one commit.
+
+        If an order appears more than once the last entry wins; unknown ids are skipped.
+        """
+        latest = {u.transaction_id: u.delivered_to_kc for u in updates}
+        updated_ids = []
+        for value in (True, False):
+            ids = [tid for tid, flag in latest.items() if flag is value]
+            updated_ids.extend(await self.repository.set_delivered_to_kc(ids, value))
+        await self.repository.commit()
+        return sorted(updated_ids)
 
+    @unit_of_work
     async def update_order(self, id: int, obj_in: transaction_schemas.OrderUpdate) -> Transaction:
         transaction = await self.repository.get(id=id)
         if not transaction:
@@ -668,14 +1048,20 @@ class TransactionService:
                   update_data["created_at"] = tx_created.astimezone(None).replace(tzinfo=None)
 
         # Update transaction primitive fields
+        # Its old contribution leaves daily_rollup and the new one is added, on whichever day
+        await self._touch_existing(transaction)
         for field in update_data:
              if hasattr(transaction, field):
                   setattr(transaction, field, update_data[field])
 
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
+        if transaction.type == TransactionType.SALE and {"customer_id", "created_at"} & update_data.keys():
+            # The sale's holder/date feed product_states
+            await self.product_repository.rebuild_states([item.product_id for item in transaction.items])
+
+        await self._commit()
         return transaction
     
+    @unit_of_work
     async def update_manufacturer_order(self, id: int, obj_in: transaction_schemas.ManufacturerOrderUpdate) -> Transaction:
         transaction = await self.repository.get(id=id)
         if not transaction:
@@ -691,10 +1077,11 @@ class TransactionService:
              if tx_created.tzinfo is not None:
                   update_data["created_at"] = tx_created.astimezone(None).replace(tzinfo=None)
 
+        # Its old contribution leaves daily_rollup and the new one is added, on whichever day
+        await self._touch_existing(transaction)
         for field in update_data:
              if hasattr(transaction, field):
                   setattr(transaction, field, update_data[field])
         
-        await self.repository.commit()
-        await self.repository.refresh(transaction)
+        await self._commit()
         return transaction
@@ -0,0 +1,49 @@
+"""Add order_status/fulfillment_date to transactions and backfill them from linked transactions."""
+import asyncio
+from sqlalchemy import select, text, update
+from app.db.models import Transaction, TransactionType
+from app.db.session import async_session_maker
+from app.modules.transactions.repository import TransactionRepository
+
+BATCH_SIZE = 1000
+
+async def backfill_order_status():
+    async with async_session_maker() as session:
+        print("Adding order_status columns to transactions...")
+        try:
+            await session.execute(text(
+                "ALTER TABLE transactions ADD COLUMN IF NOT EXISTS order_status VARCHAR;"
+            ))
+            await session.execute(text(
+                "ALTER TABLE transactions ADD COLUMN IF NOT EXISTS fulfillment_date TIMESTAMP WITHOUT TIME ZONE;"
+            ))
+            await session.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_transactions_type_order_status ON transactions (type, order_status);"
+            ))
+            print("  Added 'order_status' and 'fulfillment_date' columns.")
+
+            # Same resolution the list endpoints used to run per request
+            repository = TransactionRepository(session)
+            sale_ids = (await session.execute(
+                select(Transaction.id).where(Transaction.type == TransactionType.SALE).order_by(Transaction.id)
+            )).scalars().all()
+            updated = 0
+            for start in range(0, len(sale_ids), BATCH_SIZE):
+                status_map = await repository.get_linked_statuses(sale_ids[start:start + BATCH_SIZE])
+                rows = [
+                    {"id": tx_id, "order_status": status["status"], "fulfillment_date": status["fulfillment_date"]}
+                    for tx_id, status in status_map.items()
+                ]
+                if rows:
+                    await session.execute(update(Transaction), rows)
+                updated += len(rows)
+            print(f"  Backfilled {updated} of {len(sale_ids)} sales.")
+
+            await session.commit()
+            print("Done. Schema updated successfully.")
+        except Exception as e:
+            print(f"Error: {e}")
+            await session.rollback()
+
+if __name__ == "__main__":
+    asyncio.run(backfill_order_status())
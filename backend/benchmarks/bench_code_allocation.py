@@ -0,0 +1,72 @@
+"""Fire many simultaneous orders and check that no generated code collides.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_code_allocation [orders]
+
+Each order runs in its own session/connection, so on Postgres the writers really
+race on the code_sequences rows. On the SQLite fallback writers are serialized
+by the database lock, which still exercises the allocator end to end.
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime
+from sqlalchemy import select, func
+from app.db.models import Product, Transaction
+from app.modules.products.repository import ProductRepository
+from app.modules.products.service import ProductService
+from app.modules.transactions.repository import TransactionRepository
+from app.modules.transactions.service import TransactionService
+from app.modules.transactions import schemas as transaction_schemas
+from benchmarks.common import bench_database_url, make_engine, seed_parties
+
+
+async def place_order(session_maker, store, staff, customer, created_at):
+    async with session_maker() as session:
+        service = TransactionService(TransactionRepository(session), ProductService(ProductRepository(session)))
+        order_in = transaction_schemas.OrderCreate(
+            staff_id=staff.id, customer_id=customer.id, store_id=store.id, created_at=created_at,
+            items=[
+                transaction_schemas.OrderCreateItem(product_type="1 lượng", quantity=3, price=3400000),
+                transaction_schemas.OrderCreateItem(product_type="1 kg", quantity=1, price=82000000),
+            ]
+        )
+        await service.create_order(order_in)
+
+
+async def main(orders: int):
+    if bench_database_url().startswith("sqlite"):
+        engine_kwargs = {"connect_args": {"timeout": 60}}
+    else:
+        engine_kwargs = {"pool_size": 20, "max_overflow": 40}
+    engine, session_maker = await make_engine(**engine_kwargs)
+    async with session_maker() as session:
+        store, staff, customer = await seed_parties(session)
+
+    created_at = datetime.now()
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *[place_order(session_maker, store, staff, customer, created_at) for _ in range(orders)],
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - start
+    errors = [r for r in results if isinstance(r, Exception)]
+
+    async with session_maker() as session:
+        tx_codes = (await session.execute(select(func.count(Transaction.transaction_code), func.count(Transaction.transaction_code.distinct())))).one()
+        product_codes = (await session.execute(select(func.count(Product.product_code), func.count(Product.product_code.distinct())))).one()
+
+    print(f"orders: {orders} in {elapsed:.2f}s, errors: {len(errors)}")
+    for e in errors[:5]:
+        print(f"  {type(e).__name__}: {e}")
+    print(f"transaction codes: {tx_codes[0]} issued, {tx_codes[1]} distinct")
+    print(f"product codes:     {product_codes[0]} issued, {product_codes[1]} distinct")
+    collisions = (tx_codes[0] - tx_codes[1]) + (product_codes[0] - product_codes[1])
+    print("OK: zero collisions" if not errors and not collisions else "FAILED")
+
+    await engine.dispose()
+    if errors or collisions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
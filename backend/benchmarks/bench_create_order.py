@@ -0,0 +1,50 @@
+"""Per-order latency of TransactionService.create_order as quantity grows.
+
+Usage: python -m benchmarks.bench_create_order
+
+The statement column counts database round trips per order. On Postgres the
+product and item rows of a line go out as one multi-row INSERT ... RETURNING;
+SQLite cannot guarantee RETURNING order, so SQLAlchemy falls back to one
+INSERT per row there and the count grows with quantity.
+"""
+import asyncio
+import statistics
+import time
+from app.modules.products.repository import ProductRepository
+from app.modules.products.service import ProductService
+from app.modules.transactions.repository import TransactionRepository
+from app.modules.transactions.service import TransactionService
+from app.modules.transactions import schemas as transaction_schemas
+from benchmarks.common import make_engine, seed_parties, StatementCounter
+
+QUANTITIES = [1, 5, 10, 25, 50, 100]
+REPEATS = 5
+
+
+async def main():
+    engine, session_maker = await make_engine()
+    counter = StatementCounter(engine)
+    async with session_maker() as session:
+        store, staff, customer = await seed_parties(session)
+
+    print(f"{'qty':>5} {'median ms':>10} {'statements':>11}")
+    for qty in QUANTITIES:
+        timings = []
+        for _ in range(REPEATS):
+            async with session_maker() as session:
+                service = TransactionService(TransactionRepository(session), ProductService(ProductRepository(session)))
+                order_in = transaction_schemas.OrderCreate(
+                    staff_id=staff.id, customer_id=customer.id, store_id=store.id,
+                    items=[transaction_schemas.OrderCreateItem(product_type="1 kg", quantity=qty, price=82000000)]
+                )
+                counter.reset()
+                start = time.perf_counter()
+                await service.create_order(order_in)
+                timings.append((time.perf_counter() - start) * 1000)
+        print(f"{qty:>5} {statistics.median(timings):>10.2f} {counter.count:>11}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""Batch order import vs. one create_order call per row.
+
+Usage: python -m benchmarks.bench_order_import [rows]
+
+Imports `rows` orders (default 10,000) spread over a month through
+TransactionService.import_orders, then times a sample of the same orders
+through create_order and extrapolates. Every STOCK_EVERY-th row sells existing
+stock, alternately by product_id and by type (is_new=False), from a seeded
+inventory large enough for all of them. Point BENCH_DATABASE_URL at a local
+Postgres to see the multi-row INSERT path; on SQLite the import still saves
+the per-order commits and code allocations but inserts row by row.
+"""
+import asyncio
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from app.db.models import Product
+from app.modules.products.repository import ProductRepository
+from app.modules.products.service import ProductService
+from app.modules.transactions.repository import TransactionRepository
+from app.modules.transactions.service import TransactionService
+from app.modules.transactions import schemas as transaction_schemas
+from benchmarks.common import make_engine, seed_parties, StatementCounter
+
+SAMPLE = 200
+TYPES = ["1 lượng", "5 lượng", "1 kg"]
+STOCK_EVERY = 4
+
+
+def order_item(i: int, stock_ids: dict):
+    product_type = TYPES[i % len(TYPES)]
+    if stock_ids and i % STOCK_EVERY == 0:
+        if (i // STOCK_EVERY) % 2:
+            product_id = stock_ids[product_type].pop()
+            return transaction_schemas.OrderCreateItem(product_type=product_type, product_id=product_id, quantity=1, price=3400000, is_new=False)
+        return transaction_schemas.OrderCreateItem(product_type=product_type, quantity=1 + i % 3, price=3400000, is_new=False)
+    return transaction_schemas.OrderCreateItem(product_type=product_type, quantity=1 + i % 3, price=3400000)
+
+
+def build_orders(store, staff, customer, rows: int, stock_ids: dict = None):
+    """`rows` orders; with `stock_ids` (type -> ids), every STOCK_EVERY-th sells stock."""
+    start = datetime(2030, 1, 1, 9, 0)
+    stock_ids = {t: list(ids) for t, ids in stock_ids.items()} if stock_ids else None
+    return [
+        transaction_schemas.OrderCreate(
+            staff_id=staff.id, customer_id=customer.id, store_id=store.id,
+            created_at=start + timedelta(days=i % 30, seconds=i),
+            items=[order_item(i, stock_ids)]
+        )
+        for i in range(rows)
+    ]
+
+
+async def seed_stock(session, store, rows: int) -> dict:
+    """Enough AVAILABLE units of each type for every stock line of `rows` orders."""
+    per_type = rows // STOCK_EVERY + 1
+    products = [
+        Product(product_type=product_type, product_code=f"STOCK-{uuid.uuid4()}", store_id=store.id)
+        for product_type in TYPES for _ in range(per_type)
+    ]
+    session.add_all(products)
+    await session.commit()
+    stock_ids = {product_type: [] for product_type in TYPES}
+    for p in products:
+        stock_ids[p.product_type].append(p.id)
+    return stock_ids
+
+
+async def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    engine, session_maker = await make_engine()
+    counter = StatementCounter(engine)
+    async with session_maker() as session:
+        store, staff, customer = await seed_parties(session)
+        stock_ids = await seed_stock(session, store, rows)
+    orders = build_orders(store, staff, customer, rows, stock_ids)
+
+    async with session_maker() as session:
+        service = TransactionService(TransactionRepository(session), ProductService(ProductRepository(session)))
+        counter.reset()
+        start = time.perf_counter()
+        results = await service.import_orders(orders)
+        batch_s = time.perf_counter() - start
+    print(f"import_orders: {rows} rows in {batch_s:.2f}s, {counter.count} statements, "
+          f"{sum(r.ok for r in results)} created")
+
+    sample = build_orders(store, staff, customer, SAMPLE)
+    async with session_maker() as session:
+        service = TransactionService(TransactionRepository(session), ProductService(ProductRepository(session)))
+        counter.reset()
+        start = time.perf_counter()
+        for order_in in sample:
+            await service.create_order(order_in, minimal=True)
+        single_s = (time.perf_counter() - start) * rows / SAMPLE
+    print(f"create_order loop: ~{single_s:.2f}s for {rows} rows "
+          f"(extrapolated from {SAMPLE}, ~{counter.count * rows // SAMPLE} statements)")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""Latency of the product work queues (pending-manufacturer, received-unassigned) over a large catalogue.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_product_queues [products]
+
+Seeds `products` products (default 1,000,000), each on one transaction of the rotating
+history, then settles all but one in QUEUE_EVERY: the rest are ordered from the
+manufacturer, and a further slice is marked received. Times the repository queues,
+which the partial indexes ix_products_pending_manufacturer / ix_products_received_from_mfr
+serve, next to the former NOT IN formulation of received-unassigned.
+"""
+import asyncio
+import statistics
+import sys
+import time
+from sqlalchemy import select, text
+from app.db.models import Product, ProductStatus, Transaction, TransactionItem, TransactionType
+from app.modules.products.repository import ProductRepository
+from benchmarks.common import make_engine, seed_history, seed_parties
+
+REPEATS = 5
+QUEUE_EVERY = 1000
+
+
+async def not_in_received_unassigned(session):
+    """received-unassigned as it was written before the NOT EXISTS rewrite."""
+    bought_back_ids = select(Transaction.linked_transaction_id).where(
+        Transaction.type == TransactionType.BUYBACK, Transaction.linked_transaction_id.isnot(None)
+    )
+    sold_product_ids = select(TransactionItem.product_id).join(
+        Transaction, TransactionItem.transaction_id == Transaction.id
+    ).where(Transaction.type == TransactionType.SALE, Transaction.id.notin_(bought_back_ids))
+    result = await session.execute(select(Product).where(
+        Product.status == ProductStatus.RECEIVED_FROM_MFR, Product.id.notin_(sold_product_ids)
+    ).order_by(Product.store_id, Product.product_type, Product.id))
+    return result.scalars().all()
+
+
+async def main(n: int):
+    engine, session_maker = await make_engine()
+    async with session_maker() as session:
+        store, staff, customer = await seed_parties(session)
+        await seed_history(session, n, store, staff, customer)
+        await session.execute(
+            text(f"UPDATE products SET is_ordered = true WHERE id % {QUEUE_EVERY} <> 0")
+        )
+        await session.execute(
+            text(f"UPDATE products SET status = :received WHERE id % {QUEUE_EVERY} = 1"),
+            {"received": ProductStatus.RECEIVED_FROM_MFR.value},
+        )
+        await session.commit()
+        await session.execute(text("ANALYZE"))
+        await session.commit()
+
+    queries = {
+        "pending_manufacturer": lambda s: ProductRepository(s).get_pending_manufacturer_order(),
+        "received_unassigned": lambda s: ProductRepository(s).get_received_unassigned(),
+        "received (NOT IN)": not_in_received_unassigned,
+    }
+    print(f"{'query':<22} {'rows':>6} {'median ms':>10}")
+    for name, query in queries.items():
+        timings = []
+        for _ in range(REPEATS):
+            async with session_maker() as session:
+                start = time.perf_counter()
+                rows = await query(session)
+                timings.append((time.perf_counter() - start) * 1000)
+        print(f"{name:<22} {len(rows):>6} {statistics.median(timings):>10.1f}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000))
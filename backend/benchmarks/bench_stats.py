@@ -0,0 +1,47 @@
+"""Latency and round trips of the stats endpoints' queries over a large history.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_stats [items]
+
+Seeds `items` transactions with one item each (default 1,000,000) over three
+years and builds daily_rollup from them, then times TransactionRepository.get_stats
+and get_financial_stats for a one-month and a full-range window, reporting the
+statements each issues.
+"""
+import asyncio
+import statistics
+import sys
+import time
+from datetime import timedelta
+from app.modules.transactions.repository import TransactionRepository
+from benchmarks.common import HISTORY_DAYS, HISTORY_START, StatementCounter, make_engine, seed_history, seed_parties
+
+REPEATS = 5
+
+
+async def main(n: int):
+    engine, session_maker = await make_engine()
+    counter = StatementCounter(engine)
+    async with session_maker() as session:
+        store, staff, customer = await seed_parties(session)
+        await seed_history(session, n, store, staff, customer)
+
+    end = HISTORY_START + timedelta(days=HISTORY_DAYS - 1)
+    windows = {"one month": (end - timedelta(days=29), end), "full range": (HISTORY_START, end)}
+    print(f"{'query':<20} {'window':<11} {'median ms':>10} {'statements':>11}")
+    for name in ("get_stats", "get_financial_stats"):
+        for label, (start_date, end_date) in windows.items():
+            timings = []
+            for _ in range(REPEATS):
+                async with session_maker() as session:
+                    repo = TransactionRepository(session)
+                    counter.reset()
+                    start = time.perf_counter()
+                    await getattr(repo, name)(start_date=start_date, end_date=end_date)
+                    timings.append((time.perf_counter() - start) * 1000)
+            print(f"{name:<20} {label:<11} {statistics.median(timings):>10.1f} {counter.count:>11}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000))
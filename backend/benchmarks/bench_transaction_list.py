@@ -0,0 +1,56 @@
+"""End-to-end latency of the transaction list: ORM graph (GET /) vs flat projections (GET /stream).
+
+Usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_transaction_list [transactions]
+
+Seeds `transactions` rows (default 100,000) with one item each, then requests the
+newest page at several page sizes through the ASGI app, so the timings include
+response-model validation and JSON encoding. Both paths must return the same bytes.
+"""
+import asyncio
+import statistics
+import sys
+import time
+from httpx import ASGITransport, AsyncClient
+from app.db.session import get_db
+from app.main import app
+from benchmarks.common import make_engine, seed_history, seed_parties
+
+PAGE_SIZES = [20, 100, 500]
+REPEATS = 5
+PATHS = {"orm": "/api/v1/transactions/", "stream": "/api/v1/transactions/stream"}
+
+
+async def main(n: int):
+    engine, session_maker = await make_engine()
+    async with session_maker() as session:
+        store, staff, customer = await seed_parties(session)
+        await seed_history(session, n, store, staff, customer)
+
+    async def bench_db():
+        async with session_maker() as session:
+            yield session
+    app.dependency_overrides[get_db] = bench_db
+
+    print(f"{'page':>5} {'path':<7} {'median ms':>10} {'speedup':>8}")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://bench") as client:
+        for limit in PAGE_SIZES:
+            bodies = {}
+            medians = {}
+            for name, path in PATHS.items():
+                timings = []
+                for _ in range(REPEATS):
+                    start = time.perf_counter()
+                    response = await client.get(path, params={"limit": limit})
+                    timings.append((time.perf_counter() - start) * 1000)
+                bodies[name] = response.content
+                medians[name] = statistics.median(timings)
+            assert bodies["orm"] == bodies["stream"], f"responses differ at limit={limit}"
+            for name, median in medians.items():
+                print(f"{limit:>5} {name:<7} {median:>10.1f} {medians['orm'] / median:>7.2f}x")
+
+    app.dependency_overrides.clear()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000))
@@ -0,0 +1,122 @@
+"""Shared helpers for the benchmark scripts.
+
+Benchmarks run against BENCH_DATABASE_URL (e.g. a scratch Postgres database)
+and fall back to a throwaway SQLite file. The schema is dropped and recreated,
+so never point BENCH_DATABASE_URL at a database holding real data.
+"""
+import os
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import date
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from app.db.base import Base
+from app.db.models import Store, Staff, Customer, TransactionType
+from app.modules.transactions.repository import TransactionRepository
+
+
+def bench_database_url() -> str:
+    url = os.getenv("BENCH_DATABASE_URL")
+    if url:
+        return url.replace("postgresql://", "postgresql+asyncpg://")
+    path = os.path.join(tempfile.gettempdir(), "silver_bench.db")
+    return f"sqlite+aiosqlite:///{path}"
+
+
+class StatementCounter:
+    """Counts statements (database round trips) issued through an engine."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+
+async def make_engine(**kwargs):
+    url = bench_database_url()
+    engine = create_async_engine(url, **kwargs)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    return engine, session_maker
+
+
+async def seed_parties(session: AsyncSession):
+    """Create one store, staff member and customer to hang orders on."""
+    store = Store(name=f"Bench Store {uuid.uuid4()}", location="Bench", phone_number="000")
+    staff = Staff(staff_name="Bench Staff", username=f"bench_{uuid.uuid4()}", role="staff")
+    customer = Customer(name="Bench Customer", cccd=str(uuid.uuid4()), phone_number="000")
+    session.add_all([store, staff, customer])
+    await session.commit()
+    return store, staff, customer
+
+
+HISTORY_DAYS = 3 * 365
+HISTORY_START = date(2028, 1, 1)
+_TYPES = [t.value for t in TransactionType]
+_PAYMENT_METHODS = ["cash", "bank_transfer", "mixed"]
+
+# generate_series on Postgres, a recursive CTE on SQLite
+_SERIES = {
+    "postgresql": "SELECT generate_series(1, :n) AS i",
+    "sqlite": "WITH RECURSIVE s(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM s WHERE i < :n) SELECT i FROM s",
+}
+
+
+def _pick(dialect: str, values: list) -> str:
+    """SQL expression choosing values[i % len(values)] for series row i."""
+    if dialect == "postgresql":
+        quoted = ", ".join(f"'{v}'" for v in values)
+        return f"(ARRAY[{quoted}])[(i % {len(values)}) + 1]"
+    return "CASE i % {} {} END".format(len(values), " ".join(f"WHEN {k} THEN '{v}'" for k, v in enumerate(values)))
+
+
+async def seed_history(session: AsyncSession, n: int, store, staff, customer):
+    """Insert n transactions with one item each, set-based (no ORM), spread over HISTORY_DAYS.
+
+    Types and payment methods rotate through all values; most non-sale rows link to
+    the previous transaction so linked-flow queries have something to find.
+    """
+    dialect = session.get_bind().dialect.name
+    series = _SERIES[dialect]
+    created_expr = (
+        f"TIMESTAMP '{HISTORY_START}' + (i % {HISTORY_DAYS}) * INTERVAL '1 day' + (i % 86400) * INTERVAL '1 second'" if dialect == "postgresql"
+        else f"datetime('{HISTORY_START}', '+' || (i % {HISTORY_DAYS}) || ' days', '+' || (i % 86400) || ' seconds')"
+    )
+    await session.execute(text(
+        "INSERT INTO products (id, product_type, status, store_id, is_ordered, is_delivered) "
+        f"SELECT i, '1 lượng', 'Đã bán', {store.id}, false, false FROM ({series}) s"
+    ), {"n": n})
+    await session.execute(text(
+        "INSERT INTO transactions (id, type, customer_id, staff_id, store_id, created_at, linked_transaction_id, "
+        "payment_method, cash_amount, bank_transfer_amount, delivered_to_kc) "
+        f"SELECT i, {_pick(dialect, _TYPES)}, {customer.id}, {staff.id}, {store.id}, {created_expr}, "
+        f"CASE WHEN i > 1 AND i % {len(_TYPES)} <> 0 THEN i - 1 END, {_pick(dialect, _PAYMENT_METHODS)}, "
+        f"1000000, 2400000, false FROM ({series}) s"
+    ), {"n": n})
+    await session.execute(text(
+        f"INSERT INTO transaction_items (id, transaction_id, product_id, price_at_time, swapped) SELECT i, i, i, 3400000, false FROM ({series}) s"
+    ), {"n": n})
+    if dialect == "postgresql":
+        for table in ("products", "transactions", "transaction_items"):
+            await session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), :n)"), {"n": n})
+    # Rows inserted behind the service's back: bring the stats rollup in line
+    await TransactionRepository(session).refresh_daily_rollup()
+    await session.commit()
+    await session.execute(text("ANALYZE"))
+    await session.commit()
+
+
+@asynccontextmanager
+async def timed(results: list, label):
+    start = time.perf_counter()
+    yield
+    results.append((label, (time.perf_counter() - start) * 1000))
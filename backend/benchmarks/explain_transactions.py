@@ -0,0 +1,78 @@
+"""Check that the hot transaction queries are planned as index scans.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.explain_transactions [transactions]
+
+Seeds `transactions` rows (default 1,000,000) with one item each, spread over
+three years and all transaction types, then runs the repository's list, stats,
+financial-stats and linked-status queries. Every statement they issue is
+captured and re-run under EXPLAIN (EXPLAIN QUERY PLAN on SQLite); the check
+fails if any plan scans transactions or transaction_items sequentially.
+"""
+import asyncio
+import re
+import sys
+from datetime import timedelta
+from sqlalchemy import event
+from app.db.models import TransactionType
+from app.modules.transactions.repository import TransactionRepository
+from benchmarks.common import HISTORY_DAYS, HISTORY_START, make_engine, seed_history, seed_parties
+
+SEQ_SCAN = {
+    "postgresql": re.compile(r"Seq Scan on (transactions|transaction_items)\b"),
+    "sqlite": re.compile(r"\bSCAN (transactions|transaction_items)\b(?! USING)"),
+}
+
+
+async def main(n: int):
+    engine, session_maker = await make_engine()
+    dialect = engine.dialect.name
+    async with session_maker() as session:
+        store, staff, customer = await seed_parties(session)
+        await seed_history(session, n, store, staff, customer)
+
+    captured = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+    event.listen(engine.sync_engine, "before_cursor_execute", capture)
+
+    end = HISTORY_START + timedelta(days=HISTORY_DAYS - 1)
+    month = (end - timedelta(days=29), end)
+    checks = {}
+    async with session_maker() as session:
+        repo = TransactionRepository(session)
+        queries = {
+            "list (newest page)": lambda: repo.get_multi(limit=50),
+            "list (sale, one month)": lambda: repo.get_multi(limit=50, tx_type=TransactionType.SALE.value, start_date=month[0], end_date=month[1]),
+            "stats (one month)": lambda: repo.get_stats(start_date=month[0], end_date=month[1]),
+            "financial stats (one month)": lambda: repo.get_financial_stats(start_date=month[0], end_date=month[1]),
+            "linked statuses (100 orders)": lambda: repo.get_linked_statuses(list(range(n - 1000, n - 900))),
+        }
+        for label, run in queries.items():
+            captured.clear()
+            await run()
+            checks[label] = list(captured)
+            session.expunge_all()
+    event.remove(engine.sync_engine, "before_cursor_execute", capture)
+
+    explain = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    failures = 0
+    async with engine.connect() as conn:
+        for label, statements in checks.items():
+            print(f"== {label}")
+            for statement, parameters in statements:
+                result = await conn.exec_driver_sql(explain + statement, parameters)
+                plan = "\n".join(" | ".join(str(c) for c in row) for row in result.all())
+                bad = SEQ_SCAN[dialect].search(plan)
+                failures += bool(bad)
+                print(("  SEQ SCAN  " if bad else "  ok        ") + " ".join(statement.split())[:100])
+                if bad:
+                    print("    " + plan.replace("\n", "\n    "))
+
+    print("OK: all hot queries use indexes" if not failures else f"FAILED: {failures} statement(s) scan a whole table")
+    await engine.dispose()
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000))
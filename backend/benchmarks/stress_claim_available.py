@@ -0,0 +1,87 @@
+"""Many simultaneous sales of existing stock against a small inventory.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.stress_claim_available [sales] [stock]
+
+Each sale runs in its own session and asks for QTY units of one type with
+is_new=False, so create_order claims them via ProductRepository.claim_available
+(FOR UPDATE SKIP LOCKED). There is less stock than demand: the check is that no
+product ends up on two sales, every sold product is SOLD, and sales that lose
+the race fail cleanly with "No available product" rather than an error or a
+lock wait. Claims take their candidates from the availability index, loaded after
+seeding, which must still match the database at the end. SQLite has no row locks; there the writers are serialized by the
+database lock, which still exercises the allocator end to end.
+"""
+import asyncio
+import sys
+import time
+import uuid
+from sqlalchemy import select, func
+from app.core.availability import availability_index
+from app.db.models import Product, ProductStatus, TransactionItem
+from app.modules.products.repository import ProductRepository
+from app.modules.products.service import ProductService
+from app.modules.transactions.repository import TransactionRepository
+from app.modules.transactions.service import TransactionService
+from app.modules.transactions import schemas as transaction_schemas
+from benchmarks.common import bench_database_url, make_engine, seed_parties
+
+PRODUCT_TYPE = "5 lượng"
+QTY = 2
+
+
+async def sell(session_maker, store, staff, customer):
+    async with session_maker() as session:
+        service = TransactionService(TransactionRepository(session), ProductService(ProductRepository(session)))
+        order_in = transaction_schemas.OrderCreate(
+            staff_id=staff.id, customer_id=customer.id, store_id=store.id,
+            items=[transaction_schemas.OrderCreateItem(product_type=PRODUCT_TYPE, quantity=QTY, price=17000000, is_new=False)]
+        )
+        await service.create_order(order_in, minimal=True)
+
+
+async def main(sales: int, stock: int):
+    if bench_database_url().startswith("sqlite"):
+        engine_kwargs = {"connect_args": {"timeout": 60}}
+    else:
+        engine_kwargs = {"pool_size": 20, "max_overflow": 40}
+    engine, session_maker = await make_engine(**engine_kwargs)
+    async with session_maker() as session:
+        store, staff, customer = await seed_parties(session)
+        session.add_all([
+            Product(product_type=PRODUCT_TYPE, product_code=f"STOCK-{uuid.uuid4()}", store_id=store.id)
+            for _ in range(stock)
+        ])
+        await session.commit()
+        await availability_index.load(session)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[sell(session_maker, store, staff, customer) for _ in range(sales)], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    sold_out = [r for r in results if isinstance(r, ValueError) and "No available product" in str(r)]
+    errors = [r for r in results if isinstance(r, Exception) and r not in sold_out]
+    succeeded = sales - len(sold_out) - len(errors)
+
+    async with session_maker() as session:
+        item_rows, distinct_products = (await session.execute(
+            select(func.count(TransactionItem.id), func.count(TransactionItem.product_id.distinct()))
+        )).one()
+        sold = await session.scalar(select(func.count(Product.id)).where(Product.status == ProductStatus.SOLD))
+        drift = await availability_index.verify(session)
+
+    print(f"sales: {sales} x {QTY} units against {stock} in stock, {elapsed:.2f}s")
+    print(f"succeeded: {succeeded}, sold out: {len(sold_out)}, errors: {len(errors)}")
+    for e in errors[:5]:
+        print(f"  {type(e).__name__}: {e}")
+    print(f"items: {item_rows} for {distinct_products} distinct products, {sold} products SOLD")
+    print(f"availability index: {len(availability_index.pick(store.id, PRODUCT_TYPE, stock))} left, {drift} products differed from the database")
+    ok = not errors and item_rows == distinct_products == sold == succeeded * QTY and sold <= stock and not drift
+    print("OK: no double-sold products" if ok else "FAILED")
+
+    await engine.dispose()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    asyncio.run(main(*(args + [100, 60][len(args):])))
@@ -0,0 +1,20 @@
+"""Regenerate the daily_rollup table behind the stats endpoints from transaction history."""
+import asyncio
+from app.db.base import Base
+from app.db.models import DailyRollup
+from app.db.session import async_session_maker, engine
+from app.modules.transactions.repository import TransactionRepository
+
+async def rebuild_daily_rollup():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[DailyRollup.__table__])
+
+    async with async_session_maker() as session:
+        print("Rebuilding daily_rollup...")
+        # A failure propagates, so a deploy step running this fails visibly
+        await TransactionRepository(session).refresh_daily_rollup()
+        await session.commit()
+        print("Done. daily_rollup rebuilt successfully.")
+
+if __name__ == "__main__":
+    asyncio.run(rebuild_daily_rollup())
@@ -0,0 +1,20 @@
+"""Regenerate the product_states projection from transaction history."""
+import asyncio
+from app.db.base import Base
+from app.db.models import ProductState
+from app.db.session import async_session_maker, engine
+from app.modules.products.repository import ProductRepository
+
+async def rebuild_product_states():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[ProductState.__table__])
+
+    async with async_session_maker() as session:
+        print("Rebuilding product_states...")
+        # A failure propagates, so a deploy step running this fails visibly
+        await ProductRepository(session).rebuild_states()
+        await session.commit()
+        print("Done. product_states rebuilt successfully.")
+
+if __name__ == "__main__":
+    asyncio.run(rebuild_product_states())
@@ -5,8 +5,12 @@ from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from httpx import AsyncClient, ASGITransport
 from app.main import app
+from app.core.config import settings
 from app.db.base import Base
 from app.db.session import get_db
+from app.core.availability import availability_index
+from app.core.stats_cache import stats_cache
+from app.core.product_summary import product_summary
 
 # Use in-memory SQLite for testing as per requirements
 # Note: For production-like constraints (Foreign Keys), use Postgres test container
@@ -29,6 +33,19 @@ async def db_session(setup_db) -> AsyncGenerator[AsyncSession, None]:
     async with TestingSessionLocal() as session:
         yield session
 
+@pytest.fixture(autouse=True)
+def db_commit_metrics(monkeypatch):
+    # Tests check the X-DB-Commits header of write endpoints
+    monkeypatch.setattr(settings, "DB_COMMIT_METRICS", True)
+
+@pytest.fixture(autouse=True)
+def fresh_stats_cache(monkeypatch):
+    # Read-after-write assertions expect fresh stats; tests of stale serving raise max_stale
+    stats_cache.clear()
+    monkeypatch.setattr(stats_cache, "max_stale", 0.0)
+    product_summary.clear()
+    availability_index.clear()
+
 @pytest_asyncio.fixture
 async def client(db_session) -> AsyncGenerator[AsyncClient, None]:
     async def override_get_db():
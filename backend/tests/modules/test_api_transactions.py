@@ -0,0 +1,1225 @@
+import uuid
+from datetime import datetime
+import pytest
+from httpx import AsyncClient
+
+# --- Helpers ---
+async def create_parties(client: AsyncClient):
+    store = await client.post(
+        "/api/v1/stores/",
+        json={"name": f"Tx Store {uuid.uuid4()}", "location": "Loc", "phone_number": "123"}
+    )
+    staff = await client.post(
+        "/api/v1/staff/",
+        json={"staff_name": "Tx Staff", "username": f"tx_{uuid.uuid4()}", "password": "pw", "role": "staff"}
+    )
+    customer = await client.post(
+        "/api/v1/customers/",
+        json={"name": "Tx Customer", "cccd": str(uuid.uuid4()), "phone_number": "0909"}
+    )
+    return store.json()["id"], staff.json()["id"], customer.json()["id"]
+
+def indexed(store_id: int, product_type: str) -> int:
+    from app.core.availability import availability_index
+    return len(availability_index.pick(store_id, product_type, 1_000_000))
+
+# --- Order Tests ---
+@pytest.mark.asyncio
+async def test_create_order_bulk_products(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+
+    response = await client.post(
+        "/api/v1/transactions/order",
+        json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+            "created_at": "2031-01-05T10:00:00",
+            "items": [
+                {"product_type": "1 lượng", "quantity": 3, "price": 3400000},
+                {"product_type": "1 kg", "quantity": 2, "price": 82000000},
+            ]
+        }
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["transaction_code"] == "HĐ-05-01-2031-00001"
+    codes = sorted(item["product"]["product_code"] for item in data["items"])
+    assert codes == [
+        "1K-05-01-2031-00001", "1K-05-01-2031-00002",
+        "1L-05-01-2031-00001", "1L-05-01-2031-00002", "1L-05-01-2031-00003",
+    ]
+    assert all(item["product"]["status"] == "Đã bán" for item in data["items"])
+
+@pytest.mark.asyncio
+async def test_code_allocation_continues_existing_codes(client: AsyncClient, db_session):
+    from app.db.models import Product
+    store_id, staff_id, customer_id = await create_parties(client)
+
+    # A code issued before the counter row existed for this day
+    db_session.add(Product(product_type="1 lượng", product_code="1L-06-01-2031-00007", store_id=store_id))
+    await db_session.commit()
+
+    order = {
+        "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+        "created_at": "2031-01-06T09:00:00",
+        "items": [{"product_type": "1 lượng", "quantity": 2, "price": 3400000}]
+    }
+    first = (await client.post("/api/v1/transactions/order", json=order)).json()
+    second = (await client.post("/api/v1/transactions/order", json=order)).json()
+
+    assert sorted(i["product"]["product_code"] for i in first["items"]) == ["1L-06-01-2031-00008", "1L-06-01-2031-00009"]
+    assert sorted(i["product"]["product_code"] for i in second["items"]) == ["1L-06-01-2031-00010", "1L-06-01-2031-00011"]
+    assert (first["transaction_code"], second["transaction_code"]) == ("HĐ-06-01-2031-00001", "HĐ-06-01-2031-00002")
+
+@pytest.mark.asyncio
+async def test_failed_order_hands_its_codes_back(client: AsyncClient, monkeypatch):
+    from app.modules.products.repository import ProductRepository
+    store_id, staff_id, customer_id = await create_parties(client)
+    order = {
+        "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+        "created_at": "2031-07-09T09:00:00",
+        "items": [{"product_type": "1 lượng", "quantity": 2, "price": 3400000}]
+    }
+
+    # Fails after its codes were allocated: the rollback must return them to the counters
+    async def fail(self, objs_in):
+        raise ValueError("Product insert failed")
+    with monkeypatch.context() as patch:
+        patch.setattr(ProductRepository, "create_many", fail)
+        assert (await client.post("/api/v1/transactions/order", json=order)).status_code == 400
+
+    created = (await client.post("/api/v1/transactions/order", json=order)).json()
+    assert created["transaction_code"] == "HĐ-09-07-2031-00001"
+    assert sorted(i["product"]["product_code"] for i in created["items"]) == ["1L-09-07-2031-00001", "1L-09-07-2031-00002"]
+
+@pytest.mark.asyncio
+async def test_order_claims_existing_stock(client: AsyncClient, db_session):
+    from app.db.models import Product
+    store_id, staff_id, customer_id = await create_parties(client)
+    stock = [Product(product_type="1 kg", product_code=f"STOCK-{uuid.uuid4()}", store_id=store_id) for _ in range(3)]
+    db_session.add_all(stock)
+    await db_session.commit()
+
+    def order(qty):
+        return {
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+            "items": [{"product_type": "1 kg", "quantity": qty, "price": 82000000, "is_new": False}]
+        }
+
+    first = await client.post("/api/v1/transactions/order", json=order(2))
+    assert first.status_code == 200
+    assert sorted(i["product"]["id"] for i in first.json()["items"]) == sorted(p.id for p in stock[:2])
+    assert all(i["product"]["status"] == "Đã bán" for i in first.json()["items"])
+
+    # One unit left: a two-unit sale must fail without claiming it
+    short = await client.post("/api/v1/transactions/order", json=order(2))
+    assert short.status_code == 400
+    last = await client.post("/api/v1/transactions/order", json=order(1))
+    assert [i["product"]["id"] for i in last.json()["items"]] == [stock[2].id]
+
+@pytest.mark.asyncio
+async def test_import_orders_batch(client: AsyncClient, db_session):
+    from app.db.models import Product
+    store_id, staff_id, customer_id = await create_parties(client)
+    stock = Product(product_type="5 lượng", product_code=f"STOCK-{uuid.uuid4()}", store_id=store_id)
+    db_session.add(stock)
+    await db_session.commit()
+
+    def order(day, items):
+        return {"staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+                "created_at": f"2031-02-{day}T10:00:00", "items": items}
+
+    response = await client.post(
+        "/api/v1/transactions/order/batch",
+        json={"orders": [
+            order("01", [{"product_type": "1 lượng", "quantity": 2, "price": 3400000}]),
+            order("01", [{"product_type": "5 lượng", "quantity": 1, "price": 17000000, "is_new": False}]),
+            order("01", [{"product_type": "5 lượng", "quantity": 1, "price": 17000000, "is_new": False}]),
+            {**order("02", [{"product_type": "1 lượng", "quantity": 1, "price": 3400000}]), "customer_id": 999999},
+            order("02", [{"product_type": "1 lượng", "quantity": 1, "price": 3400000}]),
+        ]}
+    )
+    assert response.status_code == 200
+    assert response.headers["X-DB-Commits"] == "1"
+    data = response.json()
+    assert (data["created"], data["failed"]) == (3, 2)
+    results = data["results"]
+    assert [r["ok"] for r in results] == [True, True, False, False, True]
+    assert results[2]["error"] == "No available product 5 lượng in store"
+    assert results[3]["error"] == "Customer ID 999999 not found"
+    assert [results[i]["transaction_code"] for i in (0, 1, 4)] == [
+        "HĐ-01-02-2031-00001", "HĐ-01-02-2031-00002", "HĐ-02-02-2031-00001"
+    ]
+
+    first = (await client.get(f"/api/v1/transactions/{results[0]['id']}")).json()
+    assert sorted(i["product"]["product_code"] for i in first["items"]) == ["1L-01-02-2031-00001", "1L-01-02-2031-00002"]
+    second = (await client.get(f"/api/v1/transactions/{results[1]['id']}")).json()
+    assert [i["product"]["id"] for i in second["items"]] == [stock.id]
+    assert second["items"][0]["product"]["status"] == "Đã bán"
+
+@pytest.mark.asyncio
+async def test_import_orders_claims_each_stock_unit_once(client: AsyncClient, db_session):
+    from app.db.models import Product
+    store_id, staff_id, customer_id = await create_parties(client)
+    stock = [Product(product_type="1 kg", product_code=f"STOCK-{uuid.uuid4()}", store_id=store_id) for _ in range(2)]
+    db_session.add_all(stock)
+    await db_session.commit()
+
+    def order(items):
+        return {"staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+                "created_at": "2031-03-01T10:00:00", "items": items}
+
+    response = await client.post("/api/v1/transactions/order/batch", json={"orders": [
+        # One physical product cannot fill two units
+        order([{"product_id": stock[0].id, "product_type": "1 kg", "quantity": 2, "price": 82000000, "is_new": False}]),
+        # Fails on its second line: the unit it took by type goes back to the pool
+        order([{"product_type": "1 kg", "quantity": 1, "price": 82000000, "is_new": False},
+               {"product_id": 999999, "product_type": "1 kg", "quantity": 1, "price": 82000000, "is_new": False}]),
+        order([{"product_id": stock[0].id, "product_type": "1 kg", "quantity": 1, "price": 82000000, "is_new": False}]),
+        order([{"product_type": "1 kg", "quantity": 1, "price": 82000000, "is_new": False}]),
+        order([{"product_type": "1 kg", "quantity": 1, "price": 82000000, "is_new": False}]),
+    ]})
+    results = response.json()["results"]
+    assert [r["ok"] for r in results] == [False, False, True, True, False]
+    assert results[0]["error"] == f"Product ID {stock[0].id} is not available"
+    assert results[4]["error"] == "No available product 1 kg in store"
+    third = (await client.get(f"/api/v1/transactions/{results[3]['id']}")).json()
+    assert [i["product"]["id"] for i in third["items"]] == [stock[1].id]
+
+@pytest.mark.asyncio
+async def test_write_endpoints_commit_once(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+
+    order = await client.post(
+        "/api/v1/transactions/order",
+        json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+            "items": [{"product_type": "5 lượng", "quantity": 4, "price": 17000000}]
+        }
+    )
+    assert order.headers["X-DB-Commits"] == "1"
+    sale = order.json()
+
+    buyback = await client.post(
+        "/api/v1/transactions/buyback",
+        json={
+            "original_transaction_id": sale["id"], "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_id": i["product_id"], "buyback_price": 16000000} for i in sale["items"]]
+        }
+    )
+    assert buyback.status_code == 200
+    assert buyback.headers["X-DB-Commits"] == "1"
+
+    stats = (await client.get("/metrics/db-commits")).json()
+    assert stats["POST create_buyback"]["max_commits"] == 1
+
+@pytest.mark.asyncio
+async def test_db_commit_metrics_bounded_and_optional(client: AsyncClient, monkeypatch):
+    from app.core.config import settings
+    for path in ("/nope-1", "/nope-2"):
+        assert (await client.get(path)).status_code == 404
+    stats = (await client.get("/metrics/db-commits")).json()
+    assert "GET unmatched" in stats
+    assert not any("nope" in route for route in stats)
+
+    monkeypatch.setattr(settings, "DB_COMMIT_METRICS", False)
+    response = await client.get("/api/v1/stores/")
+    assert "X-DB-Commits" not in response.headers
+    assert (await client.get("/metrics/db-commits")).status_code == 404
+
+@pytest.mark.asyncio
+async def test_order_status_written_by_linked_transactions(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+    cccd = (await client.get(f"/api/v1/customers/{customer_id}")).json()["cccd"]
+    sales = [await create_sale(client, store_id, staff_id, customer_id, 1, f"2031-04-0{day}T10:00:00") for day in (1, 2, 3)]
+
+    fulfilled = await client.post(
+        "/api/v1/transactions/fulfillment",
+        json={
+            "original_transaction_id": sales[0]["id"], "staff_id": staff_id, "store_id": store_id,
+            "created_at": "2031-04-05T09:00:00",
+            "items": [{"product_id": i["product_id"]} for i in sales[0]["items"]]
+        }
+    )
+    assert fulfilled.headers["X-DB-Commits"] == "1"
+    await client.post(
+        "/api/v1/transactions/buyback",
+        json={
+            "original_transaction_id": sales[1]["id"], "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_id": i["product_id"], "buyback_price": 3000000} for i in sales[1]["items"]]
+        }
+    )
+    again = await client.post(
+        "/api/v1/transactions/buyback",
+        json={
+            "original_transaction_id": sales[0]["id"], "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_id": i["product_id"], "buyback_price": 3000000} for i in sales[0]["items"]]
+        }
+    )
+    assert again.status_code == 400
+    assert "Đã giao" in again.json()["detail"]
+
+    params = {"customer_search": cccd, "tx_type": "Đơn cọc"}
+    listed = {t["id"]: t for t in (await client.get("/api/v1/transactions/", params=params)).json()}
+    assert listed[sales[0]["id"]]["order_status"] == "Đã giao"
+    assert listed[sales[0]["id"]]["fulfillment_date"] == "2031-04-05T09:00:00"
+    assert listed[sales[1]["id"]]["order_status"] == "Mua lại"
+    assert listed[sales[2]["id"]]["order_status"] is None
+
+    open_orders = (await client.get("/api/v1/transactions/", params={**params, "order_status": "open"})).json()
+    assert [t["id"] for t in open_orders] == [sales[2]["id"]]
+    by_status = (await client.get("/api/v1/transactions/", params={**params, "sort": "order_status"})).json()
+    assert [t["id"] for t in by_status] == [sales[2]["id"], sales[1]["id"], sales[0]["id"]]
+
+    by_customer = (await client.get(f"/api/v1/transactions/customer/{customer_id}")).json()
+    assert {t["id"]: t["order_status"] for t in by_customer if t["type"] == "Đơn cọc"} == {
+        sales[0]["id"]: "Đã giao", sales[1]["id"]: "Mua lại", sales[2]["id"]: None
+    }
+
+@pytest.mark.asyncio
+async def test_failed_buyback_leaves_nothing_applied(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+    sale = (await client.post(
+        "/api/v1/transactions/order",
+        json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+            "items": [{"product_type": "1 lượng", "quantity": 1, "price": 3400000}]
+        }
+    )).json()
+    product_id = sale["items"][0]["product_id"]
+
+    response = await client.post(
+        "/api/v1/transactions/buyback",
+        json={
+            "original_transaction_id": sale["id"], "staff_id": staff_id, "store_id": store_id,
+            "items": [
+                {"product_id": product_id, "buyback_price": 3000000},
+                {"product_id": 999999, "buyback_price": 3000000},
+            ]
+        }
+    )
+    assert response.status_code == 400
+
+    product = (await client.get(f"/api/v1/products/{product_id}")).json()
+    assert product["status"] == "Đã bán"
+    assert product["last_price"] == 3400000
+
+@pytest.mark.asyncio
+async def test_manufacturer_receive_updates_items_as_batch(client: AsyncClient):
+    store_id, staff_id, _ = await create_parties(client)
+    mfr = (await client.post(
+        "/api/v1/transactions/manufacturer-order",
+        json={
+            "code": "NSX-1", "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_type": "1 lượng", "quantity": 5, "manufacturer_price": 3000000}]
+        }
+    )).json()
+    product_ids = [i["product_id"] for i in mfr["items"]]
+
+    response = await client.post(
+        "/api/v1/transactions/manufacturer-receive",
+        json={
+            "original_transaction_id": mfr["id"], "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_id": pid, "price": 3100000 if n % 2 else None} for n, pid in enumerate(product_ids)]
+        }
+    )
+    assert response.status_code == 200
+    received = response.json()
+    assert [i["price_at_time"] for i in received["items"]] == [3000000, 3100000, 3000000, 3100000, 3000000]
+    assert {i["product"]["status"] for i in received["items"]} == {"Đã nhận hàng NSX"}
+    assert [i["product"]["last_price"] for i in received["items"]] == [3000000, 3100000, 3000000, 3100000, 3000000]
+
+    missing = await client.post(
+        "/api/v1/transactions/manufacturer-receive",
+        json={
+            "original_transaction_id": mfr["id"], "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_id": product_ids[0]}, {"product_id": 999999}]
+        }
+    )
+    assert missing.status_code == 400
+    assert missing.json()["detail"] == "Product ID 999999 not found"
+
+# --- Swap Tests ---
+async def create_sale(client: AsyncClient, store_id, staff_id, customer_id, quantity, created_at=None):
+    response = await client.post(
+        "/api/v1/transactions/order",
+        json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id, "created_at": created_at,
+            "items": [{"product_type": "1 lượng", "quantity": quantity, "price": 3400000}]
+        }
+    )
+    return response.json()
+
+async def sale_product_ids(client: AsyncClient, sale_id):
+    sale = (await client.get(f"/api/v1/transactions/{sale_id}")).json()
+    return sorted(i["product_id"] for i in sale["items"])
+
+@pytest.mark.asyncio
+async def test_swap_sold_with_available(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+    sale = await create_sale(client, store_id, staff_id, customer_id, quantity=2)
+    sold_ids = [i["product_id"] for i in sale["items"]]
+    stock = (await client.post(
+        "/api/v1/transactions/manufacturer-order",
+        json={
+            "code": "NSX-SWAP", "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_type": "1 lượng", "quantity": 3, "manufacturer_price": 3000000}]
+        }
+    )).json()
+    stock_ids = [i["product_id"] for i in stock["items"]]
+
+    # Customer returns 2 bars and takes 3 from stock
+    response = await client.post(
+        "/api/v1/transactions/swap",
+        json={"product_ids_1": sold_ids, "product_ids_2": stock_ids, "staff_id": staff_id, "store_id": store_id}
+    )
+    assert response.status_code == 200
+    swap = response.json()
+    assert swap["type"] == "Hoán đổi"
+    assert swap["customer_id"] == customer_id
+    assert swap["linked_transaction_id"] == sale["id"]
+
+    assert await sale_product_ids(client, sale["id"]) == sorted(stock_ids)
+    for pid in sold_ids:
+        assert (await client.get(f"/api/v1/products/{pid}")).json()["status"] == "Có sẵn"
+    for pid in stock_ids:
+        assert (await client.get(f"/api/v1/products/{pid}")).json()["status"] == "Đã bán"
+
+@pytest.mark.asyncio
+async def test_swap_between_customers(client: AsyncClient):
+    store_id, staff_id, customer_a = await create_parties(client)
+    _, _, customer_b = await create_parties(client)
+    sale_a = await create_sale(client, store_id, staff_id, customer_a, quantity=2)
+    sale_b = await create_sale(client, store_id, staff_id, customer_b, quantity=1)
+    ids_a = sorted(i["product_id"] for i in sale_a["items"])
+    ids_b = [i["product_id"] for i in sale_b["items"]]
+
+    response = await client.post(
+        "/api/v1/transactions/swap",
+        json={"product_ids_1": ids_a, "product_ids_2": ids_b, "staff_id": staff_id, "store_id": store_id}
+    )
+    assert response.status_code == 200
+
+    # A's order now holds B's bar (the excess item is dropped); B's order holds both of A's bars
+    assert await sale_product_ids(client, sale_a["id"]) == ids_b
+    assert await sale_product_ids(client, sale_b["id"]) == ids_a
+
+@pytest.mark.asyncio
+async def test_swap_rejects_mixed_status_group(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+    sale = await create_sale(client, store_id, staff_id, customer_id, quantity=1)
+    stock = (await client.post(
+        "/api/v1/transactions/manufacturer-order",
+        json={
+            "code": "NSX-MIX", "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_type": "1 lượng", "quantity": 1, "manufacturer_price": 3000000}]
+        }
+    )).json()
+    mixed = [sale["items"][0]["product_id"], stock["items"][0]["product_id"]]
+
+    response = await client.post(
+        "/api/v1/transactions/swap",
+        json={"product_ids_1": mixed, "product_ids_2": mixed[1:], "staff_id": staff_id, "store_id": store_id}
+    )
+    assert response.status_code == 400
+
+# --- Write Response Tests ---
+@pytest.mark.asyncio
+async def test_write_response_minimal(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+    order = {
+        "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+        "items": [{"product_type": "1 lượng", "quantity": 2, "price": 3400000}]
+    }
+
+    minimal = await client.post("/api/v1/transactions/order?return=minimal", json=order)
+    assert minimal.status_code == 200
+    assert set(minimal.json()) == {"id", "transaction_code"}
+
+    full = (await client.post("/api/v1/transactions/order", json=order)).json()
+    assert full["customer"]["id"] == customer_id
+    assert full["store"]["id"] == store_id
+    assert full["staff"]["id"] == staff_id
+    assert len(full["items"]) == 2
+    assert all(i["product"]["store"]["id"] == store_id for i in full["items"])
+    assert full == (await client.get(f"/api/v1/transactions/{full['id']}")).json()
+
+# --- Idempotency Tests ---
+@pytest.mark.asyncio
+async def test_idempotency_key_replays_stored_response(client: AsyncClient):
+    from app.core import idempotency
+    store_id, staff_id, customer_id = await create_parties(client)
+    order = {
+        "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+        "items": [{"product_type": "1 lượng", "quantity": 1, "price": 3400000}]
+    }
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    first = await client.post("/api/v1/transactions/order", json=order, headers=headers)
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+
+    # Served from the LRU, then from the table once the process cache is gone
+    replay = await client.post("/api/v1/transactions/order", json=order, headers=headers)
+    idempotency.cache.clear()
+    from_table = await client.post("/api/v1/transactions/order", json=order, headers=headers)
+    for response in (replay, from_table):
+        assert response.status_code == 200
+        assert response.headers["Idempotent-Replayed"] == "true"
+        assert response.headers["X-DB-Commits"] == "0"
+        assert response.json() == first.json()
+
+    customer_sales = (await client.get(f"/api/v1/transactions/customer/{customer_id}")).json()
+    assert len(customer_sales) == 1
+
+    reused = await client.post("/api/v1/transactions/order", json={**order, "store_id": store_id + 1000}, headers=headers)
+    assert reused.status_code == 422
+
+@pytest.mark.asyncio
+async def test_idempotency_key_concurrent_duplicate_waits(client: AsyncClient):
+    import asyncio
+    store_id, staff_id, customer_id = await create_parties(client)
+    order = {
+        "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+        "items": [{"product_type": "5 lượng", "quantity": 2, "price": 17000000}]
+    }
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    responses = await asyncio.gather(*[
+        client.post("/api/v1/transactions/order", json=order, headers=headers) for _ in range(3)
+    ])
+    assert {r.status_code for r in responses} == {200}
+    assert len({r.json()["id"] for r in responses}) == 1
+    assert sum(r.headers.get("Idempotent-Replayed") == "true" for r in responses) == 2
+
+@pytest.mark.asyncio
+async def test_idempotency_key_save_failure_and_expiry(client: AsyncClient, db_session, monkeypatch):
+    from datetime import timedelta
+    from app.core import idempotency
+    store_id, staff_id, customer_id = await create_parties(client)
+    order = {
+        "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+        "items": [{"product_type": "1 lượng", "quantity": 1, "price": 3400000}]
+    }
+
+    # The order committed: a failure to store its response must not turn it into a 500
+    async def broken_save(*args):
+        raise RuntimeError("idempotency table unavailable")
+    with monkeypatch.context() as m:
+        m.setattr(idempotency, "_save", broken_save)
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        first = await client.post("/api/v1/transactions/order", json=order, headers=headers)
+    assert first.status_code == 200
+    replay = await client.post("/api/v1/transactions/order", json=order, headers=headers)
+    assert replay.headers["Idempotent-Replayed"] == "true"
+
+    # Past KEY_TTL a key is forgotten, reusable, and purged
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    stored = await client.post("/api/v1/transactions/order", json=order, headers=headers)
+    monkeypatch.setattr(idempotency, "KEY_TTL", timedelta(0))
+    idempotency.cache.clear()
+    again = await client.post("/api/v1/transactions/order", json=order, headers=headers)
+    assert "Idempotent-Replayed" not in again.headers
+    assert again.json()["id"] != stored.json()["id"]
+    assert await idempotency.purge_expired(db_session) >= 1
+
+# --- Product State Tests ---
+@pytest.mark.asyncio
+async def test_product_states_follow_writes_and_match_rebuild(client: AsyncClient, db_session):
+    from sqlalchemy import select
+    from app.db.models import ProductState
+    from app.modules.products.repository import ProductRepository
+    store_id, staff_id, customer_id = await create_parties(client)
+    customer_name = (await client.get(f"/api/v1/customers/{customer_id}")).json()["name"]
+    code = f"NSX-{uuid.uuid4()}"
+    mfr = (await client.post(
+        "/api/v1/transactions/manufacturer-order",
+        json={
+            "code": code, "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_type": "1 lượng", "quantity": 2, "manufacturer_price": 3000000}]
+        }
+    )).json()
+    received_ids = [i["product_id"] for i in mfr["items"]]
+    await client.post(
+        "/api/v1/transactions/manufacturer-receive",
+        json={
+            "original_transaction_id": mfr["id"], "staff_id": staff_id, "store_id": store_id,
+            "created_at": "2031-05-02T08:00:00", "items": [{"product_id": pid} for pid in received_ids]
+        }
+    )
+    sale = await create_sale(client, store_id, staff_id, customer_id, 2, "2031-05-01T10:00:00")
+    sold_ids = await sale_product_ids(client, sale["id"])
+
+    # Sold ↔ received: the sale now holds received_ids[0] instead of sold_ids[0]
+    swap = await client.post(
+        "/api/v1/transactions/swap",
+        json={"product_ids_1": [sold_ids[0]], "product_ids_2": [received_ids[0]], "staff_id": staff_id, "store_id": store_id}
+    )
+    assert swap.status_code == 200
+
+    listed = (await client.get(f"/api/v1/transactions/{sale['id']}")).json()
+    assert sorted(i["product_id"] for i in listed["items"]) == sorted([received_ids[0], sold_ids[1]])
+    page = (await client.get("/api/v1/transactions/", params={"customer_search": customer_name, "tx_type": "Đơn cọc"})).json()
+    items = {i["product_id"]: i["product"] for t in page if t["id"] == sale["id"] for i in t["items"]}
+    assert items[received_ids[0]]["customer_name"] == customer_name
+    assert items[received_ids[0]]["received_date"] == "2031-05-02T08:00:00"
+    unassigned = (await client.get("/api/v1/products/received-unassigned")).json()
+    assert {p["id"]: p["transaction_code"] for p in unassigned if p["id"] in received_ids} == {received_ids[1]: code}
+
+    involved = received_ids + sold_ids
+    async def states():
+        rows = (await db_session.execute(select(ProductState).where(ProductState.product_id.in_(involved)).execution_options(populate_existing=True))).scalars().all()
+        return {r.product_id: (r.sale_transaction_id, r.customer_id, r.sale_date, r.received_date, r.manufacturer_order_id) for r in rows}
+    maintained = await states()
+    assert maintained[received_ids[0]][:2] == (sale["id"], customer_id)
+    assert sold_ids[0] not in maintained  # no longer on any sale
+    await ProductRepository(db_session).rebuild_states(involved)
+    await db_session.commit()
+    assert await states() == maintained
+
+@pytest.mark.asyncio
+async def test_product_states_rebuilt_when_empty(client: AsyncClient, db_session):
+    from sqlalchemy import delete, func, select
+    from app.db.models import ProductState
+    from app.modules.products.repository import ProductRepository
+    store_id, staff_id, customer_id = await create_parties(client)
+    sale = await create_sale(client, store_id, staff_id, customer_id, 2, "2031-05-03T10:00:00")
+    sold_ids = await sale_product_ids(client, sale["id"])
+
+    async def state_count():
+        return await db_session.scalar(select(func.count()).select_from(ProductState))
+    maintained = await state_count()
+    # A database that predates the table: products have history, product_states is empty
+    await db_session.execute(delete(ProductState))
+    await db_session.commit()
+    repository = ProductRepository(db_session)
+    assert await repository.ensure_states() is True
+    await db_session.commit()
+    assert await state_count() == maintained
+    assert await repository.ensure_states() is False
+
+    customer_name = (await client.get(f"/api/v1/customers/{customer_id}")).json()["name"]
+    page = (await client.get("/api/v1/transactions/", params={"customer_search": customer_name, "tx_type": "Đơn cọc"})).json()
+    names = {i["product_id"]: i["product"]["customer_name"] for t in page if t["id"] == sale["id"] for i in t["items"]}
+    assert names == dict.fromkeys(sold_ids, customer_name)
+
+# --- Bulk Flag Tests ---
+@pytest.mark.asyncio
+async def test_bulk_delivery_and_kc_flags(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+    sale = (await client.post(
+        "/api/v1/transactions/order",
+        json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+            "items": [{"product_type": "1 lượng", "quantity": 3, "price": 3400000}]
+        }
+    )).json()
+    product_ids = sorted(i["product"]["id"] for i in sale["items"])
+
+    delivered = await client.post(
+        "/api/v1/products/delivery-status/batch",
+        json={"updates": [
+            {"product_id": product_ids[0], "is_delivered": True},
+            {"product_id": product_ids[1], "is_delivered": True},
+            {"product_id": product_ids[2], "is_delivered": False},
+            {"product_id": 999999, "is_delivered": True},
+        ]}
+    )
+    assert delivered.status_code == 200
+    assert delivered.headers["X-DB-Commits"] == "1"
+    assert delivered.json()["updated_ids"] == product_ids
+    sale = (await client.get(f"/api/v1/transactions/{sale['id']}")).json()
+    assert {i["product"]["id"]: i["product"]["is_delivered"] for i in sale["items"]} == {
+        product_ids[0]: True, product_ids[1]: True, product_ids[2]: False
+    }
+
+    kc = await client.post(
+        "/api/v1/transactions/delivered-to-kc/batch",
+        json={"updates": [{"transaction_id": sale["id"], "delivered_to_kc": True}, {"transaction_id": 999999, "delivered_to_kc": False}]}
+    )
+    assert kc.headers["X-DB-Commits"] == "1"
+    assert kc.json() == {"ok": True, "updated_count": 1, "updated_ids": [sale["id"]]}
+    assert (await client.get(f"/api/v1/transactions/{sale['id']}")).json()["delivered_to_kc"] is True
+
+# --- Listing Tests ---
+@pytest.mark.asyncio
+async def test_list_transactions_cursor_pagination(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+    cccd = (await client.get(f"/api/v1/customers/{customer_id}")).json()["cccd"]
+    # Two orders share a timestamp, so the id tie-breaker matters
+    for created_at in ["2031-03-01T10:00:00", "2031-03-02T10:00:00", "2031-03-02T10:00:00", "2031-03-03T10:00:00", "2031-03-04T10:00:00"]:
+        await client.post(
+            "/api/v1/transactions/order",
+            json={
+                "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id, "created_at": created_at,
+                "items": [{"product_type": "1 lượng", "quantity": 1, "price": 3400000}]
+            }
+        )
+
+    params = {"customer_search": cccd, "limit": 2}
+    offset_ids = [t["id"] for t in (await client.get("/api/v1/transactions/", params={**params, "limit": 10})).json()]
+    assert len(offset_ids) == 5
+
+    cursor_ids, cursor = [], None
+    for _ in range(3):
+        page = await client.get("/api/v1/transactions/", params={**params, **({"cursor": cursor} if cursor else {})})
+        cursor_ids += [t["id"] for t in page.json()]
+        cursor = page.headers.get("X-Next-Cursor")
+    assert cursor_ids == offset_ids
+    assert cursor is None
+
+    skip_page = await client.get("/api/v1/transactions/", params={**params, "skip": 2})
+    assert [t["id"] for t in skip_page.json()] == offset_ids[2:4]
+    assert (await client.get("/api/v1/transactions/", params={"cursor": "not-a-cursor"})).status_code == 400
+
+@pytest.mark.asyncio
+async def test_list_transactions_date_range_boundaries(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+    cccd = (await client.get(f"/api/v1/customers/{customer_id}")).json()["cccd"]
+    for created_at in ["2031-03-01T10:00:00", "2031-03-02T00:00:00", "2031-03-03T23:30:00", "2031-03-04T00:00:00"]:
+        await client.post(
+            "/api/v1/transactions/order",
+            json={
+                "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id, "created_at": created_at,
+                "items": [{"product_type": "1 lượng", "quantity": 1, "price": 3400000}]
+            }
+        )
+
+    # Date filters cover whole days: start_date from midnight, end_date up to its last minutes
+    listed = await client.get("/api/v1/transactions/", params={"customer_search": cccd, "start_date": "2031-03-02", "end_date": "2031-03-03"})
+    assert [t["created_at"] for t in listed.json()] == ["2031-03-03T23:30:00", "2031-03-02T00:00:00"]
+
+@pytest.mark.asyncio
+async def test_list_transactions_no_cursor_after_null_created_at(client: AsyncClient, db_session):
+    from sqlalchemy import update
+    from app.db.models import Transaction, TransactionType
+    from app.modules.transactions.service import TransactionService
+    store_id, staff_id, customer_id = await create_parties(client)
+    cccd = (await client.get(f"/api/v1/customers/{customer_id}")).json()["cccd"]
+    await client.post(
+        "/api/v1/transactions/order",
+        json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id, "created_at": "2031-03-05T10:00:00",
+            "items": [{"product_type": "1 lượng", "quantity": 1, "price": 3400000}]
+        }
+    )
+    # created_at has a column default, so the NULL is written afterwards
+    undated = Transaction(type=TransactionType.SALE, staff_id=staff_id, store_id=store_id, customer_id=customer_id)
+    db_session.add(undated)
+    await db_session.flush()
+    await db_session.execute(update(Transaction).where(Transaction.id == undated.id).values(created_at=None))
+    await db_session.commit()
+
+    db_session.expunge_all()
+    page = await client.get("/api/v1/transactions/stream", params={"customer_search": cccd, "limit": 2})
+    assert page.status_code == 200
+    assert [t["id"] for t in page.json()][-1] == undated.id
+    assert "X-Next-Cursor" not in page.headers
+    assert TransactionService.next_cursor([Transaction(id=undated.id, created_at=None)], 1) is None
+
+# --- Stats Tests ---
+@pytest.mark.asyncio
+async def test_stats_breakdowns(client: AsyncClient):
+    store_a, staff_id, customer_id = await create_parties(client)
+    store_b, _, _ = await create_parties(client)
+    stores = {s["id"]: s["name"] for s in (await client.get("/api/v1/stores/")).json()}
+
+    async def sale(store_id, day, payment_method, items):
+        await client.post("/api/v1/transactions/order", json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+            "created_at": f"2032-01-{day}T12:00:00", "payment_method": payment_method,
+            "items": [{"product_type": "1 lượng", "quantity": q, "price": p} for q, p in items]
+        })
+
+    await sale(store_a, "01", "cash", [(2, 100.0)])
+    await sale(store_a, "02", "bank_transfer", [(1, 50.0), (1, 25.0)])
+    await sale(store_b, "02", "cash", [(1, 10.0)])
+    await sale(store_b, "03", "cash", [])  # no items: counted as an order, not in the breakdowns
+    await sale(store_b, "04", "cash", [(1, 999.0)])  # outside the range
+
+    stats = (await client.get("/api/v1/transactions/stats", params={"start_date": "2032-01-01", "end_date": "2032-01-03"})).json()
+    assert stats["total_orders"] == 4
+    assert stats["total_revenue"] == 285.0
+    assert stats["payment_method_stats"] == {"cash": 210.0, "bank_transfer": 75.0}
+    assert stats["store_stats"] == sorted([
+        {"store_name": stores[store_a], "total_orders": 2, "revenue": 275.0},
+        {"store_name": stores[store_b], "total_orders": 1, "revenue": 10.0},
+    ], key=lambda s: s["store_name"])
+
+@pytest.mark.asyncio
+async def test_financial_stats_breakdown(client: AsyncClient):
+    store_id, staff_id, customer_id = await create_parties(client)
+
+    async def sale(payment_method, items, **amounts):
+        response = await client.post("/api/v1/transactions/order", json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+            "created_at": "2032-02-10T12:00:00", "payment_method": payment_method,
+            "items": [{"product_type": "1 lượng", "quantity": q, "price": p} for q, p in items], **amounts
+        })
+        return response.json()
+
+    await sale("cash", [(2, 100.0)])
+    await sale("bank_transfer", [(1, 50.0)])
+    mixed = await sale("mixed", [(1, 30.0), (1, 30.0)], cash_amount=40.0, bank_transfer_amount=20.0)
+    await client.post("/api/v1/transactions/buyback", json={
+        "original_transaction_id": mixed["id"], "staff_id": staff_id, "store_id": store_id,
+        "created_at": "2032-02-11T09:00:00",
+        "items": [{"product_id": i["product_id"], "buyback_price": 25.0} for i in mixed["items"]]
+    })
+
+    stats = (await client.get("/api/v1/transactions/financial-stats", params={"start_date": "2032-02-01", "end_date": "2032-02-28"})).json()
+    assert stats == {
+        "money_in": 310.0,
+        "money_in_breakdown": {
+            "customer_order": 310.0, "sell_to_mfr": 0.0,
+            "cash": 240.0,  # cash sale + mixed cash part
+            "bank_transfer": 70.0,  # bank sale + mixed bank part
+        },
+        "money_out": 50.0,
+        "money_out_breakdown": {"buy_back_customer": 50.0, "order_from_mfr": 0.0},
+    }
+
+@pytest.mark.asyncio
+async def test_daily_rollup_follows_order_edits_and_matches_rebuild(client: AsyncClient, db_session):
+    from sqlalchemy import select
+    from app.db.models import DailyRollup
+    from app.modules.transactions.repository import TransactionRepository
+    store_id, staff_id, customer_id = await create_parties(client)
+    order = (await client.post("/api/v1/transactions/order", json={
+        "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+        "created_at": "2032-03-01T12:00:00", "payment_method": "cash",
+        "items": [{"product_type": "1 lượng", "quantity": 1, "price": 70.0}]
+    })).json()
+
+    async def day_stats(day):
+        return (await client.get("/api/v1/transactions/stats", params={"start_date": day, "end_date": day})).json()
+    assert (await day_stats("2032-03-01"))["total_revenue"] == 70.0
+
+    response = await client.put(f"/api/v1/transactions/order/{order['id']}", json={
+        "created_at": "2032-03-05T09:00:00", "payment_method": "bank_transfer"
+    })
+    assert response.status_code == 200
+    assert (await day_stats("2032-03-01"))["total_orders"] == 0
+    moved = await day_stats("2032-03-05")
+    assert moved["total_orders"] == 1
+    assert moved["payment_method_stats"] == {"bank_transfer": 70.0}
+
+    async def rollup():
+        rows = (await db_session.execute(select(DailyRollup).execution_options(populate_existing=True))).scalars().all()
+        return sorted(
+            (r.day, r.store_id, r.staff_id, r.tx_type, r.payment_method, r.tx_count,
+             r.tx_with_items_count, r.item_total, r.cash_amount, r.bank_transfer_amount)
+            for r in rows
+        )
+    maintained = await rollup()
+    await TransactionRepository(db_session).refresh_daily_rollup()
+    await db_session.commit()
+    assert await rollup() == maintained
+
+@pytest.mark.asyncio
+async def test_daily_rollup_applies_deltas_and_backfills_when_empty(client: AsyncClient, db_session):
+    from sqlalchemy import delete
+    from app.core.stats_cache import stats_cache
+    from app.db.models import DailyRollup, Transaction, TransactionType
+    from app.modules.transactions.repository import TransactionRepository
+    store_id, staff_id, customer_id = await create_parties(client)
+
+    async def day_orders():
+        stats = await client.get("/api/v1/transactions/stats", params={"start_date": "2032-03-20", "end_date": "2032-03-20"})
+        return stats.json()["total_orders"]
+
+    # Written behind the service's back: a write on the same day only adds its own change
+    db_session.add(Transaction(type=TransactionType.SALE, staff_id=staff_id, store_id=store_id, created_at=datetime(2032, 3, 20, 9)))
+    await db_session.commit()
+    await client.post("/api/v1/transactions/order", json={
+        "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+        "created_at": "2032-03-20T12:00:00", "payment_method": "cash",
+        "items": [{"product_type": "1 lượng", "quantity": 1, "price": 70.0}]
+    })
+    assert await day_orders() == 1
+
+    # A database that predates the table: transactions exist, daily_rollup is empty
+    await db_session.execute(delete(DailyRollup))
+    await db_session.commit()
+    repository = TransactionRepository(db_session)
+    assert await repository.ensure_daily_rollup() is True
+    await db_session.commit()
+    stats_cache.clear()  # startup rebuilds before anything is cached
+    assert await day_orders() == 2
+    assert await repository.ensure_daily_rollup() is False
+
+@pytest.mark.asyncio
+async def test_stats_cache_invalidated_by_writes_and_served_stale(client: AsyncClient, monkeypatch):
+    from app.core.stats_cache import stats_cache
+    store_id, staff_id, customer_id = await create_parties(client)
+
+    async def sale(day, price):
+        await client.post("/api/v1/transactions/order", json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id,
+            "created_at": f"2032-04-{day}T12:00:00", "payment_method": "cash",
+            "items": [{"product_type": "1 lượng", "quantity": 1, "price": price}]
+        })
+
+    async def revenue(start, end):
+        params = {"start_date": f"2032-04-{start}", "end_date": f"2032-04-{end}"}
+        return (await client.get("/api/v1/transactions/stats", params=params)).json()["total_revenue"]
+
+    async def counters():
+        return (await client.get("/metrics/stats-cache")).json()
+
+    await sale("01", 10.0)
+    before = await counters()
+    assert await revenue("01", "10") == 10.0
+    assert await revenue("01", "10") == 10.0
+    assert await revenue("20", "30") == 0.0
+    after = await counters()
+    assert (after["misses"] - before["misses"], after["hits"] - before["hits"]) == (2, 1)
+
+    # A write outside a cached range leaves it fresh; one inside invalidates it
+    await sale("25", 5.0)
+    assert await revenue("01", "10") == 10.0
+    await sale("02", 20.0)
+    assert await revenue("01", "10") == 30.0
+
+    # Within max_stale the old value is served while a background task recomputes it
+    monkeypatch.setattr(stats_cache, "max_stale", 60.0)
+    await sale("03", 40.0)
+    before = await counters()
+    assert await revenue("01", "10") == 30.0
+    await stats_cache.drain()
+    assert await revenue("01", "10") == 70.0
+    after = await counters()
+    assert after["stale_hits"] - before["stale_hits"] == 1
+    assert after["refreshes"] - before["refreshes"] == 1
+
+@pytest.mark.asyncio
+async def test_stream_matches_orm_list(client: AsyncClient, db_session):
+    store_id, staff_id, customer_id = await create_parties(client)
+    mfr = (await client.post(
+        "/api/v1/transactions/manufacturer-order",
+        json={
+            "code": f"NSX-{uuid.uuid4()}", "staff_id": staff_id, "store_id": store_id, "created_at": "2032-05-01T08:00:00",
+            "items": [{"product_type": "1 lượng", "quantity": 2, "manufacturer_price": 3000000}]
+        }
+    )).json()
+    received_ids = [i["product_id"] for i in mfr["items"]]
+    await client.post(
+        "/api/v1/transactions/manufacturer-receive",
+        json={
+            "original_transaction_id": mfr["id"], "staff_id": staff_id, "store_id": store_id,
+            "created_at": "2032-05-02T08:00:00", "items": [{"product_id": pid} for pid in received_ids]
+        }
+    )
+    sale = await create_sale(client, store_id, staff_id, customer_id, 2, "2032-05-03T10:00:00")
+    sold_ids = await sale_product_ids(client, sale["id"])
+    await client.post(
+        "/api/v1/transactions/swap",
+        json={"product_ids_1": [sold_ids[0]], "product_ids_2": [received_ids[0]], "staff_id": staff_id, "store_id": store_id, "created_at": "2032-05-04T10:00:00"}
+    )
+    await client.post("/api/v1/transactions/buyback", json={
+        "original_transaction_id": sale["id"], "staff_id": staff_id, "store_id": store_id,
+        "created_at": "2032-05-05T09:00:00",
+        "items": [{"product_id": pid, "buyback_price": 3000000} for pid in await sale_product_ids(client, sale["id"])]
+    })
+    await create_sale(client, store_id, staff_id, customer_id, 1, "2032-05-06T10:00:00")  # still held: has customer_name
+
+    for params in (
+        {"start_date": "2032-05-01", "end_date": "2032-05-31"},
+        {"start_date": "2032-05-01", "end_date": "2032-05-31", "limit": 2},
+        {"customer_search": "Tx Customer", "start_date": "2032-05-01", "end_date": "2032-05-31", "sort": "order_status"},
+        {"tx_type": "Đơn cọc", "order_status": "Mua lại", "start_date": "2032-05-01"},
+    ):
+        db_session.expunge_all()  # each request normally gets a fresh session
+        orm = await client.get("/api/v1/transactions/", params=params)
+        db_session.expunge_all()
+        streamed = await client.get("/api/v1/transactions/stream", params=params)
+        assert streamed.status_code == 200
+        assert streamed.content == orm.content
+        assert streamed.headers.get("X-Next-Cursor") == orm.headers.get("X-Next-Cursor")
+    assert len(orm.json()) == 1 and orm.json()[0]["items"][0]["product"]["store"]["id"] == store_id
+    listed = (await client.get("/api/v1/transactions/stream", params={"start_date": "2032-05-06", "end_date": "2032-05-06"})).json()
+    assert listed[0]["items"][0]["product"]["customer_name"] == "Tx Customer"
+
+@pytest.mark.asyncio
+async def test_sparse_fields_and_includes(client: AsyncClient, db_session):
+    from sqlalchemy import event
+    store_id, staff_id, customer_id = await create_parties(client)
+    sale = await create_sale(client, store_id, staff_id, customer_id, 2, "2032-06-01T10:00:00")
+    params = {"start_date": "2032-06-01", "end_date": "2032-06-01"}
+
+    full = (await client.get("/api/v1/transactions/", params=params)).json()
+    assert set(full[0]) >= {"items", "customer", "store", "staff"}
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db_session.bind.sync_engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        codes = (await client.get("/api/v1/transactions/", params={**params, "fields": "transaction_code,created_at"})).json()
+        code_statements = len(statements)
+        statements.clear()
+        with_items = (await client.get("/api/v1/transactions/", params={**params, "fields": "transaction_code", "include": "items.product,customer"})).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert codes == [{"id": sale["id"], "created_at": "2032-06-01T10:00:00", "transaction_code": sale["transaction_code"]}]
+    assert code_statements == 1  # no relation queries
+    assert set(with_items[0]) == {"id", "transaction_code", "items", "customer"}
+    assert with_items[0]["customer"] == full[0]["customer"]
+    assert [set(i) for i in with_items[0]["items"]] == [{"product_id", "price_at_time", "id", "transaction_id", "swapped", "original_product_id", "product"}] * 2
+    assert not any("FROM staff" in s for s in statements)
+
+    customer_txs = (await client.get(f"/api/v1/transactions/customer/{customer_id}", params={"fields": "type"})).json()
+    assert customer_txs == [{"type": "Đơn cọc", "id": sale["id"]}]
+    assert (await client.get("/api/v1/transactions/", params={"fields": "nope"})).status_code == 400
+    assert (await client.get("/api/v1/transactions/", params={"include": "items.nope"})).status_code == 400
+
+    product_id = with_items[0]["items"][0]["product_id"]
+    products = (await client.get("/api/v1/products/", params={"limit": 1000, "fields": "product_code,customer_name", "include": "store"})).json()
+    product = next(p for p in products if p["id"] == product_id)
+    assert product["customer_name"] == "Tx Customer"
+    assert product["store"]["id"] == store_id
+    assert set(product) == {"id", "product_code", "customer_name", "store"}
+    default = (await client.get("/api/v1/products/", params={"limit": 1000})).json()
+    assert "customer_name" not in next(p for p in default if p["id"] == product_id)
+
+@pytest.mark.asyncio
+async def test_products_status_info(client: AsyncClient, db_session):
+    from sqlalchemy import event
+    store_id, staff_id, customer_id = await create_parties(client)
+    first = await create_sale(client, store_id, staff_id, customer_id, 2, "2032-07-01T10:00:00")
+    p1, p2 = await sale_product_ids(client, first["id"])
+    buyback = (await client.post("/api/v1/transactions/buyback", json={
+        "original_transaction_id": first["id"], "staff_id": staff_id, "store_id": store_id,
+        "created_at": "2032-07-02T10:00:00",
+        "items": [{"product_id": pid, "buyback_price": 3000000} for pid in (p1, p2)]
+    })).json()
+    second = await create_sale(client, store_id, staff_id, customer_id, 1, "2032-07-03T10:00:00")
+    [p3] = await sale_product_ids(client, second["id"])
+    swap = (await client.post("/api/v1/transactions/swap", json={
+        "product_ids_1": [p3], "product_ids_2": [p1], "staff_id": staff_id, "store_id": store_id,
+        "created_at": "2032-07-04T10:00:00"
+    })).json()
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db_session.bind.sync_engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = await client.post("/api/v1/products/status-info", json={"product_ids": [p3, p1, p2, 10**9]})
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert response.status_code == 200
+    assert len(statements) == 2
+
+    def info(tx, created_at, customer_name="Tx Customer"):
+        return {"transaction_code": tx["transaction_code"], "created_at": created_at, "customer_name": customer_name}
+    assert response.json() == [
+        # Swapped out of the second sale: no longer on any sale item
+        {"id": p3, "status": "Có sẵn", "buyback_info": None, "sale_info": None,
+         "swap_info": info(swap, "2032-07-04T10:00:00", "Hoán đổi")},
+        # Swapped into the second sale: sold again, so the earlier buyback is not current
+        {"id": p1, "status": "Đã bán", "buyback_info": None, "sale_info": info(second, "2032-07-03T10:00:00"), "swap_info": None},
+        {"id": p2, "status": "Có sẵn", "buyback_info": info(buyback, "2032-07-02T10:00:00"),
+         "sale_info": info(first, "2032-07-01T10:00:00"), "swap_info": None},
+    ]
+
+@pytest.mark.asyncio
+async def test_product_lists_use_latest_transaction_only(client: AsyncClient, db_session):
+    from sqlalchemy import event
+    store_id, staff_id, customer_id = await create_parties(client)
+    first = await create_sale(client, store_id, staff_id, customer_id, 2, "2032-08-01T10:00:00")
+    p1, p2 = await sale_product_ids(client, first["id"])
+    buyback = (await client.post("/api/v1/transactions/buyback", json={
+        "original_transaction_id": first["id"], "staff_id": staff_id, "store_id": store_id,
+        "created_at": "2032-08-02T10:00:00",
+        "items": [{"product_id": p1, "buyback_price": 3000000}]
+    })).json()
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db_session.bind.sync_engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        stock = (await client.get(f"/api/v1/products/store/{store_id}")).json()
+        pending = (await client.get("/api/v1/products/pending-manufacturer")).json()
+        listed = (await client.get("/api/v1/products/", params={"fields": "customer_name,order_date,store_name", "limit": 1000})).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    # Product rows plus Product.store for the first two; no transaction collection is loaded
+    assert len(statements) == 5
+    assert not any("JOIN transaction_items AS transaction_items_1" in s for s in statements)
+
+    assert [(p["id"], p["transaction_code"], p["order_date"]) for p in stock] == [
+        (p1, buyback["code"], "2032-08-02T10:00:00")
+    ]
+    p2_pending = next(p for p in pending if p["id"] == p2)
+    assert p2_pending["customer_name"] == "Tx Customer"
+    assert p2_pending["order_date"] == "2032-08-01T10:00:00"
+    assert p1 not in [p["id"] for p in pending]
+    sale_fields = {p["id"]: p for p in listed}
+    assert sale_fields[p2]["order_date"] == "2032-08-01T10:00:00"
+    assert sale_fields[p2]["customer_name"] == "Tx Customer"
+
+@pytest.mark.asyncio
+async def test_products_summary_snapshot_follows_writes(client: AsyncClient, db_session):
+    from sqlalchemy import event
+    store_id, staff_id, customer_id = await create_parties(client)
+    sale = await create_sale(client, store_id, staff_id, customer_id, 3, "2032-09-01T10:00:00")
+    p1, p2, p3 = await sale_product_ids(client, sale["id"])
+
+    async def summary():
+        response = await client.get("/api/v1/products/summary", params={"store_id": store_id})
+        assert response.status_code == 200
+        return {(g["product_type"], g["status"], g["is_ordered"]): (g["count"], g["total_value"]) for g in response.json()}
+
+    assert await summary() == {("1 lượng", "Đã bán", False): (3, 3 * 3400000)}
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db_session.bind.sync_engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        await summary()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert statements == []
+
+    # Bulk UPDATE statements on products invalidate the snapshot on commit
+    response = await client.post("/api/v1/transactions/buyback", json={
+        "original_transaction_id": sale["id"], "staff_id": staff_id, "store_id": store_id,
+        "created_at": "2032-09-02T10:00:00",
+        "items": [{"product_id": p1, "buyback_price": 3000000}]
+    })
+    assert response.status_code == 200
+    after_buyback = await summary()
+    assert after_buyback[("1 lượng", "Đã bán", False)][0] == 2
+    assert after_buyback[("1 lượng", "Có sẵn", False)][0] == 1
+
+    # So do flushed ORM changes
+    response = await client.put(f"/api/v1/products/{p2}", json={"is_ordered": True})
+    assert response.status_code == 200
+    assert (await summary())[("1 lượng", "Đã bán", True)][0] == 1
+
+    fresh = await client.get("/api/v1/products/summary", params={"store_id": store_id, "fresh": True})
+    cached = await client.get("/api/v1/products/summary", params={"store_id": store_id})
+    assert fresh.json() == cached.json()
+
+@pytest.mark.asyncio
+async def test_received_unassigned_ignores_items_without_product(client: AsyncClient, db_session):
+    from app.db.models import Transaction, TransactionItem, TransactionType
+    store_id, staff_id, customer_id = await create_parties(client)
+    mfr = (await client.post(
+        "/api/v1/transactions/manufacturer-order",
+        json={
+            "code": f"NSX-{uuid.uuid4()}", "staff_id": staff_id, "store_id": store_id,
+            "items": [{"product_type": "1 lượng", "quantity": 2, "manufacturer_price": 3000000}]
+        }
+    )).json()
+    received_ids = [i["product_id"] for i in mfr["items"]]
+    await client.post(
+        "/api/v1/transactions/manufacturer-receive",
+        json={"original_transaction_id": mfr["id"], "staff_id": staff_id, "store_id": store_id,
+              "items": [{"product_id": pid} for pid in received_ids]}
+    )
+    # A sale item with no product: NOT IN (..., NULL) would have emptied the queue
+    sale = Transaction(type=TransactionType.SALE, staff_id=staff_id, store_id=store_id, customer_id=customer_id)
+    db_session.add(sale)
+    await db_session.flush()
+    db_session.add(TransactionItem(transaction_id=sale.id, product_id=None, price_at_time=0))
+    await db_session.commit()
+
+    unassigned = (await client.get("/api/v1/products/received-unassigned")).json()
+    assert set(received_ids) <= {p["id"] for p in unassigned}
+
+@pytest.mark.asyncio
+async def test_availability_index_follows_stock_and_verifies(client: AsyncClient, db_session):
+    from sqlalchemy import event, text
+    from app.core.availability import availability_index
+    from app.db.models import Product
+    store_id, staff_id, customer_id = await create_parties(client)
+    other_store_id, _, _ = await create_parties(client)
+    await availability_index.load(db_session)
+    stock = [Product(product_type="1 kg", product_code=f"STOCK-{uuid.uuid4()}", store_id=store_id) for _ in range(3)]
+    db_session.add_all(stock)
+    await db_session.commit()
+    assert indexed(store_id, "1 kg") == 3
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db_session.bind.sync_engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        sale = (await client.post("/api/v1/transactions/order", json={
+            "staff_id": staff_id, "customer_id": customer_id, "store_id": store_id, "created_at": "2032-10-01T10:00:00",
+            "items": [{"product_type": "1 kg", "quantity": 2, "price": 82000000, "is_new": False}]
+        })).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    sold = sorted(i["product_id"] for i in sale["items"])
+    assert len(sold) == 2
+    # Claimed by primary key from the index, not by scanning the store's stock
+    [claim] = [s for s in statements if "FROM products" in s]
+    assert "products.id IN" in claim and "LIMIT" not in claim
+    assert indexed(store_id, "1 kg") == 1
+
+    # Status-only UPDATE back to stock: placement read after commit
+    await client.post("/api/v1/transactions/buyback", json={
+        "original_transaction_id": sale["id"], "staff_id": staff_id, "store_id": store_id,
+        "created_at": "2032-10-02T10:00:00", "items": [{"product_id": sold[0], "buyback_price": 80000000}]
+    })
+    assert indexed(store_id, "1 kg") == 2
+
+    moved = await client.post(f"/api/v1/products/{sold[0]}/move", params={"new_store_id": other_store_id})
+    assert moved.status_code == 200
+    assert (indexed(store_id, "1 kg"), indexed(other_store_id, "1 kg")) == (1, 1)
+    assert await availability_index.verify(db_session) == 0
+
+    # Writes behind the repository's back are repaired by verification
+    await db_session.execute(text("UPDATE products SET status = :s WHERE id = :id"), {"s": "Đã bán", "id": sold[0]})
+    await db_session.commit()
+    assert await availability_index.verify(db_session) == 1
+    assert indexed(other_store_id, "1 kg") == 0
+
+@pytest.mark.asyncio
+async def test_stats_cache_counts_failed_background_refresh(caplog):
+    from datetime import date
+    from app.core.stats_cache import StatsCache
+    cache = StatsCache(max_stale=60.0)
+    day = date(2032, 11, 1)
+
+    async def load():
+        return "computed"
+    async def failing_refresh():
+        raise RuntimeError("database away")
+
+    assert await cache.get("stats", day, day, load, failing_refresh) == "computed"
+    cache.invalidate([day])
+    # Stale value served while the refresh runs (and fails) in the background
+    assert await cache.get("stats", day, day, load, failing_refresh) == "computed"
+    await cache.drain()
+    assert cache.counters()["refresh_failures"] == 1
+    assert "Background refresh of stats" in caplog.text
+
+@pytest.mark.asyncio
+async def test_availability_verify_keeps_changes_committed_meanwhile(client: AsyncClient, db_session, monkeypatch):
+    from app.core.availability import availability_index
+    from app.db.models import Product, ProductStatus
+    store_id, _, _ = await create_parties(client)
+    product = Product(product_type="5 lượng", product_code=f"STOCK-{uuid.uuid4()}", store_id=store_id)
+    db_session.add(product)
+    await db_session.commit()
+    await availability_index.load(db_session)
+
+    # A sale commits in this process after the verifier's snapshot was read
+    snapshot = availability_index._snapshot
+    async def snapshot_then_commit(db):
+        result = await snapshot(db)
+        availability_index._apply(db_session.sync_session, {product.id: (ProductStatus.SOLD, None, None)})
+        return result
+    monkeypatch.setattr(availability_index, "_snapshot", snapshot_then_commit)
+    assert await availability_index.verify(db_session) == 0
+    assert indexed(store_id, "5 lượng") == 0